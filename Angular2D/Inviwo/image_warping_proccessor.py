@@ -32,11 +32,17 @@ import conversions
 import image_warping
 import data_transform
 import cnn_utils
+from compiled_model import CompiledModel
+from tiled_inference import TiledModel
 
 # For each input image to the network, add an inport here
 INPORT_LIST = ["im_inport1"]
 model = None
 cuda = True
+# 'trace' or 'inductor' to run the model compiled, None for eager
+COMPILE = None
+# Pixels a side of the remapped tiles to run the model on, None runs it whole
+TILE_SIZE = None
 GRID_SIZE = 64
 SIZE = 1024
 OUT_SIZE = inviwopy.glm.size2_t(SIZE, SIZE)
@@ -69,6 +75,13 @@ if model is None:
         model = model.cuda()
 
     model.eval()
+    if COMPILE is not None:
+        # The render size is fixed, so the frozen graph is reused
+        model = CompiledModel(
+            model, COMPILE, os.path.join(model_dir, "compile_cache"),
+            freeze=True)
+    if TILE_SIZE is not None:
+        model = TiledModel(model, TILE_SIZE, tile_batch=4)
 
 for name in INPORT_LIST:
     if not name in self.inports:
@@ -170,7 +183,8 @@ def process(self):
         im_input = im_input.cuda()
 
     model.eval()
-    output = model(im_input)
+    with torch.no_grad():
+        output = model(im_input)
     output += im_input
     output = torch.clamp(output, 0.0, 1.0)
     
@@ -0,0 +1,159 @@
+"""
+Checks a mixed precision mode against float32 on the validation sets
+
+Runs the model over fixed crops of each validation set of the config
+in float32 and with --amp, and compares the mean PSNR of the views.
+Exits with -1 if --amp loses more than --tolerance dB, so the mode is
+only adopted where quality holds.
+
+Example:
+python amp_check.py --pretrained best_model.pth --amp bf16
+"""
+import argparse
+import configparser
+import math
+import os
+import random
+import time
+
+import torch
+
+import cnn_utils
+import data_transform
+import helpers
+from data_loading import ValFromHdf5, InMemoryValLoader, close_h5_files
+from model_2d import C2D
+
+
+def view_psnr(outputs, targets, grid_size):
+    """
+    Returns the B, views PSNR of each view of a batch of remapped
+    light fields in 0 to 1, quantised to 8 bits as evaluate.my_psnr sees
+    """
+    one_way = data_transform.grid_width(grid_size)
+    num, channels, height, width = outputs.shape
+    diff = torch.round(outputs * 255.0) - torch.round(targets * 255.0)
+    # Remapped pixels are interleaved as C, H, view row, W, view column
+    diff = diff.view(
+        num, channels, height // one_way, one_way, width // one_way, one_way)
+    mse = diff.pow(2).mean(dim=(1, 2, 4)).flatten(1)
+    psnr = 20 * math.log10(255.0) - 10 * torch.log10(mse)
+    return torch.where(mse == 0, torch.full_like(psnr, 100.0), psnr)
+
+
+def run_model(model, loader, cuda, amp):
+    """
+    Returns the outputs of each batch of loader, the mean view PSNR
+    and the seconds taken running model in the mixed precision mode amp
+    """
+    all_outputs, psnrs = [], []
+    time_taken = 0.0
+    with cnn_utils.inference_context():
+        for batch in loader:
+            inputs, targets = batch['inputs'], batch['targets']
+            if cuda:
+                inputs = inputs.cuda()
+                targets = targets.cuda()
+            start_time = time.time()
+            _, outputs = cnn_utils.infer_batch(model, inputs, amp, cuda)
+            if cuda:
+                torch.cuda.synchronize()
+            time_taken += time.time() - start_time
+            all_outputs.append(outputs.cpu())
+            psnrs.append(view_psnr(
+                outputs, targets, int(batch['shape'][0][0])).cpu())
+    return all_outputs, torch.cat(psnrs).mean().item(), time_taken
+
+
+def main(args, config):
+    cuda = cnn_utils.check_cuda(config)
+    if args.pretrained:
+        model = cnn_utils.load_model_and_weights(args, config)
+    else:
+        print("No --pretrained model given, checking an untrained model")
+        torch.manual_seed(0)
+        model = C2D(args, inchannels=1, outchannels=1)
+    if cuda:
+        model = model.cuda()
+    model.eval()
+
+    file_path = os.path.join(config['PATH']['hdf5_dir'],
+                             config['PATH']['hdf5_name'])
+    # The same crops on every run of the check
+    random.seed(args.seed)
+    failed = False
+    for name in config['VALSETS'].values():
+        val_set = ValFromHdf5(
+            file_path=file_path, name=name,
+            patch_size=int(config['NETWORK']['val_patch_size']),
+            transform=data_transform.angular_remap,
+            sub_chan=config['NETWORK']['sub_chan'],
+            val_transform=config['NETWORK']['val_reduce'] == 'True')
+        loader = InMemoryValLoader(
+            val_set, int(config['NETWORK']['val_batch_size']))
+
+        base_outputs, base_psnr, base_time = run_model(
+            model, loader, cuda, None)
+        amp_outputs, amp_psnr, amp_time = run_model(
+            model, loader, cuda, args.amp)
+        max_diff = max(
+            torch.max(torch.abs(base - amp)).item()
+            for base, amp in zip(base_outputs, amp_outputs))
+
+        print("Validation set {}, {} light fields".format(
+            name, len(val_set)))
+        print("    fp32: psnr {:.4f}dB in {:.2f}s".format(
+            base_psnr, base_time))
+        print("    {}: psnr {:.4f}dB in {:.2f}s".format(
+            args.amp, amp_psnr, amp_time))
+        print("    psnr change {:.4f}dB, max output difference {:.5f}".format(
+            amp_psnr - base_psnr, max_diff))
+        if base_psnr - amp_psnr > args.tolerance:
+            print("    {} loses more than {}dB".format(
+                args.amp, args.tolerance))
+            failed = True
+    close_h5_files()
+    if failed:
+        exit(-1)
+    print("{} is within {}dB of fp32 on every validation set".format(
+        args.amp, args.tolerance))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Process modifiable parameters from command line')
+    PARSER.add_argument('--pretrained', default='', type=str,
+                        help='name of model in the config model dir')
+    PARSER.add_argument('--first', "--f", default=True, type=bool,
+                        help="Load the first layer pretrained - default True")
+    PARSER.add_argument("--amp", default="bf16", choices=["bf16"],
+                        help="Mixed precision mode to check")
+    PARSER.add_argument("--tolerance", default=0.1, type=float,
+                        help="Largest allowed psnr drop in dB, default 0.1")
+    PARSER.add_argument("--seed", default=0, type=int,
+                        help="Seed for the validation crops")
+    PARSER.add_argument('--config', "--cfg", default='main.ini', type=str,
+                        help="Name of config file to use")
+    PARSER.add_argument("--absolute_cfg", "-ac", action="store_true")
+    PARSER.add_argument('--n_feats', '--nf', default=8, type=int,
+                        help="Number of features of an untrained model")
+    PARSER.add_argument('--n_resblocks', '--nr', default=4, type=int,
+                        help="Number of residual blocks of an untrained model")
+    PARSER.add_argument('--res_scale', '--rs', default=1.0, type=float,
+                        help="Residual scale of an untrained model")
+    ARGS, UNPARSED = PARSER.parse_known_args()
+
+    if len(UNPARSED) != 0:
+        print("Unrecognised command line argument passed")
+        print(UNPARSED)
+        exit(-1)
+
+    CONFIG = configparser.ConfigParser()
+    if ARGS.absolute_cfg:
+        CONFIG.read(ARGS.config)
+    else:
+        CONFIG.read(os.path.join('config', ARGS.config))
+    helpers.print_config(CONFIG)
+    print(ARGS)
+    print()
+    main(ARGS, CONFIG)
@@ -0,0 +1,196 @@
+"""
+Finds the largest training batch size which fits a memory budget
+
+Runs forward and backward passes of the model on synthetic remapped
+inputs at growing batch sizes. On a GPU the peak allocated memory is
+measured, on CPU the tensors kept for backward, the inputs and outputs
+and the parameters, gradients and momentum are summed, as the CPU
+allocator keeps no peak statistics. Before each batch size is run,
+its use is estimated from the bytes per sample of the largest size
+measured so far, and sizes estimated over the budget are not run,
+as on CPU running out of memory often kills the process rather than
+raising. An allocation failure which does raise, from the GPU or the
+CPU allocator, counts as the batch size not fitting.
+The largest batch size which runs without running out of memory,
+stays within the budget and gives a finite loss is recorded in a json
+file for each n_feats, n_resblocks, patch_size, device and amp mode.
+"""
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+import cnn_utils
+from full_model import setup_model
+
+
+# Messages of the CUDA, CPU and Windows CPU allocators failing
+OUT_OF_MEMORY_MESSAGES = (
+    "out of memory", "can't allocate memory", "not enough memory")
+
+
+def is_out_of_memory(err):
+    """Returns whether err is a GPU or CPU allocation failing"""
+    if isinstance(err, getattr(torch, 'OutOfMemoryError', ())):
+        return True
+    message = str(err).lower()
+    return any(text in message for text in OUT_OF_MEMORY_MESSAGES)
+
+
+def synthetic_batch(batch_size, patch_size, grid_size=64, channels=3):
+    """Returns random remapped inputs and targets of patch_size views"""
+    one_way = int(round(grid_size ** 0.5))
+    shape = (batch_size, channels,
+             patch_size * one_way, patch_size * one_way)
+    return torch.rand(shape), torch.rand(shape)
+
+
+def cpu_step_bytes(model, optimizer, run_step):
+    """Returns the bytes run_step keeps alive, summed over tensors"""
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        loss, tensors = run_step()
+    for tensor in tensors:
+        saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+    param_bytes = sum(
+        param.numel() * param.element_size()
+        for param in model.parameters() if param.requires_grad)
+    # Weights, gradients and momentum buffers
+    return loss, sum(saved.values()) + 3 * param_bytes
+
+
+def try_batch_size(args, batch_size, cuda, repeats=2):
+    """
+    Returns the bytes used training on batch_size synthetic samples,
+    or None if it runs out of memory or the loss is not finite
+    """
+    model, criterion, optimizer, _ = setup_model(args)
+    if cuda:
+        model = model.cuda()
+    model.train()
+
+    def run_step():
+        optimizer.zero_grad()
+        with cnn_utils.amp_context(args.amp, cuda):
+            residuals, outputs = cnn_utils.forward_residual(model, inputs)
+            loss = criterion(outputs, targets)
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        optimizer.step()
+        return loss, (inputs, targets, residuals, outputs)
+
+    try:
+        inputs, targets = synthetic_batch(batch_size, args.patch_size)
+        if cuda:
+            inputs, targets = inputs.cuda(), targets.cuda()
+        for _ in range(repeats):
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats()
+                base_bytes = torch.cuda.memory_allocated()
+                loss, _ = run_step()
+                torch.cuda.synchronize()
+                used_bytes = torch.cuda.max_memory_allocated() - base_bytes
+            else:
+                loss, used_bytes = cpu_step_bytes(model, optimizer, run_step)
+            if not torch.isfinite(loss).item():
+                return None
+    except RuntimeError as err:
+        if not is_out_of_memory(err):
+            raise
+        if cuda:
+            torch.cuda.empty_cache()
+        return None
+    return used_bytes
+
+
+def default_budget(cuda):
+    """Returns 90% of the GPU memory or half the available CPU memory"""
+    if cuda:
+        return int(0.9 * torch.cuda.get_device_properties(0).total_memory)
+    return int(0.5 * os.sysconf('SC_PAGE_SIZE') *
+               os.sysconf('SC_AVPHYS_PAGES'))
+
+
+def find_batch_size(args, cuda, budget, max_batch=4096):
+    """
+    Returns the largest batch size up to max_batch within budget bytes,
+    doubling until it fails and then bisecting between the last pass
+    and fail, without running sizes estimated to be over budget
+    """
+    # Bytes per sample of the largest passing size, an overestimate for
+    # larger sizes as it includes the fixed cost of the model
+    per_sample = None
+    good, bad = 0, None
+
+    def fits(batch_size):
+        nonlocal per_sample
+        if per_sample is not None and per_sample * batch_size > budget:
+            print("Batch size {}: estimated {:.1f}MB, not run".format(
+                batch_size, per_sample * batch_size / 1e6))
+            return False
+        used_bytes = try_batch_size(args, batch_size, cuda)
+        print("Batch size {}: {}".format(
+            batch_size, "{:.1f}MB".format(used_bytes / 1e6)
+            if used_bytes is not None else "failed"))
+        if used_bytes is None or used_bytes > budget:
+            return False
+        if batch_size > good:
+            per_sample = used_bytes / batch_size
+        return True
+
+    batch_size = 1
+    while bad is None and batch_size <= max_batch:
+        if fits(batch_size):
+            good, batch_size = batch_size, batch_size * 2
+        else:
+            bad = batch_size
+    if bad is None:
+        bad = max_batch + 1
+    while bad - good > 1:
+        batch_size = (good + bad) // 2
+        if fits(batch_size):
+            good = batch_size
+        else:
+            bad = batch_size
+    return good
+
+
+def record_batch_size(location, key, batch_size):
+    """Stores batch_size under key in the json file at location"""
+    records = {}
+    if os.path.isfile(location):
+        with open(location) as json_file:
+            records = json.load(json_file)
+    records[key] = batch_size
+    with open(location, 'w') as json_file:
+        json.dump(records, json_file, indent=2, sort_keys=True)
+
+
+def main(args, config):
+    """Finds and records the batch size for args and config"""
+    cuda = cnn_utils.check_cuda(config)
+    args.patch_size = int(config['NETWORK']['patch_size'])
+    budget = args.memory_budget or default_budget(cuda)
+    print("Finding the largest batch size within {:.1f}MB".format(
+        budget / 1e6))
+    max_batch = int(config['NETWORK'].get('max_batch_size', 4096))
+    batch_size = find_batch_size(args, cuda, budget, max_batch)
+    key = "nf{}_nr{}_ps{}_{}_{}".format(
+        args.n_feats, args.n_resblocks, args.patch_size,
+        'cuda' if cuda else 'cpu', args.amp or 'fp32')
+    location = os.path.join(
+        config['PATH']['checkpoint_dir'], 'batch_sizes.json')
+    if not os.path.exists(config['PATH']['checkpoint_dir']):
+        os.makedirs(config['PATH']['checkpoint_dir'])
+    record_batch_size(location, key, batch_size)
+    print("Largest batch size for {} is {}, recorded in {}".format(
+        key, batch_size, location))
+    return batch_size
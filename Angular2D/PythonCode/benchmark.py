@@ -0,0 +1,511 @@
+"""Micro benchmarks for the data pipeline and model, run from the cmd"""
+import argparse
+import configparser
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import torch
+
+import cnn_main
+import cnn_utils
+import data_loading
+import data_transform
+import distributed
+import helpers
+import lf_metrics
+from compiled_model import CompiledModel
+from full_model import setup_model
+from model_2d import C2D, fold_c2d
+from tiled_inference import TiledModel
+from image_logger import ImageGridLogger
+from metrics_check import reference_metrics
+from step_timer import StepTimer
+from train_state import TrainProgress
+
+
+def print_rate(name, num_items, time_taken):
+    """Prints the number of items per second for a benchmark"""
+    print("{}: {} items in {:.2f}s, {:.2f} items/s".format(
+        name, num_items, time_taken, num_items / time_taken))
+
+
+def bench_loader(args, config):
+    """
+    Compares items/sec of reading training light fields with
+    a new h5py file per item against a persistent per-process handle
+    """
+    file_path = os.path.join(config['PATH']['hdf5_dir'],
+                             config['PATH']['hdf5_name'])
+    rdcc_nbytes, rdcc_nslots = data_loading.get_chunk_cache_config(config)
+    num_crops = int(config['NETWORK']['num_crops'])
+    with h5py.File(
+            file_path, mode='r', libver='latest', swmr=True) as h5_file:
+        num_samples = h5_file['train'].attrs['lf_shape'][0]
+    num_items = min(args.n, num_samples * num_crops)
+
+    start_time = time.time()
+    for index in range(num_items):
+        with h5py.File(
+                file_path, mode='r', libver='latest', swmr=True) as h5_file:
+            h5_file['/train/images'][index // num_crops]
+            h5_file['/train/warped'][index // num_crops]
+    print_rate("Open per item", num_items, time.time() - start_time)
+
+    start_time = time.time()
+    for index in range(num_items):
+        h5_file = data_loading.get_h5_file(
+            file_path, rdcc_nbytes, rdcc_nslots)
+        h5_file['/train/images'][index // num_crops]
+        h5_file['/train/warped'][index // num_crops]
+    print_rate("Persistent handle", num_items, time.time() - start_time)
+    data_loading.close_h5_files()
+
+    start_time = time.time()
+    train_set = data_loading.TrainFromHdf5(
+        file_path=file_path,
+        patch_size=int(config['NETWORK']['patch_size']),
+        num_crops=num_crops,
+        rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+    for index in range(num_items):
+        train_set[index]
+    print_rate("TrainFromHdf5", num_items, time.time() - start_time)
+    data_loading.close_h5_files()
+
+
+def loop_create_remap(in_tensor, dtype=torch.uint8):
+    """The original per view loop version of data_transform.create_remap"""
+    num, channels, im_height, im_width = in_tensor.shape
+    one_way = int(math.floor(math.sqrt(num)))
+    out_tensor = torch.zeros(
+        size=(channels, im_height * one_way, im_width * one_way),
+        dtype=dtype)
+    for i in range(num):
+        out_tensor[
+            :, i % one_way::one_way, i // one_way::one_way] = in_tensor[i]
+    return out_tensor
+
+
+def loop_undo_remap(in_tensor, desired_shape, dtype=torch.uint8):
+    """The original per view loop version of data_transform.undo_remap"""
+    num, _, _, _ = desired_shape
+    one_way = int(math.floor(math.sqrt(num)))
+    out_tensor = torch.zeros(size=desired_shape, dtype=dtype)
+    for i in range(num):
+        out_tensor[i] = in_tensor[
+            :, i % one_way::one_way, i // one_way::one_way]
+    return out_tensor
+
+
+def check_remap(lfs, lf_shape):
+    """
+    Returns a description of the first way the batched create_remap
+    and undo_remap differ from the loop versions or fail to round trip,
+    with and without out buffers, or None if they all match
+    """
+    remapped = data_transform.create_remap(lfs, dtype=torch.float32)
+    unmapped = data_transform.undo_remap(
+        remapped, lf_shape, dtype=torch.float32)
+    for lf, remap, unmap in zip(lfs, remapped, unmapped):
+        if not torch.equal(remap, loop_create_remap(lf, dtype=torch.float32)):
+            return "create_remap does not match the loop implementation"
+        if not torch.equal(
+                unmap, loop_undo_remap(remap, lf_shape, dtype=torch.float32)):
+            return "undo_remap does not match the loop implementation"
+    if not torch.equal(unmapped, lfs):
+        return "undo_remap does not invert create_remap"
+
+    # Write into stale buffers, so any element left unwritten shows
+    out = torch.full_like(remapped, -1.0)
+    unmapped = torch.full_like(lfs, -1.0)
+    data_transform.create_remap(lfs, dtype=torch.float32, out=out)
+    data_transform.undo_remap(
+        out, lf_shape, dtype=torch.float32, out=unmapped)
+    if not torch.equal(out, remapped) or not torch.equal(unmapped, lfs):
+        return "Remapping into out buffers does not round trip"
+    data_transform.create_remap(lfs[0], dtype=torch.float32, out=out[0])
+    data_transform.undo_remap(
+        out[0], lf_shape, dtype=torch.float32, out=unmapped[0])
+    if not torch.equal(out[0], remapped[0]) or not torch.equal(
+            unmapped[0], lfs[0]):
+        return "Remapping one light field into out buffers does not round trip"
+    return None
+
+
+def time_call(function, repeats):
+    """Returns the mean seconds taken by function over repeats calls"""
+    function()
+    start_time = time.time()
+    for _ in range(repeats):
+        function()
+    return (time.time() - start_time) / repeats
+
+
+def bench_remap(args, config):
+    """
+    Compares the per view loop remap with the reshape/permute version
+    for a batch of train_batch_size light fields of patch_size views
+    """
+    batch_size = int(config['NETWORK'].get('train_batch_size', 4))
+    patch_size = int(config['NETWORK']['patch_size'])
+    lf_shape = (64, 3, patch_size, patch_size)
+    lfs = torch.rand((batch_size,) + lf_shape)
+    remapped = data_transform.create_remap(lfs, dtype=torch.float32)
+    out = torch.empty_like(remapped)
+    unmapped = torch.empty_like(lfs)
+
+    failure = check_remap(lfs, lf_shape)
+    if failure is not None:
+        print(failure)
+        exit(-1)
+
+    results = [
+        ("Loop create_remap", time_call(lambda: [
+            loop_create_remap(lf, dtype=torch.float32)
+            for lf in lfs], args.n)),
+        ("Batched create_remap", time_call(lambda:
+            data_transform.create_remap(
+                lfs, dtype=torch.float32, out=out), args.n)),
+        ("Loop undo_remap", time_call(lambda: [
+            loop_undo_remap(lf, lf_shape, dtype=torch.float32)
+            for lf in remapped], args.n)),
+        ("Batched undo_remap", time_call(lambda:
+            data_transform.undo_remap(
+                remapped, lf_shape, dtype=torch.float32,
+                out=unmapped), args.n)),
+    ]
+    print("Remapping a batch of {} light fields of shape {}".format(
+        batch_size, lf_shape))
+    for name, time_taken in results:
+        print("{}: {:.2f}ms".format(name, time_taken * 1000))
+
+
+def distributed_epoch(rank, world_size, config, model_args, result_path):
+    """
+    Times one training epoch as one rank of bench_distributed,
+    after a first epoch to warm up, rank 0 writes the time to result_path
+    """
+    train_loader = data_loading.create_dataloaders(
+        model_args, config, rank, world_size)['train']
+    model, criterion, optimizer, _ = setup_model(model_args)
+    train_model = distributed.wrap_model(model)
+    image_logger = ImageGridLogger(distributed.NullWriter())
+    for epoch in range(2):
+        data_loading.set_sampler_epoch(train_loader, epoch)
+        distributed.barrier()
+        start_time = time.time()
+        cnn_main.train_phase(
+            train_model, train_loader, optimizer, criterion, epoch,
+            cuda=False, clip=model_args.clip, image_logger=image_logger,
+            timer=StepTimer(), progress=TrainProgress())
+        distributed.barrier()
+        time_taken = time.time() - start_time
+    image_logger.close()
+    data_loading.close_h5_files()
+    if rank == 0:
+        with open(result_path, 'w') as result_file:
+            json.dump({'time': time_taken, 'steps': len(train_loader)},
+                      result_file)
+
+
+def bench_distributed(args, config):
+    """
+    Compares training epoch times of cnn_main --distributed
+    over --ranks processes on a synthetic set of --n light fields
+    with views a little larger than patch_size
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench_distributed_')
+    helpers.write_synthetic_hdf5(
+        os.path.join(work_dir, 'synthetic.h5'),
+        num_train=args.n, num_val=1,
+        size=int(config['NETWORK']['patch_size']) + 8)
+    bench_config = configparser.ConfigParser()
+    bench_config.read_dict({
+        'PATH': {'hdf5_dir': work_dir, 'hdf5_name': 'synthetic.h5'},
+        'NETWORK': {
+            'patch_size': config['NETWORK']['patch_size'],
+            'val_patch_size': config['NETWORK']['patch_size'],
+            'num_crops': config['NETWORK']['num_crops'],
+            'train_batch_size': config['NETWORK']['train_batch_size'],
+            'val_batch_size': '1', 'num_workers': '0',
+            'sub_chan': 'False', 'crop_train': 'True',
+            'val_reduce': 'False'},
+        'VALSETS': {}})
+    model_args = argparse.Namespace(
+        lr=0.1, momentum=0.9, weight_decay=1e-4, nEpochs=1, clip=0.4,
+        n_feats=8, n_resblocks=4, res_scale=1.0)
+    num_items = args.n * int(config['NETWORK']['num_crops'])
+    result_path = os.path.join(work_dir, 'result.json')
+    results = []
+    for world_size in [int(ranks) for ranks in args.ranks.split(',')]:
+        distributed.launch(
+            distributed_epoch, world_size,
+            bench_config, model_args, result_path)
+        with open(result_path) as result_file:
+            results.append((world_size, json.load(result_file)))
+    shutil.rmtree(work_dir)
+
+    print("Training a {} light field epoch with {} crops each".format(
+        args.n, config['NETWORK']['num_crops']))
+    base_rate = None
+    for world_size, result in results:
+        rate = num_items / result['time']
+        base_rate = base_rate or rate / results[0][0]
+        print_rate("{} ranks, {} steps each".format(
+            world_size, result['steps']), num_items, result['time'])
+        print("    speedup {:.2f}, efficiency {:.0f}%".format(
+            rate / base_rate, 100 * rate / (base_rate * world_size)))
+
+
+def first_call(create, call):
+    """Returns the seconds taken to create a model and call it once"""
+    start_time = time.time()
+    runner = create()
+    call(runner)
+    return time.time() - start_time
+
+
+def bench_compile(args, config):
+    """
+    Compares the eager model with the --modes of compiled_model on a
+    train_batch_size batch of patch_size light fields, timing the first
+    call with an empty compile cache (cold start) and with the cache of
+    the first call (warm start), and steady state inference and training
+    """
+    batch_size = int(config['NETWORK'].get('train_batch_size', 4))
+    patch_size = int(config['NETWORK']['patch_size'])
+    inputs = torch.rand(batch_size, 3, patch_size * 8, patch_size * 8)
+    targets = torch.rand_like(inputs)
+    model_args = argparse.Namespace(
+        lr=0.1, momentum=0.9, weight_decay=1e-4, nEpochs=1, clip=0.4,
+        n_feats=8, n_resblocks=4, res_scale=1.0)
+    model, criterion, optimizer, _ = setup_model(model_args)
+    cache_dir = tempfile.mkdtemp(prefix='bench_compile_')
+
+    def infer(runner):
+        with cnn_utils.inference_context():
+            runner(inputs)
+
+    results = []
+    for mode in ['eager'] + args.modes.split(','):
+        def create(freeze=True):
+            if mode == 'eager':
+                return model
+            return CompiledModel(model, mode, cache_dir, freeze=freeze)
+
+        model.eval()
+        cold_time = first_call(create, infer)
+        if hasattr(torch, 'compiler'):
+            # Drop in memory compiled code, so only the disk cache is warm
+            torch.compiler.reset()
+        warm_time = first_call(create, infer)
+        runner = create()
+        infer(runner)
+        infer_time = time_call(lambda: infer(runner), args.n)
+
+        model.train()
+        train_runner = create(freeze=False)
+
+        def train_step():
+            optimizer.zero_grad()
+            _, outputs = cnn_utils.forward_residual(train_runner, inputs)
+            criterion(outputs, targets).backward()
+            optimizer.step()
+        train_time = time_call(train_step, args.n)
+        results.append((mode, cold_time, warm_time, infer_time, train_time))
+    shutil.rmtree(cache_dir)
+
+    print("C2D on a batch of {} inputs of shape {} on {} threads".format(
+        batch_size, tuple(inputs.shape[1:]), torch.get_num_threads()))
+    base_infer, base_train = results[0][3], results[0][4]
+    for mode, cold_time, warm_time, infer_time, train_time in results:
+        print("{}: cold start {:.2f}s, warm start {:.2f}s".format(
+            mode, cold_time, warm_time))
+        print("    inference {:.2f}ms, speedup {:.2f}".format(
+            infer_time * 1000, base_infer / infer_time))
+        print("    training step {:.2f}ms, speedup {:.2f}".format(
+            train_time * 1000, base_train / train_time))
+
+
+def bench_fold(args, config):
+    """
+    Compares inference latency of C2D with the model_2d.fold_c2d version
+    on one remapped light field of --view_size views
+    """
+    inputs = torch.rand(1, 3, args.view_size * 8, args.view_size * 8)
+    model = C2D(argparse.Namespace(
+        n_feats=8, n_resblocks=4, res_scale=0.1),
+        inchannels=1, outchannels=1).eval()
+    folded = fold_c2d(model).eval()
+
+    def infer(runner):
+        with cnn_utils.inference_context():
+            return runner(inputs)
+
+    max_diff = torch.max(torch.abs(infer(model) - infer(folded))).item()
+    results = [("C2D", time_call(lambda: infer(model), args.n)),
+               ("Folded C2D", time_call(lambda: infer(folded), args.n))]
+    print("C2D on a remapped light field of shape {} on {} threads".format(
+        tuple(inputs.shape[1:]), torch.get_num_threads()))
+    for name, time_taken in results:
+        print("{}: {:.2f}ms, speedup {:.2f}".format(
+            name, time_taken * 1000, results[0][1] / time_taken))
+    print("Largest output difference {:.3e}".format(max_diff))
+
+
+def tiled_run(tile_size, tile_batch, view_size, result_path, reference_path):
+    """
+    Runs C2D over one remapped light field of view_size views in tiles
+    of tile_size as a process of bench_tiles, writing the time taken,
+    the growth in peak resident memory and the largest difference
+    from the outputs at reference_path, or saving them there if missing
+    """
+    torch.manual_seed(0)
+    model = C2D(argparse.Namespace(
+        n_feats=8, n_resblocks=4, res_scale=1.0),
+        inchannels=1, outchannels=1).eval()
+    if tile_size > 0:
+        model = TiledModel(model, tile_size, tile_batch)
+    inputs = torch.rand(1, 3, view_size * 8, view_size * 8)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    with cnn_utils.inference_context():
+        outputs = model(inputs)
+    time_taken = time.time() - start_time
+    # ru_maxrss is in kilobytes on linux
+    peak_bytes = 1024 * (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss)
+    max_diff = 0.0
+    if os.path.isfile(reference_path):
+        max_diff = torch.max(torch.abs(
+            outputs - torch.load(reference_path))).item()
+    else:
+        torch.save(outputs, reference_path)
+    with open(result_path, 'w') as result_file:
+        json.dump({'time': time_taken, 'peak_bytes': peak_bytes,
+                   'max_diff': max_diff}, result_file)
+
+
+def bench_tiles(args, config):
+    """
+    Compares time and peak memory of whole image inference with
+    tiled_inference.TiledModel over --tile_sizes, on one remapped light
+    field of --view_size views, each in a fresh process for its peak memory
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench_tiles_')
+    result_path = os.path.join(work_dir, 'result.json')
+    reference_path = os.path.join(work_dir, 'reference.pth')
+    context = multiprocessing.get_context('spawn')
+    results = []
+    # The whole image first, giving the reference outputs
+    for tile_size in [0] + [int(size) for size in args.tile_sizes.split(',')]:
+        process = context.Process(target=tiled_run, args=(
+            tile_size, args.tile_batch, args.view_size,
+            result_path, reference_path))
+        process.start()
+        process.join()
+        with open(result_path) as result_file:
+            results.append((tile_size, json.load(result_file)))
+    shutil.rmtree(work_dir)
+
+    print("C2D on a remapped light field of {} pixel views".format(
+        args.view_size))
+    base_time = results[0][1]['time']
+    for tile_size, result in results:
+        print("{}: {:.2f}s, speedup {:.2f}, peak memory growth {:.0f}MB, "
+              "largest difference {:.3e}".format(
+                  "Tiles of {} in batches of {}".format(
+                      tile_size, args.tile_batch)
+                  if tile_size else "Whole image",
+                  result['time'], base_time / result['time'],
+                  result['peak_bytes'] / 1e6, result['max_diff']))
+
+
+def bench_metrics(args, config):
+    """
+    Compares the per view evaluate PSNR and SSIM with lf_metrics
+    on a noisy light field of --n views of --view_size pixels
+    """
+    rng = np.random.default_rng(0)
+    shape = (args.n, 3, args.view_size, args.view_size)
+    ground_truth = rng.integers(0, 256, shape, np.uint8)
+    views = np.clip(ground_truth + rng.normal(0, 10, shape), 0, 255).astype(
+        np.uint8)
+    reference = reference_metrics(views, ground_truth)
+
+    results = [("Per view evaluate", time_call(
+        lambda: reference_metrics(views, ground_truth), 1), 0.0)]
+    for name, dtype in (("lf_metrics float64", torch.float64),
+                        ("lf_metrics float32", torch.float32)):
+        values = lf_metrics.view_metrics(views, ground_truth, dtype=dtype)
+        max_diff = max(
+            float(np.max(np.abs(np.array(values[i]) - reference[i])))
+            for i in range(2))
+        results.append((name, time_call(
+            lambda: lf_metrics.view_metrics(
+                views, ground_truth, dtype=dtype), 1), max_diff))
+
+    print("PSNR and SSIM of {} views of shape {} on {} threads".format(
+        args.n, shape[1:], torch.get_num_threads()))
+    for name, time_taken, max_diff in results:
+        print("{}: {:.2f}s, {:.1f} views/s, speedup {:.2f}, "
+              "largest difference {:.3e}".format(
+                  name, time_taken, args.n / time_taken,
+                  results[0][1] / time_taken, max_diff))
+
+
+BENCHMARKS = {
+    'loader': bench_loader,
+    'remap': bench_remap,
+    'distributed': bench_distributed,
+    'compile': bench_compile,
+    'fold': bench_fold,
+    'tiles': bench_tiles,
+    'metrics': bench_metrics,
+}
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Process modifiable parameters from command line')
+    PARSER.add_argument('--bench', "-b", default='loader', type=str,
+                        choices=sorted(BENCHMARKS.keys()),
+                        help="Which benchmark to run")
+    PARSER.add_argument('--n', default=64, type=int,
+                        help="Number of items to time, default 64")
+    PARSER.add_argument('--config', "--cfg", default='main.ini', type=str,
+                        help="Name of config file to use")
+    PARSER.add_argument('--ranks', default='1,2,4,8', type=str,
+                        help="Comma separated process counts to compare " +
+                        "in the distributed benchmark")
+    PARSER.add_argument('--view_size', default=512, type=int,
+                        help="View size of the light field in the " +
+                        "fold, tiles and metrics benchmarks, " +
+                        "default 512 for full resolution")
+    PARSER.add_argument('--tile_sizes', default='128,256,512,1024', type=str,
+                        help="Comma separated tile sizes to compare with " +
+                        "the whole image in the tiles benchmark")
+    PARSER.add_argument('--tile_batch', default=4, type=int,
+                        help="Tiles per batch in the tiles benchmark")
+    PARSER.add_argument('--modes', default='trace,inductor', type=str,
+                        help="Comma separated compile modes to compare " +
+                        "with eager in the compile benchmark")
+    ARGS, UNPARSED = PARSER.parse_known_args()
+
+    if len(UNPARSED) != 0:
+        print("Unrecognised command line argument passed")
+        print(UNPARSED)
+        exit(-1)
+
+    CONFIG = configparser.ConfigParser()
+    CONFIG.read(os.path.join('config', ARGS.config))
+    helpers.print_config(CONFIG)
+    print(ARGS)
+    print()
+    BENCHMARKS[ARGS.bench](ARGS, CONFIG)
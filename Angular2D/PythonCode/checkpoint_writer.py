@@ -0,0 +1,156 @@
+"""
+Saves training checkpoints on a background thread
+
+The training loop only copies the state dicts to CPU memory,
+pickling and writing happen off the loop. Each file is written to a
+temporary name in the same directory and renamed, so a crash never
+leaves a half written checkpoint behind. An error writing a checkpoint
+is raised by the next save, flush or close.
+"""
+import copy
+import os
+import queue
+import tempfile
+import threading
+
+import torch
+
+
+def snapshot_state(state):
+    """
+    Returns a copy of a (nested) state dict with every tensor
+    detached and copied to CPU memory
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)(
+            (key, snapshot_state(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def atomic_save(state, location, save_fn=torch.save):
+    """
+    Saves state with save_fn to a temporary file and renames it to
+    location, so a crash never leaves a partly written file there
+    """
+    save_dir = os.path.dirname(location)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    handle, tmp_location = tempfile.mkstemp(
+        dir=save_dir, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            save_fn(state, tmp_file)
+        os.replace(tmp_location, location)
+    except BaseException:
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+        raise
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in the cnn_utils.save_checkpoint format
+    from a thread, keeping the last keep_last rotating ones on disk
+    """
+
+    def __init__(self, model, keep_last=0, max_queue=2):
+        """
+        Keyword arguments:
+        model -- the model being trained, a CPU copy of its architecture
+                 is pickled alongside each state dict
+        keep_last -- how many rotating checkpoints to keep, 0 keeps all
+        max_queue -- the number of snapshots to hold before save blocks
+        """
+        self.architecture = copy.deepcopy(model).cpu()
+        self.keep_last = keep_last
+        self.written = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def snapshot(model):
+        """Returns a CPU copy of the state dict of model"""
+        return snapshot_state(model.state_dict())
+
+    def save(self, epoch, optimizer, best_loss, save_dir, name,
+             state_dict=None, model=None, rotate=True, extra=None):
+        """
+        Queues a checkpoint of state_dict, or a snapshot of model
+        rotate -- whether this counts towards the keep_last checkpoints
+        extra -- an optional dict of more state to store in the checkpoint
+        """
+        self.raise_error()
+        if state_dict is None:
+            if model is None:
+                print("No model or state dict given for saving")
+                return -1
+            state_dict = self.snapshot(model)
+        if epoch is None:
+            print("No epoch given for saving")
+            return -1
+        state = {"epoch": epoch,
+                 "state_dict": state_dict,
+                 "best_loss": best_loss,
+                 "optimizer": snapshot_state(optimizer.state_dict())}
+        if extra is not None:
+            state.update(snapshot_state(extra))
+        self.queue.put((state, os.path.join(save_dir, name), rotate))
+
+    def write(self, state, location, rotate):
+        """Writes one checkpoint and removes any rotated out ones"""
+        # Skip any partial loading overrides of the model class
+        torch.nn.Module.load_state_dict(
+            self.architecture, state["state_dict"])
+        state["model"] = self.architecture
+        atomic_save(state, location)
+        print("Checkpoint saved to {}".format(location))
+        if not rotate:
+            return
+        if location in self.written:
+            self.written.remove(location)
+        self.written.append(location)
+        while self.keep_last > 0 and len(self.written) > self.keep_last:
+            old_location = self.written.pop(0)
+            try:
+                os.remove(old_location)
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        """
+        Writes queued checkpoints until a None is received, keeping the
+        first error and skipping the checkpoints after it
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.write(*item)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        """Raises the error of the writing thread, if it had one"""
+        if self.error is not None:
+            raise RuntimeError("Failed to save checkpoint") from self.error
+
+    def flush(self):
+        """Blocks until every queued checkpoint has been written"""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """Writes any queued checkpoints and stops the thread"""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
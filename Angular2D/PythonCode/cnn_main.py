@@ -4,7 +4,7 @@ https://github.com/twtygqyy/pytorch-vdsr
 And the pytorch example files """
 import argparse
 import configparser
-import copy
+import contextlib
 import math
 import os
 import time
@@ -12,15 +12,21 @@ import pathlib
 
 import torch
 import torch.nn as nn
-import torchvision.utils as vutils
 from tensorboardX import SummaryWriter
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
+import batch_finder
 import cnn_utils
+from compiled_model import CompiledModel, COMPILE_MODES, default_cache_dir
 from full_model import setup_model
-from data_loading import create_dataloaders
+from step_timer import StepTimer
+from checkpoint_writer import CheckpointWriter
+import train_state
+from train_state import TrainProgress
+from data_loading import create_dataloaders, set_sampler_epoch
+import distributed
 import helpers
-from data_transform import undo_remap
+from image_logger import ImageGridLogger
 
 CONTINUE_MESSAGE = "==> Would you like to continue training?"
 SAVE_MESSAGE = "==> Would you like to save the model?"
@@ -28,14 +34,20 @@ SAVE_MESSAGE = "==> Would you like to save the model?"
 
 def main(args, config, writer):
     best_loss = math.inf
-    best_model, best_epoch = None, None
+    best_state, best_epoch = None, None
     cuda = cnn_utils.check_cuda(config)
 
     # Attempts to otimise - see
     # https://discuss.pytorch.org/t/what-does-torch-backends-cudnn-benchmark-do
     torch.backends.cudnn.benchmark = True
 
-    data_loaders = create_dataloaders(args, config)
+    # Only rank 0 validates, logs and saves when distributed
+    is_main = distributed.is_main_process()
+    data_loaders = create_dataloaders(
+        args, config, distributed.get_rank(), distributed.get_world_size())
+    timer = StepTimer(enabled=args.profile_steps, cuda=cuda)
+    image_logger = ImageGridLogger(
+        writer, int(config['NETWORK'].get('image_log_downsample', 1)))
 
     model, criterion, optimizer, lr_scheduler = setup_model(args)
     if cuda:  # GPU support
@@ -50,39 +62,76 @@ def main(args, config, writer):
     if args.pretrained:  # Direct copy weights from another model
         cnn_utils.load_weights(model, args, config, frozen=args.frozen)
 
+    checkpointer = CheckpointWriter(model, keep_last=args.keep_last)
+    progress = TrainProgress(save_every=args.save_every)
+    if args.resume:  # Resume from the exact batch of a resume checkpoint
+        resume = train_state.load_resume_state(os.path.join(
+            config['PATH']['checkpoint_dir'], args.resume))
+        best_loss, best_epoch, best_state = train_state.restore(
+            resume, model, optimizer, lr_scheduler, progress,
+            data_loaders)
+        args.start_epoch = progress.epoch
+    # All-reduces the gradients over the ranks, after loading weights
+    train_model = distributed.wrap_model(model)
+    if args.compile:
+        # The eager model keeps the weights the optimizer and saves use
+        train_model = CompiledModel(
+            model, args.compile, default_cache_dir(config))
+
+    def save_progress():
+        checkpointer.save(
+            progress.epoch, optimizer, best_loss,
+            config['PATH']['checkpoint_dir'],
+            args.tag + "_resume.pth", model=model, rotate=False,
+            extra=train_state.resume_extras(
+                lr_scheduler, progress, best_epoch, best_state,
+                data_loaders))
+    if is_main:
+        progress.save_fn = save_progress
+
     # Perform training and testing
     print("Beginning training loop")
     for epoch in range(args.start_epoch, args.start_epoch + args.nEpochs):
         epoch_loss = 0
         epoch_loss_all = train(
-            model=model, dset_loaders=data_loaders,
+            model=train_model, dset_loaders=data_loaders,
             optimizer=optimizer, lr_scheduler=lr_scheduler,
             criterion=criterion, epoch=epoch,
-            cuda=cuda, clip=args.clip, writer=writer)
+            cuda=cuda, clip=args.clip, writer=writer, timer=timer,
+            image_logger=image_logger, progress=progress, amp=args.amp,
+            accumulate_steps=args.accumulate_steps)
+        # Finish the image grids of this epoch before moving on
+        image_logger.flush()
+        if is_main:
+            timer.save(
+                config['PATH']['checkpoint_dir'],
+                args.tag + "_timings.json")
 
         for val in epoch_loss_all:
             epoch_loss += val / len(epoch_loss_all)
+        # Only rank 0 validates, so every rank takes its loss to track
+        # the same best_loss, which a resume then restores on each rank
+        epoch_loss = distributed.broadcast(epoch_loss)
 
         if epoch_loss < best_loss:
             best_loss = epoch_loss
             best_epoch = epoch
-            best_model = copy.deepcopy(model)
+            if is_main:
+                best_state = checkpointer.snapshot(model)
+
+        lr_scheduler = restart_lr_scheduler(lr_scheduler, optimizer, args.lr)
 
-        # Update the scheduler - restarting
-        if lr_scheduler.last_epoch == lr_scheduler.T_max:
-            for group in optimizer.param_groups:
-                group['lr'] = args.lr
-            lr_scheduler = CosineAnnealingLR(
-                optimizer,
-                T_max=lr_scheduler.T_max * 2)
+        progress.end_epoch()
+        if is_main and args.save_every > 0:
+            save_progress()
 
         # cnn_utils.log_all_layer_weights(model, writer, epoch)
 
-        if epoch % 1 == 0 and epoch != 0:
-            cnn_utils.save_checkpoint(
-                model, epoch, optimizer, best_loss,
+        if is_main and epoch % 1 == 0 and epoch != 0:
+            checkpointer.save(
+                epoch, optimizer, best_loss,
                 config['PATH']['checkpoint_dir'],
-                args.tag + "{}.pth".format(epoch))
+                args.tag + "{}.pth".format(epoch), model=model)
 
         if args.prompt:
             if not helpers.prompt_user(CONTINUE_MESSAGE):
@@ -100,12 +149,13 @@ def main(args, config, writer):
             save = False
 
     # Save the best model
-    if save:
-        cnn_utils.save_checkpoint(
-            best_model, best_epoch, optimizer, best_loss,
+    if save and is_main:
+        checkpointer.save(
+            best_epoch, optimizer, best_loss,
             config['PATH']['model_dir'],
-            args.tag + "_best_at{}.pth".format(best_epoch)
-        )
+            args.tag + "_best_at{}.pth".format(best_epoch),
+            state_dict=best_state, rotate=False)
+    checkpointer.close()
 
     parent_dir = os.path.abspath(os.pardir)
     scalar_dir = os.path.join(parent_dir, "logs", args.tag)
@@ -113,108 +163,82 @@ def main(args, config, writer):
     #     pathlib.Path(scalar_dir).mkdir(parents=True, exist_ok=True)
     # writer.export_scalars_to_json(
     #     os.path.join(scalar_dir, "all_scalars.json"))
+    image_logger.close()
     writer.close()
 
 
+def distributed_main(rank, world_size, args, config, tboard_loc):
+    """Runs main as one rank of --distributed training"""
+    if rank == 0:
+        writer = SummaryWriter(log_dir=tboard_loc)
+    else:
+        writer = distributed.NullWriter()
+    main(args, config, writer)
+
+
+def restart_lr_scheduler(lr_scheduler, optimizer, lr):
+    """
+    Returns a CosineAnnealingLR with double the period, restarted at lr,
+    once lr_scheduler completes its period, otherwise lr_scheduler
+    """
+    # Update the scheduler - restarting
+    if lr_scheduler.last_epoch == lr_scheduler.T_max:
+        for group in optimizer.param_groups:
+            group['lr'] = lr
+        lr_scheduler = CosineAnnealingLR(
+            optimizer,
+            T_max=lr_scheduler.T_max * 2)
+    return lr_scheduler
+
+
 def train(model, dset_loaders, optimizer, lr_scheduler,
-          criterion, epoch, cuda, clip, writer):
+          criterion, epoch, cuda, clip, writer, timer=None,
+          image_logger=None, progress=None, amp=None, accumulate_steps=1):
     """
     Trains model using data_loader with the given
     optimizer, lr_scheduler, criterion and epoch
+    timer is an optional step_timer.StepTimer to record step timings
+    image_logger is an optional image_logger.ImageGridLogger for writer
+    progress is an optional train_state.TrainProgress to resume from
+    amp is an optional mixed precision mode, see cnn_utils.amp_context
+    accumulate_steps is the number of batches to sum gradients over
     """
-    lr_scheduler.step()
+    if timer is None:
+        timer = StepTimer(enabled=False)
+    if progress is None:
+        progress = TrainProgress()
+    close_logger = image_logger is None
+    if close_logger:
+        image_logger = ImageGridLogger(writer)
+    # A resumed epoch has already stepped the restored lr_scheduler
+    if progress.start_epoch(epoch) == 0:
+        lr_scheduler.step()
+    set_sampler_epoch(dset_loaders['train'], epoch)
     # Each epoch has a training and validation phase
     all_keys = list(dset_loaders.keys())
     all_keys.remove("train")
     all_keys = ["train"] + all_keys
     epoch_loss_all = []
     for phase in all_keys:
+        if phase != 'train' and not distributed.is_main_process():
+            continue
         since = time.time()
         if phase == 'train':
-            model.train()  # Set model to training mode
+            epoch_loss = train_phase(
+                model, dset_loaders[phase], optimizer, criterion,
+                epoch, cuda, clip, image_logger, timer, progress, amp,
+                accumulate_steps)
+            epoch_loss = distributed.average(epoch_loss)
         else:
-            model.eval()  # Set model to evaluate mode
-
-        running_loss = 0.0
-        for iteration, batch in enumerate(dset_loaders[phase]):
-            # Use this if doing cyclic learning
-            # lr_scheduler.batch_step()
-            targets = batch['targets']
-            inputs = batch['inputs']
-            inputs.requires_grad_()
-            targets.requires_grad_(False)
-
-            if cuda:
-                inputs = inputs.cuda()
-                targets = targets.cuda()
-
-            # forward
-            if iteration == 0:
-                print("Loaded " + phase + " batch in {:.0f}s".format(
-                    time.time() - since))
-            residuals = model(inputs)
-            outputs = inputs + residuals
-            outputs = torch.clamp(outputs, 0.0, 1.0)
-
-            loss = criterion(outputs, targets)
-            optimizer.zero_grad()
+            # Validation needs no autograd graph, see cnn_utils.validate
+            # and runs on one rank so no gradient all-reduce is involved
+            epoch_loss, last_batch = cnn_utils.validate(
+                getattr(model, 'module', model), dset_loaders[phase],
+                criterion, cuda, epoch=epoch, timer=timer, amp=amp)
+            image_logger.log(phase, epoch, last_batch)
+            timer.mark('image_logging')
+        timer.end_phase(writer, phase, epoch)
 
-            # backward + optimize only if in training phase
-            if phase == 'train':
-                loss.backward()
-                nn.utils.clip_grad_norm_(
-                    model.parameters(), clip)
-                optimizer.step()
-
-            # statistics
-            running_loss += loss.item()
-
-            if iteration == 0 and cuda:
-                cnn_utils.print_mem_usage()
-
-            if iteration % 100 == 0:
-                print("===> Epoch[{}]({}/{}): Loss: {:.5f}".format(
-                    epoch, iteration, len(dset_loaders[phase]),
-                    loss.item()))
-
-                if phase == 'train':
-                    if not cnn_utils.check_gradients(model):
-                        print("No gradients are being computed during training")
-                        exit(-1)
-
-            if iteration == len(dset_loaders[phase]) - 1:
-                desired_shape = [int(shape[0]) for shape in batch['shape']]
-                inputs_s = undo_remap(
-                    inputs[0], desired_shape, dtype=torch.float32)
-                residuals_s = undo_remap(
-                    residuals[0], desired_shape, dtype=torch.float32)
-                outputs_s = undo_remap(
-                    outputs[0], desired_shape, dtype=torch.float32)
-                targets_s = undo_remap(
-                    targets[0], desired_shape, dtype=torch.float32)
-                input_grid = vutils.make_grid(
-                    inputs_s, nrow=8, range=(0, 1), normalize=True,
-                    pad_value=1.0)
-                residual_grid = vutils.make_grid(
-                    residuals_s, nrow=8, range=(-1, 1), normalize=True,
-                    pad_value=1.0)
-                output_grid = vutils.make_grid(
-                    outputs_s, nrow=8, range=(0, 1), normalize=True,
-                    pad_value=1.0)
-                target_grid = vutils.make_grid(
-                    targets_s, nrow=8, range=(0, 1), normalize=True,
-                    pad_value=1.0)
-                diff_grid = vutils.make_grid(
-                    torch.abs(targets_s - outputs_s),
-                    nrow=8, range=(0, 1), normalize=True,
-                    pad_value=1.0)
-                writer.add_image(phase + '/input', input_grid, epoch)
-                writer.add_image(phase + '/residual', residual_grid, epoch)
-                writer.add_image(phase + '/output', output_grid, epoch)
-                writer.add_image(phase + '/target', target_grid, epoch)
-                writer.add_image(phase + '/difference', diff_grid, epoch)
-
-        epoch_loss = running_loss / len(dset_loaders[phase])
         writer.add_scalar(phase + '/loss', epoch_loss, epoch)
         print("Phase {} average overall loss {:.5f}".format(phase, epoch_loss))
         time_elapsed = time.time() - since
@@ -227,8 +251,110 @@ def train(model, dset_loaders, optimizer, lr_scheduler,
                     'learning_rate', param_group['lr'], epoch)
             epoch_loss_all.append(epoch_loss)
 
+    if close_logger:
+        image_logger.close()
     return epoch_loss_all
 
+
+def train_phase(model, data_loader, optimizer, criterion,
+                epoch, cuda, clip, image_logger, timer, progress, amp=None,
+                accumulate_steps=1):
+    """
+    Runs one epoch of training, returning the average batch loss
+    The optimizer steps on the gradient summed over accumulate_steps batches
+    """
+    since = time.time()
+    model.train()  # Set model to training mode
+    running_loss = progress.running_loss
+    start_step = progress.step
+    num_batches = len(data_loader)
+    timer.start()
+    for iteration, batch in enumerate(data_loader):
+        if iteration < start_step:
+            # Draw the batches trained before the resume checkpoint
+            # so the random state matches an uninterrupted run
+            timer.start()
+            continue
+        timer.mark('data_wait')
+        # Use this if doing cyclic learning
+        # lr_scheduler.batch_step()
+        targets = batch['targets']
+        inputs = batch['inputs']
+        inputs.requires_grad_()
+        targets.requires_grad_(False)
+
+        if cuda:
+            inputs = inputs.cuda()
+            targets = targets.cuda()
+        timer.mark('transfer')
+
+        # forward
+        if iteration == 0:
+            print("Loaded train batch in {:.0f}s".format(
+                time.time() - since))
+        # The last window of the epoch may have fewer batches
+        window_start = iteration - iteration % accumulate_steps
+        window = min(accumulate_steps, num_batches - window_start)
+        update = iteration == window_start + window - 1
+        if iteration == window_start:
+            optimizer.zero_grad()
+        # Only all-reduce the gradients of the last batch of a window
+        if update or not hasattr(model, 'no_sync'):
+            sync_context = contextlib.nullcontext()
+        else:
+            sync_context = model.no_sync()
+
+        with sync_context:
+            # Weights and gradients stay float32 under amp
+            with cnn_utils.amp_context(amp, cuda):
+                residuals, outputs = cnn_utils.forward_residual(
+                    model, inputs)
+                timer.mark('forward')
+
+                loss = criterion(outputs, targets)
+                timer.mark('loss')
+
+            # backward, averaging the gradient over the window
+            (loss / window).backward()
+            timer.mark('backward')
+
+        # statistics
+        running_loss += loss.item()
+
+        # optimize
+        if update:
+            nn.utils.clip_grad_norm_(
+                model.parameters(), clip)
+            timer.mark('clip_grad_norm')
+            optimizer.step()
+            timer.mark('optimizer_step')
+            # Resume checkpoints are only written between updates
+            progress.end_step(iteration + 1, running_loss)
+
+        if iteration == 0 and cuda:
+            cnn_utils.print_mem_usage()
+
+        if iteration % 100 == 0:
+            print("===> Epoch[{}]({}/{}): Loss: {:.5f}".format(
+                epoch, iteration, len(data_loader),
+                loss.item()))
+
+            if not cnn_utils.check_gradients(model):
+                print("No gradients are being computed during training")
+                exit(-1)
+
+        if iteration == len(data_loader) - 1:
+            image_logger.log('train', epoch, {
+                'inputs': inputs, 'residuals': residuals,
+                'outputs': outputs, 'targets': targets,
+                'shape': batch['shape']})
+            timer.mark('image_logging')
+        else:
+            timer.mark('logging')
+
+    return running_loss / len(data_loader)
+
+
 if __name__ == '__main__':
     # Command line modifiable parameters
     # See https://github.com/twtygqyy/pytorch-vdsr/blob/master/main_vdsr.py
@@ -269,6 +395,34 @@ if __name__ == '__main__':
     PARSER.add_argument('--frozen', '--f', default=True, type=bool,
                         help="Should the loaded weights be frozen?, default=True")
     PARSER.add_argument("--absolute_cfg", "-ac", action="store_true")
+    PARSER.add_argument("--profile_steps", action="store_true",
+                        help="Record per step timings of each training part")
+    PARSER.add_argument("--keep_last", default=0, type=int,
+                        help="Epoch checkpoints to keep, default 0 keeps all")
+    PARSER.add_argument("--save_every", default=0, type=int,
+                        help="Write tag_resume.pth every n training " +
+                        "batches and epoch, default 0 never does")
+    PARSER.add_argument("--resume", default="", type=str,
+                        help="resume checkpoint name to continue from")
+    PARSER.add_argument("--accumulate_steps", "--accumulate-steps",
+                        default=1, type=int,
+                        help="Batches to sum gradients over per optimizer " +
+                        "step, default 1")
+    PARSER.add_argument("--find_batch_size", "--find-batch-size",
+                        action="store_true",
+                        help="Only find and record the largest batch size " +
+                        "within --memory_budget, then exit")
+    PARSER.add_argument("--memory_budget", default=0, type=int,
+                        help="Bytes for --find_batch_size, default 0 " +
+                        "uses 90% of the GPU or half the free memory")
+    PARSER.add_argument("--amp", default=None, choices=["bf16"],
+                        help="Run forward and loss in mixed precision")
+    PARSER.add_argument("--compile", default=None, choices=COMPILE_MODES,
+                        help="Train and validate through a compiled model")
+    PARSER.add_argument("--distributed", action="store_true",
+                        help="Train data parallel over local CPU processes")
+    PARSER.add_argument("--world_size", default=2, type=int,
+                        help="Number of processes for --distributed")
     # Any unknown argument will go to unparsed
     ARGS, UNPARSED = PARSER.parse_known_args()
     if ARGS.tag is None:
@@ -289,11 +443,24 @@ if __name__ == '__main__':
     TBOARD_LOC = os.path.join(
         CONFIG['PATH']['tboard'],
         ARGS.tag + "_" + datetime.now().strftime('%b%d_%H-%M-%S'))
-    WRITER = SummaryWriter(log_dir=TBOARD_LOC)
 
     print('Program started with the following options')
     helpers.print_config(CONFIG)
     print('Command Line arguments')
     print(ARGS)
     print()
-    main(ARGS, CONFIG, WRITER)
+    if ARGS.find_batch_size:
+        batch_finder.main(ARGS, CONFIG)
+        exit(0)
+    if ARGS.distributed:
+        if ARGS.prompt or ARGS.compile:
+            print("--prompt and --compile can not be used with --distributed")
+            exit(-1)
+        if cnn_utils.check_cuda(CONFIG):
+            print("--distributed is for CPU training, set cuda to False")
+            exit(-1)
+        distributed.launch(
+            distributed_main, ARGS.world_size, ARGS, CONFIG, TBOARD_LOC)
+    else:
+        WRITER = SummaryWriter(log_dir=TBOARD_LOC)
+        main(ARGS, CONFIG, WRITER)
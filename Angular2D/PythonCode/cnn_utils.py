@@ -1,10 +1,18 @@
 """Handles functions such as loading from checkpoints"""
+import contextlib
 import os
 import math
+import time
 
 import torch
 import torch.nn as nn
 
+from step_timer import StepTimer
+from checkpoint_writer import atomic_save
+
+# The autocast data type of each --amp mode
+AMP_DTYPES = {'bf16': torch.bfloat16}
+
 def check_cuda(config):
     """Checks cuda settings from config - Returns true if cuda available"""
     cuda = config['NETWORK']['cuda'] == 'True'
@@ -30,13 +38,97 @@ def save_checkpoint(model, epoch, optimizer, best_loss, save_dir, name):
              "best_loss": best_loss,
              "optimizer": optimizer.state_dict()}
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
-    torch.save(state, model_out_path)
+    atomic_save(state, model_out_path)
 
     print("Checkpoint saved to {}".format(model_out_path))
 
+def inference_context():
+    """
+    Returns a context in which no autograd graph is recorded
+    torch.inference_mode where available, otherwise torch.no_grad
+    """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+def amp_context(amp, cuda=False):
+    """
+    Returns an autocast context for the mixed precision mode amp,
+    such as 'bf16', or a context which does nothing if amp is None
+    The weights stay float32, only the operations run in lower precision
+    """
+    if amp is None:
+        return contextlib.nullcontext()
+    return torch.autocast(
+        'cuda' if cuda else 'cpu', dtype=AMP_DTYPES[amp])
+
+def forward_residual(model, inputs):
+    """Returns the model residuals and the clamped outputs for inputs"""
+    # Add and clamp in float32 whatever the model ran in,
+    # so the 8 bit input levels and the 0 to 1 bounds stay exact
+    residuals = model(inputs).float()
+    outputs = inputs + residuals
+    outputs = torch.clamp(outputs, 0.0, 1.0)
+    return residuals, outputs
+
+def infer_batch(model, inputs, amp=None, cuda=False):
+    """
+    Returns the residuals and clamped outputs of model for a batch of
+    inputs run in the mixed precision mode amp, see amp_context
+    The inference step of validate and final_cnn_demo
+    """
+    with amp_context(amp, cuda):
+        return forward_residual(model, inputs)
+
+def validate(model, data_loader, criterion, cuda, epoch=None, timer=None,
+             amp=None):
+    """
+    Evaluates model over data_loader in inference mode
+    Returns the average batch loss and the last batch as a dictionary
+    of inputs, residuals, outputs, targets and shape
+    If epoch is given, progress is printed every 100 batches
+    timer is an optional step_timer.StepTimer to record step timings
+    amp is an optional mixed precision mode, see amp_context
+    """
+    if timer is None:
+        timer = StepTimer(enabled=False)
+    model.eval()
+    since = time.time()
+    # Summed on the device so there is no sync each iteration
+    total_loss = 0.0
+    last_batch = {}
+    timer.start()
+    with inference_context():
+        for iteration, batch in enumerate(data_loader):
+            timer.mark('data_wait')
+            targets = batch['targets']
+            inputs = batch['inputs']
+            if cuda:
+                inputs = inputs.cuda(non_blocking=True)
+                targets = targets.cuda(non_blocking=True)
+            timer.mark('transfer')
+
+            if iteration == 0 and epoch is not None:
+                print("Loaded validation batch in {:.0f}s".format(
+                    time.time() - since))
+            residuals, outputs = infer_batch(model, inputs, amp, cuda)
+            timer.mark('forward')
+            loss = criterion(outputs, targets)
+            total_loss = total_loss + loss
+            timer.mark('loss')
+
+            if iteration % 100 == 0 and epoch is not None:
+                print("===> Epoch[{}]({}/{}): Loss: {:.5f}".format(
+                    epoch, iteration, len(data_loader),
+                    loss.item()))
+
+            last_batch = {
+                'inputs': inputs, 'residuals': residuals,
+                'outputs': outputs, 'targets': targets,
+                'shape': batch['shape']}
+
+    return float(total_loss) / len(data_loader), last_batch
+
 def load_from_checkpoint(model, optimizer, args, config):
     resume_location = os.path.join(
         config['PATH']['checkpoint_dir'],
@@ -1,3 +1,4 @@
+import contextlib
 import math
 
 import torch
@@ -6,6 +7,12 @@ import torch.nn.functional as F
 
 from torch.autograd import Variable
 
+def autocast_disabled(device_type):
+    """Returns a context which turns off any autocast on device_type"""
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, enabled=False)
+    return contextlib.nullcontext()
+
 def default_conv(in_channels, out_channels, kernel_size, bias=True):
     return nn.Conv2d(
         in_channels, out_channels, kernel_size,
@@ -25,6 +32,12 @@ class MeanShift(nn.Conv2d):
         for param in self.parameters():
             param.requires_grad = False
 
+    def forward(self, x):
+        # Shifting 8 bit levels by the mean is only exact in float32,
+        # so this stays float32 under mixed precision autocast
+        with autocast_disabled(x.device.type):
+            return super(MeanShift, self).forward(x.float())
+
 class BasicBlock(nn.Sequential):
     def __init__(
         self, in_channels, out_channels, kernel_size, stride=1, bias=False,
@@ -59,6 +72,50 @@ class ResBlock(nn.Module):
 
         return res
 
+class MeanPad(nn.Module):
+    """
+    Pads each channel by a constant of its own, so a folded MeanShift
+    followed by a zero padded conv sees the same borders
+    """
+    def __init__(self, value, padding):
+        super(MeanPad, self).__init__()
+        self.register_buffer('value', value.view(1, -1, 1, 1).clone())
+        self.padding = padding
+
+    def forward(self, x):
+        p = self.padding
+        out = F.pad(x, (p, p, p, p))
+        value = self.value.to(out.dtype)
+        out[:, :, :p, :] = value
+        out[:, :, -p:, :] = value
+        out[:, :, :, :p] = value
+        out[:, :, :, -p:] = value
+        return out
+
+class ChannelAffine(nn.Module):
+    """A per channel scale and shift, a diagonal MeanShift without the conv"""
+    def __init__(self, scale, shift):
+        super(ChannelAffine, self).__init__()
+        self.register_buffer('scale', scale.view(1, -1, 1, 1).clone())
+        self.register_buffer('shift', shift.view(1, -1, 1, 1).clone())
+
+    def forward(self, x):
+        # float32 under mixed precision autocast, as in MeanShift
+        with autocast_disabled(x.device.type):
+            return torch.addcmul(self.shift, x.float(), self.scale)
+
+class PlainResBlock(nn.Module):
+    """A ResBlock with res_scale folded into its last conv"""
+    def __init__(self, body):
+        super(PlainResBlock, self).__init__()
+        self.body = body
+
+    def forward(self, x):
+        res = self.body(x)
+        res += x
+
+        return res
+
 class Upsampler(nn.Sequential):
     def __init__(self, conv, scale, n_feats, bn=False, act=False, bias=True):
 
@@ -0,0 +1,191 @@
+"""
+Compiled execution of the C2D model for training and inference
+
+C2D runs a short chain of convolutions over a very large remapped image,
+so the python overhead of eager mode is small but every fused or
+reordered operation counts. Two compile modes are available:
+
+trace -- torch.jit.trace, which is shape generic as C2D has no shape
+         dependent python. For inference only models the weights are
+         frozen into the graph and it is fused with optimize_for_inference.
+         Frozen graphs are saved to the cache directory, keyed by the
+         architecture, input shape, autocast mode, weights and torch version,
+         so later runs load them instead of tracing.
+inductor -- torch.compile, with the inductor code cache kept in the
+            cache directory so later runs skip code generation.
+
+The first call for each input shape checks the compiled model against
+the eager one; if compiling fails or the outputs differ a warning is
+printed and the eager model is used for that shape.
+"""
+import hashlib
+import json
+import os
+import warnings
+
+import torch
+import torch.nn as nn
+
+from checkpoint_writer import atomic_save
+
+COMPILE_MODES = ('trace', 'inductor')
+
+
+def default_cache_dir(config):
+    """Returns the compile cache directory of config, under model_dir"""
+    return config['PATH'].get(
+        'compile_cache',
+        os.path.join(config['PATH']['model_dir'], 'compile_cache'))
+
+
+def architecture(model):
+    """Returns the C2D arguments which a compiled graph of model depends on"""
+    resblocks = list(model.body)[:-1]
+    return {
+        'model': type(model).__name__,
+        'in_channels': model.head[0].in_channels,
+        'n_feats': model.head[0].out_channels,
+        'n_resblocks': len(resblocks),
+        # Folded into the weights of a model_2d.FoldedC2D
+        'res_scale': getattr(resblocks[0], 'res_scale', 1.0)
+                     if resblocks else 1.0}
+
+
+def weights_hash(model):
+    """Returns a hash of the parameters and buffers of model"""
+    sha = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def autocast_mode(device_type):
+    """Returns the autocast dtype active on device_type as a str, or None"""
+    try:
+        if torch.is_autocast_enabled(device_type):
+            return str(torch.get_autocast_dtype(device_type))
+    except TypeError:
+        # torch before 2.4 only has the device specific functions
+        enabled = (torch.is_autocast_enabled() if device_type == 'cuda'
+                   else torch.is_autocast_cpu_enabled())
+        if enabled:
+            return 'autocast'
+    return None
+
+
+class CompiledModel(nn.Module):
+    """
+    Runs an eager C2D model through a compiled graph per input shape,
+    while the eager model keeps, trains and saves the weights
+    """
+
+    def __init__(self, model, mode='trace', cache_dir=None, freeze=False,
+                 tolerance=1e-4):
+        """
+        Keyword arguments:
+        model -- the eager C2D model
+        mode -- one of COMPILE_MODES
+        cache_dir -- directory keeping compiled code across runs,
+                     None keeps traces in memory only
+        freeze -- bake the current weights into traced inference graphs,
+                  only for models which will not be trained further
+        tolerance -- largest output difference from eager mode accepted,
+                     ten times larger under autocast
+        """
+        super(CompiledModel, self).__init__()
+        if mode not in COMPILE_MODES:
+            raise ValueError("Unknown compile mode {}".format(mode))
+        self.model = model
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.freeze = freeze
+        self.tolerance = tolerance
+        self.compiled = {}
+        self.inductor = []
+        if mode == 'inductor' and cache_dir is not None:
+            # Read by inductor when it first generates code
+            os.environ.setdefault(
+                'TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+
+    def forward(self, inputs):
+        amp = autocast_mode(inputs.device.type)
+        frozen = self.freeze and not torch.is_grad_enabled()
+        key = (tuple(inputs.shape), str(inputs.dtype),
+               inputs.device.type, amp, frozen)
+        if key not in self.compiled:
+            self.compiled[key] = self.compile_for(inputs, amp, frozen)
+        return self.compiled[key](inputs)
+
+    def compile_for(self, inputs, amp, frozen):
+        """
+        Returns a compiled function of the model checked on inputs,
+        or the eager model if compiling fails or the outputs differ
+        """
+        try:
+            if self.mode == 'inductor':
+                compiled = self.compile_inductor()
+            elif frozen:
+                compiled = self.load_or_freeze(inputs, amp)
+            else:
+                compiled = self.trace(inputs)
+            with torch.no_grad():
+                expected = self.model(inputs).float()
+                difference = torch.max(torch.abs(
+                    compiled(inputs).float() - expected)).item()
+        except Exception as err:
+            warnings.warn("Compiling the model failed, running eagerly: "
+                          "{}".format(err))
+            return self.model
+        tolerance = self.tolerance * (10 if amp is not None else 1)
+        if not difference <= tolerance:
+            warnings.warn(
+                "Compiled model differs from eager by {}, running "
+                "eagerly".format(difference))
+            return self.model
+        return compiled
+
+    def trace(self, inputs):
+        """Returns a trace of the model sharing its parameters"""
+        with torch.no_grad():
+            return torch.jit.trace(self.model, inputs, check_trace=False)
+
+    def compile_inductor(self):
+        """Returns the model under torch.compile, compiled on first call"""
+        if not self.inductor:
+            self.inductor.append(torch.compile(self.model))
+        return self.inductor[0]
+
+    def cache_location(self, inputs, amp):
+        """Returns where the frozen graph for inputs is cached"""
+        key = json.dumps({
+            'architecture': architecture(self.model),
+            'shape': list(inputs.shape),
+            'dtype': str(inputs.dtype),
+            'device': inputs.device.type,
+            'amp': amp,
+            'weights': weights_hash(self.model),
+            'torch': torch.__version__}, sort_keys=True)
+        name = 'c2d_{}.pt'.format(
+            hashlib.sha1(key.encode()).hexdigest()[:16])
+        return os.path.join(self.cache_dir, name)
+
+    def load_or_freeze(self, inputs, amp):
+        """
+        Returns the frozen traced graph for inputs, from the cache
+        directory if it was saved there before
+        """
+        location = None
+        if self.cache_dir is not None:
+            location = self.cache_location(inputs, amp)
+            if os.path.isfile(location):
+                print("=> loading compiled model '{}'".format(location))
+                frozen = torch.jit.load(location, map_location=inputs.device)
+                return torch.jit.optimize_for_inference(frozen)
+        self.model.eval()
+        frozen = torch.jit.freeze(self.trace(inputs))
+        if location is not None:
+            # The fused graph does not reload, so save before fusing
+            atomic_save(frozen, location, save_fn=torch.jit.save)
+            print("=> saved compiled model to '{}'".format(location))
+        return torch.jit.optimize_for_inference(frozen)
@@ -1,5 +1,9 @@
+import atexit
+import math
+import multiprocessing.util
 import random
 import os
+import time
 from pathlib import Path
 
 import h5py
@@ -7,7 +11,101 @@ import torch
 import torch.utils.data as data
 
 import data_transform
+import lf_cache
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+# Open hdf5 handles for this process, keyed on file path and chunk cache
+_H5_HANDLES = {}
+# The pid which owns _H5_HANDLES, handles inherited over fork are not reused
+_H5_PID = None
+
+
+def get_h5_file(file_path, rdcc_nbytes=None, rdcc_nslots=None):
+    """
+    Returns a read only hdf5 handle to file_path which stays open
+    for the lifetime of the calling process (a DataLoader worker)
+
+    The file is opened lazily on first use in each process, so handles
+    are never shared across a fork. They are closed on process exit.
+
+    Keyword arguments:
+    file_path -- the location of the hdf5 file
+    rdcc_nbytes -- the raw data chunk cache size in bytes, h5py default if None
+    rdcc_nslots -- the number of chunk slots in the cache, h5py default if None
+    """
+    global _H5_PID
+    pid = os.getpid()
+    if _H5_PID != pid:
+        # Forked from a process that had open handles, do not touch them
+        _H5_HANDLES.clear()
+        _H5_PID = pid
+        atexit.register(close_h5_files)
+        # Worker processes exit through os._exit, so atexit does not run
+        multiprocessing.util.Finalize(None, close_h5_files, exitpriority=10)
+    key = (file_path, rdcc_nbytes, rdcc_nslots)
+    h5_file = _H5_HANDLES.get(key, None)
+    if h5_file is None or not h5_file.id.valid:
+        cache_kwargs = {}
+        if rdcc_nbytes is not None:
+            cache_kwargs['rdcc_nbytes'] = rdcc_nbytes
+        if rdcc_nslots is not None:
+            cache_kwargs['rdcc_nslots'] = rdcc_nslots
+        h5_file = h5py.File(
+            file_path, mode='r', libver='latest', swmr=True, **cache_kwargs)
+        _H5_HANDLES[key] = h5_file
+    return h5_file
+
+
+def close_h5_files():
+    """Closes all hdf5 handles opened by get_h5_file in this process"""
+    if _H5_PID != os.getpid():
+        return
+    for h5_file in _H5_HANDLES.values():
+        if h5_file.id.valid:
+            h5_file.close()
+    _H5_HANDLES.clear()
+
+
+def lf_index(dataset, idx, crop_cords=None, num_channels=None):
+    """
+    Returns the hdf5 index of sample idx in the V1, H1, V2, H2 window
+    given by crop_cords with the first num_channels channels
+    dataset may be N, C, H, W light fields or remapped C, H, W images
+    """
+    if crop_cords is None:
+        v_slice = h_slice = slice(None)
+    else:
+        v_slice = slice(int(crop_cords[0]), int(crop_cords[2]))
+        h_slice = slice(int(crop_cords[1]), int(crop_cords[3]))
+    if dataset.ndim == 4:
+        return (idx, slice(None, num_channels), v_slice, h_slice)
+    return (idx, slice(None), slice(None, num_channels), v_slice, h_slice)
+
+
+def read_lf_slab(dataset, idx, crop_cords=None, num_channels=None):
+    """
+    Reads sample idx of a light field dataset as a uint8 tensor,
+    only decoding the V1, H1, V2, H2 window given by crop_cords
+    and the first num_channels channels, or all of them if None
+    """
+    lf = dataset[lf_index(dataset, idx, crop_cords, num_channels)]
+    return torch.from_numpy(lf)
+
+
+def crop_lf(lf, crop_cords=None):
+    """Crops a decoded uint8 numpy light field to V1, H1, V2, H2"""
+    if crop_cords is not None:
+        lf = lf[..., crop_cords[0]:crop_cords[2], crop_cords[1]:crop_cords[3]]
+    return torch.from_numpy(lf)
+
+
+def remapped_shape(grid_size, remapped):
+    """Returns the N, C, H, W light field shape of a remapped C, H, W image"""
+    one_way = data_transform.grid_width(grid_size)
+    channels, height, width = remapped.shape
+    return torch.Size(
+        (grid_size, channels, height // one_way, width // one_way))
 
 
 class TrainFromHdf5(data.Dataset):
@@ -17,13 +115,24 @@ class TrainFromHdf5(data.Dataset):
 
     def __init__(
             self, file_path, patch_size,
-            num_crops, transform=None, fixed_seed=False, sub_chan=False, crop_train=True):
+            num_crops, transform=None, fixed_seed=False, sub_chan=False,
+            crop_train=True, rdcc_nbytes=None, rdcc_nslots=None,
+            group_crops=False, cache=None, uint8_out=False):
         """
         Keyword arguments:
         hdf_file -- the location containing the hdf5 file
         patch_size -- the size of the patches to extract for training
         num_crops -- the number of patches to extract for training
         transform -- an optional transform to apply to the data
+        rdcc_nbytes -- hdf5 chunk cache size in bytes per worker
+        rdcc_nslots -- hdf5 chunk cache hash table slots per worker
+        group_crops -- return all num_crops crops of a light field as one item
+        cache -- an optional lf_cache.SharedLFCache of decoded light fields
+        uint8_out -- only crop, leaving normalise, gamma and transform
+                     to be applied to the batch by data_transform.batch_remap
+
+        If the file has remapped_images and remapped_warped datasets
+        crops are taken from them directly and transform is not applied
         """
         super()
         self.file_path = file_path
@@ -31,13 +140,26 @@ class TrainFromHdf5(data.Dataset):
                 file_path, mode='r', libver='latest', swmr=True) as h5_file:
             self.num_samples = h5_file['train'].attrs['lf_shape'][0]
             self.grid_size = h5_file['train'].attrs['lf_shape'][1]
-        self.colour = '/train/images'
-        self.warped = '/train/warped'
+            self.im_size = h5_file['train'].attrs['lf_shape'][-1]
+            self.remapped = 'remapped_images' in h5_file['train']
+        if self.remapped:
+            self.colour = '/train/remapped_images'
+            self.warped = '/train/remapped_warped'
+            self.remap_scale = data_transform.grid_width(self.grid_size)
+        else:
+            self.colour = '/train/images'
+            self.warped = '/train/warped'
+            self.remap_scale = 1
         self.transform = transform
         self.patch_size = patch_size
         self.num_crops = num_crops
         self.sub_chan = sub_chan
         self.crop_train = crop_train
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.group_crops = group_crops
+        self.cache = cache
+        self.uint8_out = uint8_out
         if fixed_seed:
             random.seed(100)
         else:
@@ -48,40 +170,258 @@ class TrainFromHdf5(data.Dataset):
         Return item at index in 0 to len(self)
         In this case a set of crops from an lf sample
         Return type is a dictionary of depth and colour arrays
+        If group_crops is set, a list of num_crops such dictionaries
         """
-        with h5py.File(
-                self.file_path, mode='r',
-                libver='latest', swmr=True) as h5_file:
-            idx = index // self.num_crops
-            colour = torch.tensor(
-                h5_file[self.colour][idx], dtype=torch.float32)
-            warped = torch.tensor(
-                h5_file[self.warped][idx], dtype=torch.float32)
-            grid_size = self.grid_size
-            sample = {
-                'colour': colour,
-                'warped': warped,
-                'grid_size': grid_size}
-
-            if self.crop_train:
-                sample = data_transform.get_random_crop(sample, self.patch_size)
-            sample = data_transform.normalise_sample(sample)
-            sample = data_transform.random_gamma(sample)
-
-            if self.sub_chan:
-                sample = data_transform.subsample_channels(
-                    sample, 3
-                )
-            if self.transform:
-                sample = self.transform(sample)
-
-            return sample
+        h5_file = get_h5_file(
+            self.file_path, self.rdcc_nbytes, self.rdcc_nslots)
+        if self.group_crops:
+            return self.get_crop_group(h5_file, index)
+        idx = index // self.num_crops
+        # Pick the crop first so only that slab is read and converted
+        crop_cords = None
+        if self.crop_train:
+            crop_cords = self.random_crop_coords()
+        num_channels = 3 if self.sub_chan else None
+        if self.cache is not None:
+            colour_lf, warped_lf = self.read_full_lf(
+                h5_file, idx, num_channels)
+            colour = crop_lf(colour_lf, crop_cords)
+            warped = crop_lf(warped_lf, crop_cords)
+        else:
+            colour = read_lf_slab(
+                h5_file[self.colour], idx, crop_cords, num_channels)
+            warped = read_lf_slab(
+                h5_file[self.warped], idx, crop_cords, num_channels)
+        return self.finish_sample(colour, warped)
+
+    def random_crop_coords(self):
+        """Returns random V1, H1, V2, H2 crop co-ords in the stored layout"""
+        crop_cords = data_transform.random_crop_coords(
+            self.im_size, self.patch_size)
+        # In the interleaved layout offsets are multiples of the grid width
+        return [cord * self.remap_scale for cord in crop_cords]
+
+    def read_full_lf(self, h5_file, idx, num_channels):
+        """
+        Returns the decoded uint8 colour and warped light fields of idx,
+        from the shared cache if present, otherwise from h5_file
+        """
+        lfs = []
+        for name in self.colour, self.warped:
+            dataset = h5_file[name]
+            index = lf_index(dataset, idx, num_channels=num_channels)
+            if self.cache is None:
+                lfs.append(dataset[index])
+                continue
+            key = '{}_{}_{}'.format(
+                name.strip('/').replace('/', '_'), idx, num_channels)
+            lf = self.cache.get(key)
+            if lf is None:
+                lf = dataset[index]
+                self.cache.put(key, lf)
+            lfs.append(lf)
+        return lfs
+
+    def get_crop_group(self, h5_file, idx):
+        """
+        Decodes light field idx once and returns a list
+        of num_crops random crops taken from it
+        """
+        num_channels = 3 if self.sub_chan else None
+        colour_lf, warped_lf = self.read_full_lf(h5_file, idx, num_channels)
+        samples = []
+        for _ in range(self.num_crops):
+            crop_cords = self.random_crop_coords()
+            colour = crop_lf(colour_lf, crop_cords)
+            warped = crop_lf(warped_lf, crop_cords)
+            samples.append(self.finish_sample(colour, warped))
+        return samples
+
+    def finish_sample(self, colour, warped):
+        """Normalises, augments and transforms a uint8 colour/warped pair"""
+        if self.remapped:
+            return self.finish_remapped_sample(colour, warped)
+        if self.uint8_out:
+            # Copy out views of a larger light field before sending over IPC
+            return {
+                'colour': colour.contiguous(),
+                'warped': warped.contiguous(),
+                'grid_size': self.grid_size}
+
+        sample = {
+            'colour': colour.to(torch.float32),
+            'warped': warped.to(torch.float32),
+            'grid_size': self.grid_size}
+
+        sample = data_transform.normalise_sample(sample)
+        sample = data_transform.random_gamma(sample)
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def finish_remapped_sample(self, colour, warped):
+        """As finish_sample for crops stored in the angular remapped layout"""
+        shape = remapped_shape(self.grid_size, colour)
+        if self.uint8_out:
+            return {
+                'inputs': warped.contiguous(),
+                'targets': colour.contiguous(),
+                'shape': shape}
+
+        sample = {
+            'colour': colour.to(torch.float32),
+            'warped': warped.to(torch.float32),
+            'grid_size': self.grid_size}
+
+        sample = data_transform.normalise_sample(sample)
+        sample = data_transform.random_gamma(sample)
+
+        return {
+            'inputs': sample['warped'],
+            'targets': sample['colour'],
+            'shape': shape}
 
     def __len__(self):
         """Return the number of samples in the dataset"""
+        if self.group_crops:
+            return self.num_samples
         return self.num_samples * self.num_crops
 
 
+def collate_crop_groups(batch):
+    """Flattens a batch of crop groups into a list of samples, not collated"""
+    return [sample for group in batch for sample in group]
+
+
+class ShuffleBufferLoader(object):
+    """
+    Turns a DataLoader over crop groups into batches of single crops
+
+    Crops are pushed into a buffer of buffer_size samples and drawn at
+    random, so the crops of one light field are spread over batches
+    """
+
+    def __init__(self, group_loader, batch_size, buffer_size, num_items):
+        """
+        Keyword arguments:
+        group_loader -- a DataLoader using collate_crop_groups
+        batch_size -- the number of crops in each output batch
+        buffer_size -- the number of crops to hold for shuffling
+        num_items -- the total number of crops in an epoch
+        """
+        self.group_loader = group_loader
+        self.batch_size = batch_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.num_items = num_items
+
+    def __iter__(self):
+        buffer = []
+        for samples in self.group_loader:
+            buffer.extend(samples)
+            while len(buffer) >= self.buffer_size:
+                yield default_collate(self.draw(buffer, self.batch_size))
+        random.shuffle(buffer)
+        while buffer:
+            yield default_collate(self.draw(buffer, self.batch_size))
+
+    @staticmethod
+    def draw(buffer, num):
+        """Removes and returns up to num random samples from buffer"""
+        out = []
+        for _ in range(min(num, len(buffer))):
+            pos = random.randrange(len(buffer))
+            buffer[pos], buffer[-1] = buffer[-1], buffer[pos]
+            out.append(buffer.pop())
+        return out
+
+    def __len__(self):
+        return (self.num_items + self.batch_size - 1) // self.batch_size
+
+
+class BatchTransformLoader(object):
+    """Applies a transform to every collated batch of a loader"""
+
+    def __init__(self, loader, transform):
+        """
+        Keyword arguments:
+        loader -- any iterable of batches with a length
+        transform -- a function from a batch to a batch
+        """
+        self.loader = loader
+        self.transform = transform
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.transform(batch)
+
+    def __len__(self):
+        return len(self.loader)
+
+
+class CropGroupSampler(data.Sampler):
+    """
+    Shards the items of a TrainFromHdf5 over distributed ranks
+    by light field, so all crops of a light field go to the same rank
+    and each light field is only read by one rank per epoch
+
+    Light fields are repeated so every rank gets the same number,
+    as each rank must run the same number of steps
+    """
+
+    def __init__(self, num_groups, group_size, num_replicas, rank, seed=0):
+        """
+        Keyword arguments:
+        num_groups -- the number of light fields
+        group_size -- the consecutive items of each light field,
+                      num_crops, or 1 when crops are grouped into one item
+        num_replicas -- the number of ranks
+        rank -- the rank to return items for
+        seed -- the shuffle is seeded with seed plus the epoch
+        """
+        self.num_groups = num_groups
+        self.group_size = group_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.groups_per_rank = math.ceil(num_groups / num_replicas)
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, so each epoch is shuffled differently"""
+        self.epoch = epoch
+
+    def __iter__(self):
+        # A separate generator leaves the global random state alone
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_groups, generator=generator).tolist()
+        total_groups = self.groups_per_rank * self.num_replicas
+        order = (order * math.ceil(total_groups / len(order)))[:total_groups]
+        indices = [
+            group * self.group_size + crop
+            for group in order[self.rank::self.num_replicas]
+            for crop in range(self.group_size)]
+        shuffle = torch.randperm(len(indices), generator=generator)
+        return iter([indices[pos] for pos in shuffle.tolist()])
+
+    def __len__(self):
+        return self.groups_per_rank * self.group_size
+
+
+def set_sampler_epoch(loader, epoch):
+    """Sets the epoch of a CropGroupSampler inside loader, if any"""
+    while loader is not None:
+        sampler = getattr(loader, 'sampler', None)
+        if isinstance(sampler, CropGroupSampler):
+            sampler.set_epoch(epoch)
+            return
+        # Unwrap a BatchTransformLoader or ShuffleBufferLoader
+        loader = getattr(
+            loader, 'loader', getattr(loader, 'group_loader', None))
+
+
 class ValFromHdf5(data.Dataset):
     """
     Creates a validation set from a hdf5 file
@@ -89,11 +429,17 @@ class ValFromHdf5(data.Dataset):
 
     def __init__(
             self, file_path, patch_size, name,
-            transform=None, sub_chan=False, val_transform=False):
+            transform=None, sub_chan=False, val_transform=False,
+            rdcc_nbytes=None, rdcc_nslots=None):
         """
         Keyword arguments:
         hdf_file -- the location containing the hdf5 file
         transform -- an optional transform to apply to the data
+        rdcc_nbytes -- hdf5 chunk cache size in bytes per worker
+        rdcc_nslots -- hdf5 chunk cache hash table slots per worker
+
+        If the group has remapped_images and remapped_warped datasets
+        crops are taken from them directly and transform is not applied
         """
         super()
         self.file_path = file_path
@@ -102,8 +448,15 @@ class ValFromHdf5(data.Dataset):
             self.num_samples = h5_file[name].attrs['lf_shape'][0]
             self.grid_size = h5_file[name].attrs['lf_shape'][1]
             self.im_size = h5_file[name].attrs['lf_shape'][-1]
-        self.colour = '/{}/images'.format(name)
-        self.warped = '/{}/warped'.format(name)
+            self.remapped = 'remapped_images' in h5_file[name]
+        if self.remapped:
+            self.colour = '/{}/remapped_images'.format(name)
+            self.warped = '/{}/remapped_warped'.format(name)
+            self.remap_scale = data_transform.grid_width(self.grid_size)
+        else:
+            self.colour = '/{}/images'.format(name)
+            self.warped = '/{}/warped'.format(name)
+            self.remap_scale = 1
         self.transform = transform
         self.patch_size = patch_size
         self.val_transform = val_transform
@@ -112,6 +465,8 @@ class ValFromHdf5(data.Dataset):
                 self.im_size, self.num_samples, self.patch_size
             )
         self.sub_chan = sub_chan
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
 
     def __getitem__(self, index):
         """
@@ -119,41 +474,150 @@ class ValFromHdf5(data.Dataset):
         In this case a set of crops from an lf sample
         Return type is a dictionary of depth and colour arrays
         """
-        with h5py.File(
-                self.file_path, mode='r',
-                libver='latest', swmr=True) as h5_file:
-            colour = torch.tensor(
-                h5_file[self.colour][index], dtype=torch.float32)
-            warped = torch.tensor(
-                h5_file[self.warped][index], dtype=torch.float32)
-            grid_size = self.grid_size
-            sample = {
-                'colour': colour,
-                'warped': warped,
-                'grid_size': grid_size}
-
-        # Running out of GPU memory on validation
-        if self.val_transform:
-            sample = data_transform.crop(sample, self.crop_cords[index])
+        colour, warped = self.read_uint8(index)
+        grid_size = self.grid_size
+        sample = {
+            'colour': colour.to(torch.float32),
+            'warped': warped.to(torch.float32),
+            'grid_size': grid_size}
 
-        if self.sub_chan:
-            sample = data_transform.subsample_channels(
-                sample, 3
-            )
-        
         sample = data_transform.normalise_sample(sample)
+        if self.remapped:
+            return {
+                'inputs': sample['warped'],
+                'targets': sample['colour'],
+                'shape': remapped_shape(self.grid_size, colour)}
         if self.transform:
             sample = self.transform(sample)
 
         return sample
 
+    def read_uint8(self, index):
+        """Returns the uint8 colour and warped crops of sample index"""
+        h5_file = get_h5_file(
+            self.file_path, self.rdcc_nbytes, self.rdcc_nslots)
+        # Running out of GPU memory on validation
+        crop_cords = None
+        if self.val_transform:
+            crop_cords = [
+                int(cord) * self.remap_scale
+                for cord in self.crop_cords[index]]
+        num_channels = 3 if self.sub_chan else None
+        colour = read_lf_slab(
+            h5_file[self.colour], index, crop_cords, num_channels)
+        warped = read_lf_slab(
+            h5_file[self.warped], index, crop_cords, num_channels)
+        return colour, warped
+
+    def read_remapped(self, index):
+        """
+        Returns the uint8 angular remapped inputs and targets of
+        sample index and the N, C, H, W shape of the light field
+        """
+        colour, warped = self.read_uint8(index)
+        if self.remapped:
+            return warped, colour, remapped_shape(self.grid_size, colour)
+        return (
+            data_transform.create_remap(warped),
+            data_transform.create_remap(colour),
+            colour.shape)
+
     def __len__(self):
         """Return the number of samples in the dataset"""
         return self.num_samples
 
 
-def create_dataloaders(args, config):
-    """Creates a train and val dataloader from a h5file and a config file"""
+class InMemoryValLoader(object):
+    """
+    Decodes and remaps every sample of a validation set once,
+    on first use, into a uint8 buffer which is then iterated in order
+    Full views are held, the same validation data as the DataLoader path
+    """
+
+    def __init__(self, val_set, batch_size):
+        """
+        Keyword arguments:
+        val_set -- a ValFromHdf5 dataset
+        batch_size -- the number of samples in each batch
+        """
+        self.val_set = val_set
+        self.batch_size = batch_size
+        self.inputs = None
+        self.targets = None
+        self.shape = None
+
+    def materialise(self):
+        """Reads the whole validation set into memory"""
+        start_time = time.time()
+        num_samples = len(self.val_set)
+        for index in range(num_samples):
+            inputs, targets, shape = self.val_set.read_remapped(index)
+            if self.inputs is None:
+                buffer_shape = (num_samples,) + tuple(inputs.shape)
+                self.inputs = torch.empty(buffer_shape, dtype=torch.uint8)
+                self.targets = torch.empty(buffer_shape, dtype=torch.uint8)
+            self.inputs[index] = inputs
+            self.targets[index] = targets
+            self.shape = shape
+        close_h5_files()
+        print("Loaded {} validation samples into {:.1f}MB in {:.1f}s".format(
+            num_samples,
+            (self.inputs.numel() + self.targets.numel()) / 1e6,
+            time.time() - start_time))
+
+    def __iter__(self):
+        if self.inputs is None:
+            self.materialise()
+        for start in range(0, len(self.val_set), self.batch_size):
+            end = min(start + self.batch_size, len(self.val_set))
+            # Match the collated form of the per sample shape
+            shape = [torch.full((end - start,), dim, dtype=torch.int64)
+                     for dim in self.shape]
+            inputs = self.inputs[start:end].to(torch.float32)
+            targets = self.targets[start:end].to(torch.float32)
+            yield {
+                'inputs': inputs.div_(255.0),
+                'targets': targets.div_(255.0),
+                'shape': shape}
+
+    def __len__(self):
+        return (len(self.val_set) + self.batch_size - 1) // self.batch_size
+
+
+def get_chunk_cache_config(config):
+    """Returns the optional hdf5 (rdcc_nbytes, rdcc_nslots) from config"""
+    rdcc_nbytes = config['NETWORK'].get('rdcc_nbytes', None)
+    rdcc_nslots = config['NETWORK'].get('rdcc_nslots', None)
+    if rdcc_nbytes is not None:
+        rdcc_nbytes = int(rdcc_nbytes)
+    if rdcc_nslots is not None:
+        rdcc_nslots = int(rdcc_nslots)
+    return rdcc_nbytes, rdcc_nslots
+
+
+def create_grouped_loader(train_set, batch_size, num_workers, buffer_size,
+                          sampler=None):
+    """
+    Returns a loader which decodes each light field of train_set once
+    and shuffles its crops into batches of batch_size
+    sampler -- an optional sampler of light fields, such as CropGroupSampler
+    """
+    num_lfs = max(1, batch_size // train_set.num_crops)
+    group_loader = DataLoader(
+        dataset=train_set, num_workers=num_workers,
+        batch_size=num_lfs, shuffle=sampler is None, sampler=sampler,
+        collate_fn=collate_crop_groups)
+    num_groups = train_set.num_samples if sampler is None else len(sampler)
+    return ShuffleBufferLoader(
+        group_loader, batch_size, buffer_size,
+        num_items=num_groups * train_set.num_crops)
+
+
+def create_dataloaders(args, config, rank=0, world_size=1):
+    """
+    Creates a train and val dataloader from a h5file and a config file
+    With a world_size above 1 the training set is sharded to rank
+    """
     print("Loading dataset")
     file_path = os.path.join(config['PATH']['hdf5_dir'],
                              config['PATH']['hdf5_name'])
@@ -161,13 +625,23 @@ def create_dataloaders(args, config):
         print(file_path, " is not a valid location")
         print("Please enter a valid location of a h5 file through main.ini")
         exit(-1)
+    rdcc_nbytes, rdcc_nslots = get_chunk_cache_config(config)
+    group_crops = config['NETWORK'].get('group_crops', 'False') == 'True'
+    uint8_workers = (
+        config['NETWORK'].get('uint8_workers', 'False') == 'True')
+    in_memory_val = (
+        config['NETWORK'].get('in_memory_val', 'False') == 'True')
     train_set = TrainFromHdf5(
         file_path=file_path,
         patch_size=int(config['NETWORK']['patch_size']),
         num_crops=int(config['NETWORK']['num_crops']),
         transform=data_transform.angular_remap,
         sub_chan=config["NETWORK"]["sub_chan"],
-        crop_train=config["NETWORK"]["crop_train"])
+        crop_train=config["NETWORK"]["crop_train"],
+        rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots,
+        group_crops=group_crops,
+        cache=lf_cache.create_cache_from_config(config),
+        uint8_out=uint8_workers)
     batch_size = {'train': int(config['NETWORK']['train_batch_size'])}
     all_sets = [('train', train_set)]
     val_size = int(config['NETWORK']['val_batch_size'])
@@ -177,16 +651,39 @@ def create_dataloaders(args, config):
             file_path=file_path, name=name,
             patch_size=int(config["NETWORK"]["val_patch_size"]),
             transform=data_transform.angular_remap,
-            sub_chan=config["NETWORK"]["sub_chan"])
+            sub_chan=config["NETWORK"]["sub_chan"],
+            rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
         batch_size[name] = val_size
         all_sets.append((name, new_set))
 
+    train_sampler = None
+    if world_size > 1:
+        train_sampler = CropGroupSampler(
+            train_set.num_samples, 1 if group_crops else train_set.num_crops,
+            world_size, rank)
+
     data_loaders = {}
     threads = int(config['NETWORK']['num_workers'])
     for name, dset in all_sets:
-        data_loaders[name] = DataLoader(
-            dataset=dset, num_workers=threads,
-            batch_size=batch_size[name],
-            shuffle=True)
+        if name == 'train' and group_crops:
+            data_loaders[name] = create_grouped_loader(
+                dset, batch_size[name], threads,
+                int(config['NETWORK'].get('shuffle_buffer', 64)),
+                train_sampler)
+        elif name == 'train' and train_sampler is not None:
+            data_loaders[name] = DataLoader(
+                dataset=dset, num_workers=threads,
+                batch_size=batch_size[name],
+                sampler=train_sampler)
+        elif name != 'train' and in_memory_val:
+            data_loaders[name] = InMemoryValLoader(dset, batch_size[name])
+        else:
+            data_loaders[name] = DataLoader(
+                dataset=dset, num_workers=threads,
+                batch_size=batch_size[name],
+                shuffle=True)
+        if name == 'train' and uint8_workers:
+            data_loaders[name] = BatchTransformLoader(
+                data_loaders[name], data_transform.batch_remap)
 
     return data_loaders
@@ -80,14 +80,19 @@ def angular_remap(sample):
     return {'inputs': inputs, 'targets': targets, 'shape': shape}
 
 
-def get_random_crop(sample, patch_size):
-    pixel_end = sample['colour'].shape[-1]
+def random_crop_coords(pixel_end, patch_size):
+    """Return random crop co-ords as V1, H1, V2, H2"""
     high = pixel_end - 1 - patch_size
     start_h = random.randint(0, high)
     start_v = random.randint(0, high)
     end_h = start_h + patch_size
     end_v = start_v + patch_size
-    sample = crop(sample, [start_v, start_h, end_v, end_h])
+    return [start_v, start_h, end_v, end_h]
+
+
+def get_random_crop(sample, patch_size):
+    pixel_end = sample['colour'].shape[-1]
+    sample = crop(sample, random_crop_coords(pixel_end, patch_size))
     return sample
 
 
@@ -100,6 +105,35 @@ def random_gamma(sample):
     return sample
 
 
+def batch_remap(batch):
+    """
+    Normalises, gamma augments and angular remaps a collated batch
+    of uint8 B, N, C, H, W colour and warped light fields in one go
+    Batches of already remapped inputs and targets are not remapped
+    """
+    pre_remapped = 'inputs' in batch
+    if pre_remapped:
+        colour, warped = batch['targets'], batch['inputs']
+    else:
+        colour, warped = batch['colour'], batch['warped']
+    colour = colour.to(torch.float32).div_(255.0)
+    warped = warped.to(torch.float32).div_(255.0)
+    # One random gamma per sample, as random_gamma does
+    gamma = torch.tensor(
+        [random.uniform(0.4, 1.0) for _ in range(colour.shape[0])],
+        dtype=torch.float32).view((-1,) + (1,) * (colour.dim() - 1))
+    colour.pow_(gamma)
+    warped.pow_(gamma)
+    if pre_remapped:
+        return {'inputs': warped, 'targets': colour, 'shape': batch['shape']}
+    inputs = create_remap(warped, dtype=torch.float32)
+    targets = create_remap(colour, dtype=torch.float32)
+    # Match the collated form of the per sample shape
+    shape = [torch.full((colour.shape[0],), dim, dtype=torch.int64)
+             for dim in colour.shape[1:]]
+    return {'inputs': inputs, 'targets': targets, 'shape': shape}
+
+
 def denormalise_lf(lf):
     """Coverts an lf in the range 0 1 to 0 to maximum"""
     maximum = 255.0
@@ -107,35 +141,69 @@ def denormalise_lf(lf):
     return lf
 
 
-def create_remap(in_tensor, dtype=torch.uint8):
+def grid_width(num):
+    """Returns the side length of a square grid of num views"""
+    one_way = int(round(math.sqrt(num)))
+    if one_way * one_way != num:
+        raise ValueError(
+            "{} views do not form a square grid".format(num))
+    return one_way
+
+
+def create_remap(in_tensor, dtype=torch.uint8, out=None):
     """
-    Remaps an input tensor of shape B, W, H, C into
-    W * sqrt(B), H * sqrt(B), C
-    Where each grid of size sqrt(B) * sqrt(B) in the remap
-    contains pixel information from the 64 input images
+    Remaps an input tensor of shape N, C, H, W into
+    C, H * sqrt(N), W * sqrt(N)
+    Where each grid of size sqrt(N) * sqrt(N) in the remap
+    contains pixel information from the N input images
+    View i lands at [:, i % sqrt(N)::sqrt(N), i // sqrt(N)::sqrt(N)]
+
+    A leading batch dimension, B, N, C, H, W, is kept in the output
+    If out is given the remap is written into it, it must be contiguous
     """
-    num, channels, im_height, im_width = in_tensor.shape
-    one_way = int(math.floor(math.sqrt(num)))
-    out_tensor = torch.zeros(
-        size=(channels, im_height * one_way, im_width * one_way),
-        dtype=dtype)
-    for i in range(num):
-        out_tensor[
-            :, i % one_way::one_way, i // one_way::one_way] = in_tensor[i]
-    return out_tensor
-
-
-def undo_remap(in_tensor, desired_shape, dtype=torch.uint8):
+    batched = in_tensor.dim() == 5
+    if not batched:
+        in_tensor = in_tensor.unsqueeze(0)
+    batch, num, channels, im_height, im_width = in_tensor.shape
+    one_way = grid_width(num)
+    out_shape = (batch, channels, im_height * one_way, im_width * one_way)
+    if out is None:
+        out = torch.empty(
+            size=out_shape if batched else out_shape[1:],
+            dtype=dtype, device=in_tensor.device)
+    # Split N into (col, row), then interleave rows with H and cols with W
+    grid = in_tensor.reshape(
+        batch, one_way, one_way, channels, im_height, im_width)
+    out.view(
+        batch, channels, im_height, one_way, im_width, one_way).copy_(
+            grid.permute(0, 3, 4, 2, 5, 1))
+    return out
+
+
+def undo_remap(in_tensor, desired_shape, dtype=torch.uint8, out=None):
     """
     Remaps an input tensor to undo create_remap
+    desired_shape is the N, C, H, W shape of a single light field
+    A leading batch dimension on in_tensor gives a B, N, C, H, W output
+    If out is given the result is written into it, it must be contiguous
     """
-    num, _, _, _ = desired_shape
-    one_way = int(math.floor(math.sqrt(num)))
-    out_tensor = torch.zeros(size=desired_shape, dtype=dtype)
-    for i in range(num):
-        out_tensor[i] = in_tensor[
-            :, i % one_way::one_way, i // one_way::one_way]
-    return out_tensor
+    num, channels, im_height, im_width = [int(dim) for dim in desired_shape]
+    batched = in_tensor.dim() == 4
+    if not batched:
+        in_tensor = in_tensor.unsqueeze(0)
+    batch = in_tensor.shape[0]
+    one_way = grid_width(num)
+    if out is None:
+        out_shape = (batch, num, channels, im_height, im_width)
+        out = torch.empty(
+            size=out_shape if batched else out_shape[1:],
+            dtype=dtype, device=in_tensor.device)
+    remapped = in_tensor.contiguous().view(
+        batch, channels, im_height, one_way, im_width, one_way)
+    out.view(
+        batch, one_way, one_way, channels, im_height, im_width).copy_(
+            remapped.permute(0, 5, 3, 1, 2, 4))
+    return out
 
 
 if __name__ == "__main__":
@@ -147,7 +215,7 @@ if __name__ == "__main__":
     with h5py.File(
             loc, mode='r',
             libver='latest', swmr=True) as h5_file:
-        inp = h5_file["train/images"][0]
+        inp = torch.from_numpy(h5_file["train/images"][0])
         data = create_remap(inp).numpy()
         data = np.swapaxes(data, 0, 2)
         data = np.swapaxes(data, 0, 1)
@@ -0,0 +1,112 @@
+"""
+Stages for pipelining reading, inference, evaluation and saving
+
+A ReaderThread reads ahead into a bounded queue and StagePools run
+jobs on worker threads with a bounded number in flight, so a slow stage
+holds back the stages before it rather than filling memory.
+Each stage records the time it spends busy, not counting time blocked
+on a later stage, for its utilisation.
+Torch, numpy, PIL and hdf5 release the GIL in their heavy work,
+so the threads of different stages run at the same time.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds each thread has spent blocked in StagePool.submit
+_BLOCKED = threading.local()
+
+
+class ReaderThread(object):
+    """Calls read_fn on each of items from a thread, ahead of the consumer"""
+
+    def __init__(self, read_fn, items, max_queue=2):
+        """
+        Keyword arguments:
+        read_fn -- a function of one item returning what to consume
+        items -- the items to read, in order
+        max_queue -- the number of results to hold before reading blocks
+        """
+        self.read_fn = read_fn
+        self.items = items
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.busy_time = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Reads every item then puts a None"""
+        try:
+            for item in self.items:
+                start_time = time.time()
+                result = self.read_fn(item)
+                self.busy_time += time.time() - start_time
+                self.queue.put(result)
+        except Exception as err:
+            self.error = err
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        """Yields each result, raising any error of the reading thread"""
+        while True:
+            result = self.queue.get()
+            if result is None:
+                break
+            yield result
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class StagePool(object):
+    """A thread pool which blocks submit while max_pending jobs are queued"""
+
+    def __init__(self, num_workers, max_pending=None):
+        """
+        Keyword arguments:
+        num_workers -- the number of worker threads
+        max_pending -- jobs submitted but not finished before submit
+                       blocks, default twice num_workers
+        """
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(
+            max_pending or 2 * num_workers)
+        self.lock = threading.Lock()
+        self.busy_time = 0.0
+
+    def submit(self, function, *args):
+        """Returns a Future of function(*args) run on a worker"""
+        start_time = time.time()
+        self.slots.acquire()
+        _BLOCKED.time = getattr(_BLOCKED, 'time', 0.0) + (
+            time.time() - start_time)
+        try:
+            future = self.executor.submit(self.timed, function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def timed(self, function, *args):
+        """Calls function, counting the time not blocked on another pool"""
+        start_time = time.time()
+        start_blocked = getattr(_BLOCKED, 'time', 0.0)
+        try:
+            return function(*args)
+        finally:
+            blocked = getattr(_BLOCKED, 'time', 0.0) - start_blocked
+            with self.lock:
+                self.busy_time += time.time() - start_time - blocked
+
+    def utilisation(self, time_taken):
+        """Returns the fraction of time_taken the workers were busy"""
+        return self.busy_time / (time_taken * self.num_workers)
+
+    def close(self):
+        """Waits for every submitted job and stops the workers"""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,115 @@
+"""
+CPU data parallel training over local processes with torch.distributed
+
+Each rank trains on its own shard of the training light fields and the
+gloo backend all-reduces the gradients, so the effective batch size is
+train_batch_size times the number of ranks.
+Only rank 0 validates, logs and saves checkpoints.
+"""
+import contextlib
+import os
+import random
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+
+class NullWriter(object):
+    """Stands in for a SummaryWriter on the ranks which do not log"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Returns True on the rank which logs and saves, or if not distributed"""
+    return get_rank() == 0
+
+
+def free_port():
+    """Returns a currently unused local port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch(function, world_size, *args):
+    """
+    Runs function(rank, world_size, *args) in world_size local processes,
+    each in a gloo process group
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(free_port()))
+    mp.spawn(
+        run_rank, args=(world_size, function, args),
+        nprocs=world_size, join=True)
+
+
+def run_rank(rank, world_size, function, args):
+    """
+    Sets up the process group of rank and calls function in it,
+    with the default seeds offset by rank and output only from rank 0
+    """
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # Share the cores between the ranks rather than each using them all
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    # Offset the default seeds so the ranks never draw the same
+    # random crops or DataLoader worker seeds
+    seed = torch.initial_seed() + rank
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    random.seed(seed)
+    with contextlib.ExitStack() as stack:
+        if rank != 0:
+            stack.enter_context(contextlib.redirect_stdout(
+                stack.enter_context(open(os.devnull, 'w'))))
+        try:
+            function(rank, world_size, *args)
+        finally:
+            dist.destroy_process_group()
+
+
+def wrap_model(model):
+    """Returns model wrapped to all-reduce its gradients if distributed"""
+    if get_world_size() == 1:
+        return model
+    return DistributedDataParallel(model)
+
+
+def average(value):
+    """Returns the mean of a float over all ranks"""
+    if get_world_size() == 1:
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+
+def broadcast(value):
+    """Returns the float value of rank 0 on every rank"""
+    if get_world_size() == 1:
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.broadcast(tensor, src=0)
+    return tensor.item()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
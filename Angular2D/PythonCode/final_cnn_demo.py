@@ -6,6 +6,7 @@ import time
 import pathlib
 import math
 import gc
+from functools import partial
 
 import torch
 import h5py
@@ -13,13 +14,17 @@ import numpy as np
 from PIL import Image
 
 import cnn_utils
+from compiled_model import CompiledModel, COMPILE_MODES, default_cache_dir
 import conversions
 import helpers
 import data_transform
 from data_transform import denormalise_lf
 import image_warping
-import evaluate
+import metric_cache
 import welford
+from demo_pipeline import ReaderThread, StagePool
+from model_2d import C2D, fold_c2d
+from tiled_inference import TiledModel
 
 def get_sub_dir_for_saving(base_dir):
     """
@@ -41,170 +46,357 @@ def get_sub_dir_for_saving(base_dir):
 
     return sub_dir_to_save_to
 
-def do_one_demo(args, config, hdf5_file, model, sample_num, cuda):
+def load_sample(hdf5_file, sample_num):
+    """
+    Returns the warped light field sample_num of the hdf5 val group,
+    its ground truth colour images and the metric_cache fingerprint
+    of the sample
+    """
+    print("Working on image", sample_num)
     depth_grp = hdf5_file['val']['disparity']
-    # Create output directory
-
-    if not args.no_save:
-        base_dir = os.path.join(config['PATH']['output_dir'], 'warped')
-        if not os.path.isdir(base_dir):
-            pathlib.Path(base_dir).mkdir(parents=True, exist_ok=True)
-        save_dir = get_sub_dir_for_saving(base_dir)
-
-    model.eval()
-    SNUM = sample_num
-    start_time = time.time()
-    print("Working on image", SNUM)
+    depth_data = depth_grp['images'][sample_num]
     depth_images = torch.squeeze(torch.tensor(
-        depth_grp['images'][SNUM],
+        depth_data,
         dtype=torch.float32))
 
     colour_grp = hdf5_file['val']['colour']
+    colour_data = colour_grp['images'][sample_num]
     colour_images = torch.tensor(
-        colour_grp['images'][SNUM],
+        colour_data,
         dtype=torch.float32)
+    key = metric_cache.fingerprint(depth_data, colour_data)
 
     sample = {'depth': depth_images,
                 'colour': colour_images,
                 'grid_size': depth_images.shape[0]}
 
-    warped = data_transform.transform_to_warped(sample)
-    desired_shape = warped['shape']
-    im_input = warped['inputs'].unsqueeze_(0)
+    return data_transform.transform_to_warped(sample), colour_images, key
 
+def read_batch(hdf5_file, sample_nums):
+    """
+    Returns the light fields sample_nums as one remapped input batch,
+    the shape of each light field, their colour images and fingerprints
+    """
+    warped, colours, keys = [], [], []
+    for sample_num in sample_nums:
+        sample, colour_images, key = load_sample(hdf5_file, sample_num)
+        warped.append(sample)
+        colours.append(colour_images)
+        keys.append(key)
+    im_input = torch.stack([sample['inputs'] for sample in warped])
+    return im_input, [sample['shape'] for sample in warped], colours, keys
+
+def run_model(args, model, im_input, cuda):
+    """Returns the model outputs for im_input and the seconds taken"""
+    model_start = time.time()
     if cuda:
         im_input = im_input.cuda()
 
-    output = model(im_input)
-    output += im_input
-    output = torch.clamp(output, 0.0, 1.0)
-
-    time_taken = time.time() - start_time
-    print("Time taken was {:.0f}s".format(time_taken))
-    grid_size = 64
+    _, output = cnn_utils.infer_batch(model, im_input, args.amp, cuda)
+    if cuda:
+        torch.cuda.synchronize()
+    return output, time.time() - model_start
 
-    psnr_accumulator = (0, 0, 0)
-    ssim_accumulator = (0, 0, 0)
+def do_batch_demo(args, config, hdf5_file, model, sample_nums, cuda,
+                  cache=None):
+    """
+    Runs the model once on a batch of the light fields sample_nums
+    and then evaluates and saves each output, with values already
+    in the metric cache taken from it
+    Returns the psnr1, ssim1, psnr2, ssim2 of each light field,
+    the seconds from the start of the batch until each light field was
+    evaluated, and the seconds the model took
+    """
+    model.eval()
+    start_time = time.time()
+    im_input, shapes, colours, keys = read_batch(hdf5_file, sample_nums)
+    output, model_time = run_model(args, model, im_input, cuda)
+
+    print("Time taken was {:.0f}s for {} light fields, {:.0f}s in the model"
+          .format(time.time() - start_time, len(sample_nums), model_time))
+    results, latencies = [], []
+    for i in range(len(sample_nums)):
+        results.append(evaluate_one(
+            args, config, output[i:i + 1], im_input[i:i + 1],
+            shapes[i], colours[i], keys[i], cache))
+        latencies.append(time.time() - start_time)
+    return results, latencies, model_time
 
-    if not args.no_save:
-        print("Saving output to", save_dir)
-        no_cnn_dir = os.path.join(save_dir, "no_cnn")
-        cnn_dir = os.path.join(save_dir, "cnn")
-        os.mkdir(cnn_dir)
-        os.mkdir(no_cnn_dir)
+def do_one_demo(args, config, hdf5_file, model, sample_num, cuda):
+    results, _, _ = do_batch_demo(
+        args, config, hdf5_file, model, [sample_num], cuda)
+    return results[0]
 
-    output = torch.squeeze(denormalise_lf(output))
-    output = data_transform.undo_remap(output, desired_shape, dtype=torch.float32)
-    cpu_output = np.around(output.cpu().detach().numpy()).astype(np.uint8)
+def make_save_dirs(args, config):
+    """
+    Creates the next numbered output directory with cnn and no_cnn
+    sub directories, returning the three, or None if args.no_save
+    """
+    if args.no_save:
+        return None
+    base_dir = os.path.join(config['PATH']['output_dir'], 'warped')
+    if not os.path.isdir(base_dir):
+        pathlib.Path(base_dir).mkdir(parents=True, exist_ok=True)
+    save_dir = get_sub_dir_for_saving(base_dir)
+
+    print("Saving output to", save_dir)
+    no_cnn_dir = os.path.join(save_dir, "no_cnn")
+    cnn_dir = os.path.join(save_dir, "cnn")
+    os.mkdir(cnn_dir)
+    os.mkdir(no_cnn_dir)
+    return save_dir, cnn_dir, no_cnn_dir
+
+def lf_views(remapped, desired_shape):
+    """Returns the 8 bit views of a remapped light field in 0 to 1"""
+    views = torch.squeeze(denormalise_lf(remapped))
+    views = data_transform.undo_remap(
+        views, desired_shape, dtype=torch.float32)
+    return np.around(views.cpu().detach().numpy()).astype(np.uint8)
+
+def save_diff_image(colour, image, save_location):
+    diff = image_warping.get_diff_image(colour, image)
+    #diff = get_diff_image_floatint(res, colour)
+    image_warping.save_array_as_image(diff, save_location)
+
+def plan_one(args, save_dirs, output, im_input, desired_shape,
+             colour_images):
+    """
+    Returns the jobs saving the images of one light field, as functions
+    of no arguments, and the (views, ground truth, model key) to evaluate,
+    the model output first and then the input if args.no_cnn
+    """
+    grid_size = 64
+    grid_len = int(math.sqrt(grid_size))
+    cpu_output = lf_views(output, desired_shape)
 
     if (not args.no_eval) or args.get_diff:
         ground_truth = np.around(
             denormalise_lf(colour_images).numpy()
             ).astype(np.uint8)
-    grid_len = int(math.sqrt(grid_size))
-    for i in range(grid_size):
-        row, col = i // grid_len, i % grid_len
+    saves, evals = [], []
+    if not args.no_eval:
+        evals.append((cpu_output, ground_truth, args.model_key))
 
-        if not args.no_save:
-            file_name = 'Colour{}{}.png'.format(row, col)
-            save_location = os.path.join(cnn_dir, file_name)
-            if i == 0:
-                print("Saving images of size ", cpu_output[i].shape)
-            image_warping.save_array_as_image(
-                cpu_output[i], save_location)
-        
-        if args.get_diff and not args.no_save:
-            colour = ground_truth[i]
-            diff = image_warping.get_diff_image(colour, cpu_output[i])
-            #diff = get_diff_image_floatint(res, colour)
-            file_name = 'Diff{}{}.png'.format(row, col)
-            save_location = os.path.join(cnn_dir, file_name)
-            image_warping.save_array_as_image(diff, save_location)
+    if save_dirs is not None:
+        save_dir, cnn_dir, _ = save_dirs
+        print("Saving images of size ", cpu_output[0].shape)
+        for i in range(grid_size):
+            row, col = i // grid_len, i % grid_len
+            saves.append(partial(
+                image_warping.save_array_as_image, cpu_output[i],
+                os.path.join(cnn_dir, 'Colour{}{}.png'.format(row, col))))
+            if args.get_diff:
+                saves.append(partial(
+                    save_diff_image, ground_truth[i], cpu_output[i],
+                    os.path.join(cnn_dir, 'Diff{}{}.png'.format(row, col))))
+            if not args.no_eval:
+                saves.append(partial(
+                    image_warping.save_array_as_image, ground_truth[i],
+                    os.path.join(
+                        save_dir, 'GT_Colour{}{}.png'.format(row, col))))
 
+    if args.no_cnn:
+        cpu_input = lf_views(im_input, desired_shape)
         if not args.no_eval:
-            img = ground_truth[i]
-
-            if not args.no_save:
-                file_name = 'GT_Colour{}{}.png'.format(row, col)
-                save_location = os.path.join(save_dir, file_name)
-                image_warping.save_array_as_image(img, save_location)
-            psnr = evaluate.my_psnr(
-                cpu_output[i], 
-                img)
-            ssim = evaluate.ssim(
-                cpu_output[i], 
-                img)
-            psnr_accumulator = welford.update(psnr_accumulator, psnr)
-            ssim_accumulator = welford.update(ssim_accumulator, ssim)
-
-    psnr_mean, psnr_var, _ = welford.finalize(psnr_accumulator)
-    ssim_mean, ssim_var, _ = welford.finalize(ssim_accumulator)
-    print("For cnn, psnr average {:5f}, stddev {:5f}".format(
-        psnr_mean, math.sqrt(psnr_var)))
-    print("For cnn, ssim average {:5f}, stddev {:5f}".format(
-        ssim_mean, math.sqrt(ssim_var)))
-    psnr1 = psnr_mean
-    ssim1 = ssim_mean
-
+            evals.append((cpu_input, ground_truth, "warped"))
+        if save_dirs is not None:
+            no_cnn_dir = save_dirs[2]
+            print("Saving images of size ", cpu_input[0].shape)
+            for i in range(grid_size):
+                row, col = i // grid_len, i % grid_len
+                saves.append(partial(
+                    image_warping.save_array_as_image, cpu_input[i],
+                    os.path.join(
+                        no_cnn_dir, 'Colour{}{}.png'.format(row, col))))
+                if args.get_diff:
+                    saves.append(partial(
+                        save_diff_image, ground_truth[i], cpu_output[i],
+                        os.path.join(
+                            no_cnn_dir, 'Diff{}{}.png'.format(row, col))))
+    return saves, evals
+
+def view_metrics(views, ground_truth, model, key=None, cache=None):
+    """
+    Returns welford aggregates of the psnr and ssim of each view
+    of two N, C, H, W light fields, from the cache under the sample
+    fingerprint key and model when stored there
+    """
     psnr_accumulator = (0, 0, 0)
     ssim_accumulator = (0, 0, 0)
+    for psnr, ssim in zip(*metric_cache.cached_view_metrics(
+            cache, key, views, ground_truth, model)):
+        psnr_accumulator = welford.update(psnr_accumulator, psnr)
+        ssim_accumulator = welford.update(ssim_accumulator, ssim)
+    return psnr_accumulator, ssim_accumulator
 
-    psnr2, ssim2 = 0, 0
-    if args.no_cnn:
-        squeeze_input = torch.squeeze(denormalise_lf(im_input))
-        squeeze_input = data_transform.undo_remap(
-            squeeze_input, desired_shape, torch.float32)
-        cpu_input = np.around(
-            squeeze_input.cpu().detach().numpy()).astype(np.uint8)
-        for i in range(grid_size):
-            row, col = i // grid_len, i % grid_len
-
-            if not args.no_save:
-                file_name = 'Colour{}{}.png'.format(row, col)
-                save_location = os.path.join(no_cnn_dir, file_name)
-                if i == 0:
-                    print("Saving images of size ", cpu_input[i].shape)
-                image_warping.save_array_as_image(
-                    cpu_input[i], save_location)
-
-            if args.get_diff and not args.no_save:
-                colour = ground_truth[i]
-                diff = image_warping.get_diff_image(colour, cpu_output[i])
-                #diff = get_diff_image_floatint(res, colour)
-                file_name = 'Diff{}{}.png'.format(row, col)
-                save_location = os.path.join(no_cnn_dir, file_name)
-                image_warping.save_array_as_image(diff, save_location)
-
-            if not args.no_eval:
-                img = ground_truth[i]
-                psnr = evaluate.my_psnr(
-                    cpu_input[i], 
-                    img)
-                ssim = evaluate.ssim(
-                    cpu_input[i], 
-                    img)
-                psnr_accumulator = welford.update(psnr_accumulator, psnr)
-                ssim_accumulator = welford.update(ssim_accumulator, ssim)
-
+def report_metrics(metrics):
+    """
+    Prints the view_metrics of the output and input of one light field
+    Returns psnr1, ssim1 of the output and psnr2, ssim2 of the input
+    """
+    results = []
+    for name, (psnr_accumulator, ssim_accumulator) in zip(
+            ["cnn", "no cnn"], metrics):
         psnr_mean, psnr_var, _ = welford.finalize(psnr_accumulator)
         ssim_mean, ssim_var, _ = welford.finalize(ssim_accumulator)
-        print("For no cnn, psnr average {:5f}, stddev {:5f}".format(
-            psnr_mean, math.sqrt(psnr_var)))
-        print("For no cnn, ssim average {:5f}, stddev {:5f}".format(
-            ssim_mean, math.sqrt(ssim_var)))
-        psnr2, ssim2 = psnr_mean, ssim_mean
+        print("For {}, psnr average {:5f}, stddev {:5f}".format(
+            name, psnr_mean, math.sqrt(psnr_var)))
+        print("For {}, ssim average {:5f}, stddev {:5f}".format(
+            name, ssim_mean, math.sqrt(ssim_var)))
+        results += [psnr_mean, ssim_mean]
+    results += [0, 0] * (2 - len(metrics))
+    return tuple(results)
+
+def evaluate_one(args, config, output, im_input, desired_shape,
+                 colour_images, key=None, cache=None):
+    """
+    Saves and evaluates the model output of one light field
+    against colour_images, and the input too if args.no_cnn,
+    with values under its fingerprint key in the cache taken from it
+    Returns psnr1, ssim1 of the output and psnr2, ssim2 of the input
+    """
+    saves, evals = plan_one(
+        args, make_save_dirs(args, config), output, im_input,
+        desired_shape, colour_images)
+    for save in saves:
+        save()
+    return report_metrics(
+        [view_metrics(*pair, key=key, cache=cache) for pair in evals])
+
+def finish_time(job):
+    """Runs job, returning the time it finished"""
+    job()
+    return time.time()
+
+def evaluate_job(args, writer, save_dirs, output, im_input, desired_shape,
+                 colour_images, key=None, cache=None):
+    """
+    Queues the images of one light field on the writer pool and
+    evaluates it as evaluate_one does, as a job of the evaluation
+    pool of run_pipeline
+    Returns the view_metrics, the Futures of the image writes
+    and the time the evaluation finished
+    """
+    # Inference mode is per thread, and lf_views scales output in place
+    with cnn_utils.inference_context():
+        saves, evals = plan_one(
+            args, save_dirs, output, im_input, desired_shape, colour_images)
+    save_futures = [writer.submit(finish_time, save) for save in saves]
+    metrics = [view_metrics(*pair, key=key, cache=cache) for pair in evals]
+    return metrics, save_futures, time.time()
+
+def run_pipeline(args, config, hdf5_file, model, cuda, cache=None):
+    """
+    Runs the demo as stages with bounded queues between them:
+    a thread reading and warping batches, the model on this thread,
+    a pool of args.eval_workers evaluating each light field and
+    a pool of args.write_workers saving the images, and prints how
+    busy each stage was
+    Returns the psnr1, ssim1, psnr2, ssim2 of each light field,
+    the seconds from the start of reading each until it was evaluated
+    and saved, and the seconds the model took
+    """
+    batches = [
+        list(range(start, min(start + args.batch_size, args.nSamples)))
+        for start in range(0, args.nSamples, args.batch_size)]
 
-    return psnr1, ssim1, psnr2, ssim2
+    def read(sample_nums):
+        return sample_nums, time.time(), read_batch(hdf5_file, sample_nums)
+
+    model.eval()
+    start_time = time.time()
+    reader = ReaderThread(read, batches, max_queue=args.queue_size)
+    evaluator = StagePool(args.eval_workers)
+    # Up to a few light fields of views, which are already in memory
+    writer = StagePool(args.write_workers, max_pending=256)
+    model_time = 0.0
+    pending = []
+    for sample_nums, read_start, (im_input, shapes, colours, keys) in reader:
+        output, batch_model_time = run_model(args, model, im_input, cuda)
+        model_time += batch_model_time
+        output = output.cpu()
+        print("Model took {:.0f}s for {} light fields".format(
+            batch_model_time, len(sample_nums)))
+        for i in range(len(sample_nums)):
+            pending.append((read_start, evaluator.submit(
+                evaluate_job, args, writer, make_save_dirs(args, config),
+                output[i:i + 1], im_input[i:i + 1], shapes[i], colours[i],
+                keys[i], cache)))
+
+    results, latencies = [], []
+    for read_start, future in pending:
+        metrics, save_futures, end_time = future.result()
+        end_time = max([end_time] + [save.result() for save in save_futures])
+        results.append(report_metrics(metrics))
+        latencies.append(end_time - read_start)
+    evaluator.close()
+    writer.close()
+    time_taken = time.time() - start_time
+
+    print("\nStage utilisation over {:.2f}s: read {:.0f}%, model {:.0f}%, "
+          "evaluate {:.0f}% of {} workers, write {:.0f}% of {} workers"
+          .format(time_taken, 100 * reader.busy_time / time_taken,
+                  100 * model_time / time_taken,
+                  100 * evaluator.utilisation(time_taken),
+                  evaluator.num_workers,
+                  100 * writer.utilisation(time_taken),
+                  writer.num_workers))
+    return results, latencies, model_time
+
+def print_throughput(latencies, model_time, time_taken):
+    """
+    Prints the latency of each light field, from the start of its batch
+    until it was evaluated, and the light fields per second overall
+    and in the model alone
+    """
+    latencies = np.array(latencies)
+    print("\nLatency per light field: mean {:.2f}s, median {:.2f}s, "
+          "95th percentile {:.2f}s, max {:.2f}s".format(
+              latencies.mean(), np.percentile(latencies, 50),
+              np.percentile(latencies, 95), latencies.max()))
+    print("Throughput: {:.3f} light fields/s overall, "
+          "{:.3f} light fields/s in the model".format(
+              len(latencies) / time_taken, len(latencies) / model_time))
+
+def model_key(args, config):
+    """
+    Returns the metric_cache model key of the demo outputs, the hash of
+    the checkpoint and the options which change the outputs at all
+    """
+    parts = [metric_cache.file_hash(os.path.join(
+        config['PATH']['model_dir'], args.pretrained))]
+    if args.amp:
+        parts.append("amp=" + args.amp)
+    if args.fold:
+        parts.append("fold")
+    if args.compile:
+        parts.append("compile=" + args.compile)
+    if args.tile_size > 0:
+        parts.append("tiles")
+    return ";".join(parts)
 
 def main(args, config):
     cuda = cnn_utils.check_cuda(config)
     model = cnn_utils.load_model_and_weights(args, config)
     if cuda:
         model = model.cuda()
+    if args.fold and isinstance(model, C2D):
+        model = fold_c2d(model)
+    if args.compile:
+        model = CompiledModel(
+            model, args.compile, default_cache_dir(config), freeze=True)
+    if args.tile_size > 0:
+        model = TiledModel(model, args.tile_size, args.tile_batch)
 
     file_path = os.path.join(config['PATH']['hdf5_dir'],
                                 config['PATH']['hdf5_name'])
-    with h5py.File(file_path, mode='r', libver='latest') as hdf5_file:
+    cache = None
+    args.model_key = ""
+    if not (args.no_cache or args.no_eval):
+        cache = metric_cache.MetricCache(file_path, args.cache_loc)
+        args.model_key = model_key(args, config)
+    with h5py.File(file_path, mode='r', libver='latest') as hdf5_file, \
+            cnn_utils.inference_context():
         overall_psnr_accum = (0, 0, 0)
         overall_ssim_accum = (0, 0, 0)
 
@@ -212,14 +404,32 @@ def main(args, config):
             overalln_psnr_accum = (0, 0, 0)
             overalln_ssim_accum = (0, 0, 0)
 
-        for sample_num in range(args.nSamples):
-            p1, s1, p2, s2 = do_one_demo(
-                args, config, hdf5_file, model, sample_num, cuda)
+        start_time = time.time()
+        if args.no_pipeline:
+            results, latencies, model_time = [], [], 0.0
+            for start in range(0, args.nSamples, args.batch_size):
+                sample_nums = list(range(
+                    start, min(start + args.batch_size, args.nSamples)))
+                batch_results, batch_latencies, batch_model_time = \
+                    do_batch_demo(
+                        args, config, hdf5_file, model, sample_nums, cuda,
+                        cache)
+                results += batch_results
+                latencies += batch_latencies
+                model_time += batch_model_time
+        else:
+            results, latencies, model_time = run_pipeline(
+                args, config, hdf5_file, model, cuda, cache)
+        print_throughput(latencies, model_time, time.time() - start_time)
+        if cache is not None:
+            cache.close()
+
+        for p1, s1, p2, s2 in results:
             overall_psnr_accum = welford.update(
                 overall_psnr_accum, p1)
             overall_ssim_accum = welford.update(
                 overall_ssim_accum, s1)
-            
+
             if args.no_cnn:
                 overalln_psnr_accum = welford.update(
                     overalln_psnr_accum, p2)
@@ -277,10 +487,40 @@ if __name__ == '__main__':
                         help="Should get difference images")
     PARSER.add_argument('--nSamples', "--n", default=1, type=int,
                         help="Number of sample to evaluate")
+    PARSER.add_argument('--batch_size', "--b", default=1, type=int,
+                        help="Number of light fields to run the model on " +
+                        "at once, default 1")
+    PARSER.add_argument("--no_pipeline", action='store_true',
+                        help="Read, run, evaluate and save one step " +
+                        "at a time rather than as pipelined stages")
+    PARSER.add_argument("--eval_workers", default=2, type=int,
+                        help="Threads evaluating light fields, default 2")
+    PARSER.add_argument("--write_workers", default=4, type=int,
+                        help="Threads saving images, default 4")
+    PARSER.add_argument("--queue_size", default=2, type=int,
+                        help="Batches to read ahead of the model, default 2")
     PARSER.add_argument("--no_save", "--ns", action='store_true',
                         help="Should not save images")
     PARSER.add_argument('--first', "--f", default=True, type=bool,
                         help="Load the first layer pretrained - default True")
+    PARSER.add_argument("--amp", default=None, choices=["bf16"],
+                        help="Run the model in mixed precision")
+    PARSER.add_argument("--tile_size", default=0, type=int,
+                        help="Run the remapped image in tiles of this many " +
+                        "pixels a side, default 0 runs it whole")
+    PARSER.add_argument("--tile_batch", default=4, type=int,
+                        help="Number of tiles to run at once, default 4")
+    PARSER.add_argument("--fold", action="store_true",
+                        help="Fold the MeanShifts and res_scale into the " +
+                        "convolutions, see fold_check.py")
+    PARSER.add_argument("--compile", default=None, choices=COMPILE_MODES,
+                        help="Run the model compiled, cached in the " +
+                        "config compile_cache or model_dir/compile_cache")
+    PARSER.add_argument("--no_cache", action="store_true",
+                        help="Evaluate without the metric cache")
+    PARSER.add_argument("--cache_loc", default=None, type=str,
+                        help="The metric cache file, " +
+                        "default next to the hdf5 file")
     #Any unknown argument will go to unparsed
     ARGS, UNPARSED = PARSER.parse_known_args()
 
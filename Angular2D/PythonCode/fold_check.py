@@ -0,0 +1,120 @@
+"""
+Checks and exports a C2D model with its MeanShifts and res_scale folded
+
+Folds the model with model_2d.fold_c2d and compares it with the original
+on random remapped light fields of random sizes, including all black and
+all white ones, as the borders of the folded head conv are padded by the
+mean instead of zero. Exits with -1 if any output differs by more than
+--tolerance, otherwise saves the folded model if --save is given.
+
+Example:
+python fold_check.py --pretrained best_model.pth --save folded_model.pth
+"""
+import argparse
+import configparser
+import os
+
+import torch
+
+import cnn_utils
+import helpers
+from checkpoint_writer import atomic_save
+from model_2d import C2D, fold_c2d
+
+
+def random_inputs(num_trials, max_size, grid_size=64):
+    """
+    Yields batches of random 8 bit remapped light fields of random
+    view sizes up to max_size, then an all black and all white one
+    """
+    one_way = int(round(grid_size ** 0.5))
+    for _ in range(num_trials):
+        batch_size = int(torch.randint(1, 4, (1,)))
+        height, width = torch.randint(1, max_size + 1, (2,)).tolist()
+        yield torch.randint(0, 256, (
+            batch_size, 3, height * one_way, width * one_way)).float() / 255
+    shape = (1, 3, max_size * one_way, max_size * one_way)
+    yield torch.zeros(shape)
+    yield torch.ones(shape)
+
+
+def main(args, config):
+    cuda = cnn_utils.check_cuda(config)
+    torch.manual_seed(args.seed)
+    if args.pretrained:
+        model = cnn_utils.load_model_and_weights(args, config)
+    else:
+        print("No --pretrained model given, checking an untrained model")
+        model = C2D(args, inchannels=1, outchannels=1)
+    if cuda:
+        model = model.cuda()
+    model.eval()
+    folded = fold_c2d(model).eval()
+
+    max_diff = 0.0
+    with cnn_utils.inference_context():
+        for inputs in random_inputs(args.trials, args.size):
+            if cuda:
+                inputs = inputs.cuda()
+            max_diff = max(max_diff, torch.max(torch.abs(
+                model(inputs) - folded(inputs))).item())
+    print("Largest output difference of the folded model {:.3e}".format(
+        max_diff))
+    if not max_diff <= args.tolerance:
+        print("The folded model differs by more than {}".format(
+            args.tolerance))
+        exit(-1)
+    print("The folded model is within {} of the original".format(
+        args.tolerance))
+
+    if args.save:
+        location = os.path.join(config['PATH']['model_dir'], args.save)
+        folded = folded.cpu()
+        # The checkpoint format cnn_utils.load_model_and_weights reads
+        atomic_save({"model": folded, "state_dict": folded.state_dict()},
+                    location)
+        print("Folded model saved to {}".format(location))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Process modifiable parameters from command line')
+    PARSER.add_argument('--pretrained', default='', type=str,
+                        help='name of model in the config model dir')
+    PARSER.add_argument('--first', "--f", default=True, type=bool,
+                        help="Load the first layer pretrained - default True")
+    PARSER.add_argument('--save', default='', type=str,
+                        help="name to save the folded model as in model dir")
+    PARSER.add_argument("--tolerance", default=1e-5, type=float,
+                        help="Largest allowed output difference")
+    PARSER.add_argument("--trials", default=8, type=int,
+                        help="Number of random batches to compare on")
+    PARSER.add_argument("--size", default=32, type=int,
+                        help="Largest random view size, default 32")
+    PARSER.add_argument("--seed", default=0, type=int,
+                        help="Seed for the inputs and untrained model")
+    PARSER.add_argument('--config', "--cfg", default='main.ini', type=str,
+                        help="Name of config file to use")
+    PARSER.add_argument("--absolute_cfg", "-ac", action="store_true")
+    PARSER.add_argument('--n_feats', '--nf', default=8, type=int,
+                        help="Number of features of an untrained model")
+    PARSER.add_argument('--n_resblocks', '--nr', default=4, type=int,
+                        help="Number of residual blocks of an untrained model")
+    PARSER.add_argument('--res_scale', '--rs', default=0.1, type=float,
+                        help="Residual scale of an untrained model")
+    ARGS, UNPARSED = PARSER.parse_known_args()
+
+    if len(UNPARSED) != 0:
+        print("Unrecognised command line argument passed")
+        print(UNPARSED)
+        exit(-1)
+
+    CONFIG = configparser.ConfigParser()
+    if ARGS.absolute_cfg:
+        CONFIG.read(ARGS.config)
+    else:
+        CONFIG.read(os.path.join('config', ARGS.config))
+    helpers.print_config(CONFIG)
+    print(ARGS)
+    print()
+    main(ARGS, CONFIG)
@@ -1,4 +1,5 @@
 """A set of functions for helping, such as printing certain objects"""
+import h5py
 import numpy as np
 
 def print_config(config):
@@ -43,4 +44,20 @@ def prompt_user(message, failed=False):
             print("Read no input twice, assuming problem, crashing")
             exit(-1)
         print("Read no input, please enter y or n (case insensitive)")
-        return prompt_user(message, failed=True)
\ No newline at end of file
+        return prompt_user(message, failed=True)
+
+
+def write_synthetic_hdf5(location, num_train=4, num_val=2,
+                         grid_size=64, channels=3, size=16):
+    """Writes random uint8 light fields in the layout the loaders expect"""
+    rng = np.random.RandomState(0)
+    with h5py.File(location, mode='w', libver='latest') as h5_file:
+        for name, num in (('train', num_train), ('val', num_val)):
+            group = h5_file.create_group(name)
+            shape = (num, grid_size, channels, size, size)
+            group.attrs['lf_shape'] = shape
+            group.attrs['baseline'] = 0.5
+            for dset in ('images', 'warped'):
+                group.create_dataset(
+                    dset, data=rng.randint(0, 256, shape, dtype=np.uint8),
+                    chunks=(1, 1, channels, size, size))
@@ -0,0 +1,140 @@
+"""
+Writes tensorboard image grids of light fields on a background thread
+
+The training loop only takes a small CPU snapshot of the batch,
+the undo_remap, make_grid and add_image work happens off the hot loop
+An error writing images is raised by the next log, flush or close
+"""
+import queue
+import threading
+
+import torch
+import torchvision.utils as vutils
+
+from data_transform import undo_remap, grid_width
+
+
+def downsample_remapped(image, grid_size, factor):
+    """
+    Keeps every factor-th pixel of each view of a C, H, W remapped image
+    The interleaving of the grid_size views is preserved
+    """
+    if factor <= 1:
+        return image
+    one_way = grid_width(grid_size)
+    channels, height, width = image.shape
+    views = image.view(
+        channels, height // one_way, one_way, width // one_way, one_way)
+    views = views[:, ::factor, :, ::factor, :]
+    return views.reshape(
+        channels, views.shape[1] * one_way, views.shape[3] * one_way)
+
+
+def write_image_grids(writer, phase, epoch, snapshot):
+    """
+    Writes grids of a snapshot of one light field to tensorboard
+    snapshot holds remapped inputs, residuals, outputs, targets and shape
+    """
+    desired_shape = snapshot['shape']
+    inputs_s = undo_remap(
+        snapshot['inputs'], desired_shape, dtype=torch.float32)
+    residuals_s = undo_remap(
+        snapshot['residuals'], desired_shape, dtype=torch.float32)
+    outputs_s = undo_remap(
+        snapshot['outputs'], desired_shape, dtype=torch.float32)
+    targets_s = undo_remap(
+        snapshot['targets'], desired_shape, dtype=torch.float32)
+    input_grid = vutils.make_grid(
+        inputs_s, nrow=8, value_range=(0, 1), normalize=True,
+        pad_value=1.0)
+    residual_grid = vutils.make_grid(
+        residuals_s, nrow=8, value_range=(-1, 1), normalize=True,
+        pad_value=1.0)
+    output_grid = vutils.make_grid(
+        outputs_s, nrow=8, value_range=(0, 1), normalize=True,
+        pad_value=1.0)
+    target_grid = vutils.make_grid(
+        targets_s, nrow=8, value_range=(0, 1), normalize=True,
+        pad_value=1.0)
+    diff_grid = vutils.make_grid(
+        torch.abs(targets_s - outputs_s),
+        nrow=8, value_range=(0, 1), normalize=True,
+        pad_value=1.0)
+    writer.add_image(phase + '/input', input_grid, epoch)
+    writer.add_image(phase + '/residual', residual_grid, epoch)
+    writer.add_image(phase + '/output', output_grid, epoch)
+    writer.add_image(phase + '/target', target_grid, epoch)
+    writer.add_image(phase + '/difference', diff_grid, epoch)
+
+
+class ImageGridLogger(object):
+    """Queues light field snapshots which a thread writes as image grids"""
+
+    def __init__(self, writer, downsample=1, max_queue=4):
+        """
+        Keyword arguments:
+        writer -- the tensorboard SummaryWriter to write to
+        downsample -- keep every downsample-th pixel of each view
+        max_queue -- the number of snapshots to hold before log blocks
+        """
+        self.writer = writer
+        self.downsample = downsample
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, phase, epoch, batch):
+        """
+        Snapshots the first light field of a batch of remapped
+        inputs, residuals, outputs, targets and shape for writing
+        """
+        self.raise_error()
+        if not batch:
+            return
+        desired_shape = [int(shape[0]) for shape in batch['shape']]
+        snapshot = {}
+        for key in 'inputs', 'residuals', 'outputs', 'targets':
+            image = batch[key][0].detach()
+            image = downsample_remapped(
+                image, desired_shape[0], self.downsample)
+            snapshot[key] = image.to('cpu', torch.float32, copy=True)
+        desired_shape[-2] = snapshot['inputs'].shape[-2] // (
+            grid_width(desired_shape[0]))
+        desired_shape[-1] = snapshot['inputs'].shape[-1] // (
+            grid_width(desired_shape[0]))
+        snapshot['shape'] = desired_shape
+        self.queue.put((phase, epoch, snapshot))
+
+    def run(self):
+        """
+        Writes queued snapshots until a None is received, keeping the
+        first error and skipping the snapshots after it
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    write_image_grids(self.writer, *item)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        """Raises the error of the writing thread, if it had one"""
+        if self.error is not None:
+            raise RuntimeError("Failed to log images") from self.error
+
+    def flush(self):
+        """Blocks until every queued snapshot has been written"""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """Writes any queued snapshots and stops the thread"""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -0,0 +1,110 @@
+"""
+A cache of decoded uint8 light fields shared by all DataLoader workers
+
+Entries are stored as .npy files in a tmpfs directory (/dev/shm by default)
+so any process can read them with a memcpy instead of decompressing
+the hdf5 chunks again. When the byte budget is exceeded the least
+recently used entries are removed. See Scripts/list_shared_mem.sh
+to watch the usage.
+"""
+import atexit
+import fcntl
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class SharedLFCache(object):
+    """A byte limited LRU cache of numpy arrays in shared memory"""
+
+    def __init__(self, max_bytes, base_dir='/dev/shm', name=None):
+        """
+        Keyword arguments:
+        max_bytes -- the maximum number of bytes of arrays to keep
+        base_dir -- a directory on a tmpfs to store the cache in
+        name -- the sub directory name, a unique one is made if None
+        """
+        self.max_bytes = max_bytes
+        if name is None:
+            self.cache_dir = tempfile.mkdtemp(
+                prefix='lf_cache_', dir=base_dir)
+        else:
+            self.cache_dir = os.path.join(base_dir, name)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.cache_dir, '.lock')
+        self.owner_pid = os.getpid()
+        atexit.register(self.remove)
+
+    def path_for(self, key):
+        """Returns the file location of the entry named key"""
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """Returns a copy of the array stored at key, or None if missing"""
+        location = self.path_for(key)
+        try:
+            array = np.load(location)
+            # Mark the entry as most recently used
+            os.utime(location)
+        except (FileNotFoundError, ValueError, OSError):
+            # Evicted by another worker or partially removed
+            return None
+        return array
+
+    def put(self, key, array):
+        """Stores array at key, evicting the least recently used entries"""
+        if array.nbytes > self.max_bytes:
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.evict(self.max_bytes - array.nbytes)
+                handle, tmp_location = tempfile.mkstemp(
+                    dir=self.cache_dir, suffix='.tmp')
+                with os.fdopen(handle, 'wb') as tmp_file:
+                    np.save(tmp_file, array)
+                os.replace(tmp_location, self.path_for(key))
+            except OSError as err:
+                # Out of shared memory, the cache is only an optimisation
+                print("Could not cache light field {}: {}".format(key, err))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self, target_bytes):
+        """Removes the oldest entries until at most target_bytes are used"""
+        entries = []
+        used_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            used_bytes += stat.st_size
+        entries.sort()
+        for _, size, location in entries:
+            if used_bytes <= target_bytes:
+                break
+            try:
+                os.remove(location)
+            except FileNotFoundError:
+                pass
+            used_bytes -= size
+
+    def remove(self):
+        """Deletes the cache directory, only done by the creating process"""
+        if os.getpid() == self.owner_pid:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def create_cache_from_config(config):
+    """Returns a SharedLFCache if shm_cache is True in config, else None"""
+    if config['NETWORK'].get('shm_cache', 'False') != 'True':
+        return None
+    max_bytes = int(config['NETWORK'].get('shm_cache_bytes', 2 ** 32))
+    base_dir = config['NETWORK'].get('shm_cache_dir', '/dev/shm')
+    cache = SharedLFCache(max_bytes, base_dir)
+    print("Caching decoded light fields in {} up to {} bytes".format(
+        cache.cache_dir, max_bytes))
+    return cache
@@ -0,0 +1,113 @@
+"""
+PSNR and SSIM of whole batches of views at once with torch
+
+Matches evaluate.my_psnr and evaluate.ssim, which run one view at a time
+through numpy and skimage, on an N, C, H, W batch such as the 64 views
+of a light field. SSIM uses Wang's settings as evaluate.ssim asks of
+skimage: an 11 tap Gaussian window of sigma 1.5, population covariance,
+K1 0.01 and K2 0.03, averaged over the channels and over the pixels at
+least the window radius from the border, as skimage crops the rest.
+Those pixels see no padding, so the Gaussian is run separably without
+padding, as sums of shifted slices, over all five moments of every
+channel at once. On the CPU this is several times faster than conv2d,
+which copies each image out once per tap.
+"""
+import numpy as np
+import torch
+
+
+def as_batch(images, dtype):
+    """Returns numpy or torch N, C, H, W images as a tensor of dtype"""
+    if isinstance(images, np.ndarray):
+        images = torch.from_numpy(images)
+    return images.to(dtype)
+
+
+def gaussian_window(sigma=1.5, truncate=3.5):
+    """
+    Returns the normalised 1D Gaussian weights
+    scipy.ndimage.gaussian_filter uses, as a list
+    """
+    radius = int(truncate * sigma + 0.5)
+    offsets = np.arange(-radius, radius + 1)
+    window = np.exp(-0.5 * (offsets / sigma) ** 2)
+    return (window / window.sum()).tolist()
+
+
+def filter_valid(images, window, dim):
+    """Returns images filtered by window along dim, without padding"""
+    size = images.shape[dim] - len(window) + 1
+    filtered = images.narrow(dim, 0, size) * window[0]
+    for i in range(1, len(window)):
+        filtered.add_(images.narrow(dim, i, size), alpha=window[i])
+    return filtered
+
+
+def psnr(img1, img2, data_range=255.0, equal_value=100.0,
+         dtype=torch.float64):
+    """
+    Returns the PSNR of each of a batch of N, C, H, W images as a tensor
+    of N, equal_value where the images are the same, 100 as
+    evaluate.my_psnr gives or math.inf as evaluate.psnr gives
+    """
+    diff = as_batch(img1, dtype) - as_batch(img2, dtype)
+    mse = diff.pow(2).flatten(1).mean(dim=1)
+    values = 10 * torch.log10(data_range ** 2 / mse)
+    return torch.where(
+        mse == 0, torch.full_like(values, equal_value), values)
+
+
+def ssim(img1, img2, data_range=255.0, sigma=1.5, chunk=None,
+         dtype=torch.float32):
+    """
+    Returns the SSIM of each of a batch of N, C, H, W images as a tensor
+    of N, as evaluate.ssim gives for each H, W, C image
+
+    Keyword arguments:
+    data_range -- the difference between the largest and smallest values
+    sigma -- the standard deviation of the Gaussian window
+    chunk -- images to filter at once, default the whole batch on the GPU
+             and one image on the CPU, where its moments stay in cache
+    dtype -- float32 is within 1e-6 of skimage, float64 within rounding
+    """
+    window = gaussian_window(sigma)
+    pad = (len(window) - 1) // 2
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    if chunk is None:
+        chunk = len(img1) if getattr(img1, 'is_cuda', False) else 1
+
+    results = []
+    for start in range(0, len(img1), chunk):
+        x = as_batch(img1[start:start + chunk], dtype)
+        y = as_batch(img2[start:start + chunk], dtype)
+        if min(x.shape[2:]) <= 2 * pad:
+            raise ValueError(
+                "Images of {}x{} are smaller than the SSIM window".format(
+                    *x.shape[2:]))
+        # The variances are differences of large moments, so centre
+        # each channel first to keep them accurate in float32
+        shift = (x.mean(dim=(2, 3), keepdim=True) +
+                 y.mean(dim=(2, 3), keepdim=True)) / 2
+        x, y = x - shift, y - shift
+        moments = torch.stack((x, y, x * x, y * y, x * y), dim=1)
+        moments = filter_valid(filter_valid(moments, window, 3), window, 4)
+        mu_x, mu_y, xx, yy, xy = moments.unbind(1)
+        var_x = xx - mu_x * mu_x
+        var_y = yy - mu_y * mu_y
+        cov_xy = xy - mu_x * mu_y
+        mu_x, mu_y = mu_x + shift, mu_y + shift
+        ssim_map = (
+            (2 * mu_x * mu_y + c1) * (2 * cov_xy + c2) /
+            ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)))
+        results.append(ssim_map.flatten(1).mean(dim=1))
+    return torch.cat(results)
+
+
+def view_metrics(img1, img2, equal_psnr=100.0, dtype=torch.float32):
+    """
+    Returns lists of the PSNR and SSIM of each view of two N, C, H, W
+    light fields in 0 to 255, with SSIM computed in dtype
+    """
+    return (psnr(img1, img2, equal_value=equal_psnr).tolist(),
+            ssim(img1, img2, dtype=dtype).tolist())
@@ -0,0 +1,165 @@
+"""
+A store of per view PSNR and SSIM in an SQLite file next to the data
+
+Values are keyed by a fingerprint of the content they were computed
+from and a model key, the hash of the checkpoint whose outputs were
+compared, or "" for comparisons of stored data such as warped against
+images, so re-runs only compute what is missing. Sources, such as a
+sample of an hdf5 group, also map to their last fingerprint along with
+the size and modification time of the data file, so while that is
+unchanged a stored sample is found without reading its data.
+PSNR is stored as evaluate.psnr gives it, infinite for identical views.
+The store sits next to the data file, or in the user cache directory
+if that is not writable, such as on a shared read only data drive.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import lf_metrics
+
+
+def fingerprint(*arrays):
+    """Returns a hex digest of the shapes, types and contents of arrays"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def file_hash(path, block_size=1 << 20):
+    """Returns a hex sha1 digest of the file at path, such as a checkpoint"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as checkpoint:
+        for block in iter(lambda: checkpoint.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_location(data_path):
+    """
+    Returns data_path.metrics.sqlite if it can be written, otherwise
+    a file named for data_path in the user cache directory
+    """
+    location = data_path + ".metrics.sqlite"
+    directory = os.path.dirname(os.path.abspath(data_path))
+    # SQLite writes journal files next to the store
+    if os.access(directory, os.W_OK) and (
+            not os.path.exists(location) or os.access(location, os.W_OK)):
+        return location
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'DepthLFSynthesis', 'metrics')
+    os.makedirs(cache_dir, exist_ok=True)
+    path_hash = hashlib.sha1(
+        os.path.abspath(data_path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}_{}.metrics.sqlite".format(
+        os.path.basename(data_path), path_hash))
+
+
+def file_stamp(path):
+    """Returns a string of the size and modification time of path"""
+    stat = os.stat(path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+class MetricCache(object):
+    """Per view PSNR and SSIM stored in SQLite, safe to share by threads"""
+
+    def __init__(self, data_path, location=None):
+        """
+        Keyword arguments:
+        data_path -- the data file the values are computed from
+        location -- the SQLite file, default from default_location
+        """
+        self.location = location or default_location(data_path)
+        self.stamp = file_stamp(data_path)
+        self.lock = threading.Lock()
+        # Worker processes may write at once, so wait out their locks
+        self.connection = sqlite3.connect(
+            self.location, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS views ("
+                "fingerprint TEXT, model TEXT, view INTEGER, "
+                "psnr REAL, ssim REAL, "
+                "PRIMARY KEY (fingerprint, model, view))")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                "source TEXT, model TEXT, stamp TEXT, fingerprint TEXT, "
+                "PRIMARY KEY (source, model))")
+
+    def get(self, fingerprint, model=''):
+        """
+        Returns lists of the psnr and ssim of each view stored
+        for fingerprint and model, or None if there are none
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT psnr, ssim FROM views WHERE fingerprint = ? "
+                "AND model = ? ORDER BY view", (fingerprint, model)).fetchall()
+        if not rows:
+            return None
+        psnrs, ssims = zip(*rows)
+        return list(psnrs), list(ssims)
+
+    def put(self, fingerprint, psnrs, ssims, model=''):
+        """Stores the psnr and ssim of each view for fingerprint and model"""
+        rows = [(fingerprint, model, view, psnr, ssim)
+                for view, (psnr, ssim) in enumerate(zip(psnrs, ssims))]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO views VALUES (?, ?, ?, ?, ?)", rows)
+
+    def lookup(self, source, model=''):
+        """
+        Returns the values stored for source as get does, or None if
+        there are none or the data file has changed since they were
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT fingerprint FROM sources WHERE source = ? "
+                "AND model = ? AND stamp = ?",
+                (source, model, self.stamp)).fetchone()
+        if row is None:
+            return None
+        return self.get(row[0], model)
+
+    def set_source(self, source, fingerprint, model=''):
+        """Records that source currently has the content of fingerprint"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (source, model, self.stamp, fingerprint))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def with_equal_psnr(values, equal_psnr):
+    """Returns stored psnrs and ssims with equal_psnr for identical views"""
+    psnrs, ssims = values
+    return [equal_psnr if math.isinf(psnr) else psnr
+            for psnr in psnrs], ssims
+
+
+def cached_view_metrics(cache, key, img1, img2, model='', equal_psnr=100.0):
+    """
+    Returns lf_metrics.view_metrics of img1 and img2, taken from cache
+    under the fingerprint key and model when stored there, otherwise
+    computed and stored, or only computed if cache is None
+    """
+    values = None if cache is None else cache.get(key, model)
+    if values is None:
+        values = lf_metrics.view_metrics(img1, img2, equal_psnr=math.inf)
+        if cache is not None:
+            cache.put(key, *values, model=model)
+    return with_equal_psnr(values, equal_psnr)
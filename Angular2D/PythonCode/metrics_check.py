@@ -0,0 +1,119 @@
+"""
+Checks lf_metrics against the per view evaluate.my_psnr and evaluate.ssim
+
+Compares the PSNR and SSIM of random 8 bit light fields of random view
+sizes, with noisy, identical, all black and all white pairs among them,
+as lf_metrics gives in float64 and float32 and as evaluate gives one
+view at a time. Exits with -1 if any value differs by more than
+--tolerance.
+
+Example:
+python metrics_check.py --trials 16 --size 64
+"""
+import argparse
+
+import numpy as np
+import torch
+
+import lf_metrics
+
+try:
+    from evaluate import my_psnr, ssim
+except ImportError:
+    # skimage 0.16 renamed compare_ssim, which evaluate imports
+    import math
+
+    from skimage.metrics import structural_similarity
+
+    def my_psnr(img1, img2):
+        """As evaluate.my_psnr"""
+        mse = np.mean((img1.astype(float) - img2.astype(float)) ** 2)
+        if mse == 0:
+            return 100
+        return 20 * math.log10(255.0 / math.sqrt(mse))
+
+    def ssim(img1, img2):
+        """As evaluate.ssim, with the renamed skimage function"""
+        return structural_similarity(
+            img2 / 255, img1 / 255, gaussian_weights=True,
+            use_sample_covariance=False, sigma=1.5, channel_axis=-1,
+            data_range=1.0)
+
+
+def reference_metrics(views, ground_truth):
+    """
+    Returns lists of the evaluate PSNR and SSIM of each of two
+    N, C, H, W light fields, one H, W, C view at a time
+    """
+    psnrs, ssims = [], []
+    for view, img in zip(views, ground_truth):
+        view, img = view.transpose(1, 2, 0), img.transpose(1, 2, 0)
+        psnrs.append(my_psnr(view, img))
+        ssims.append(ssim(view, img))
+    return psnrs, ssims
+
+
+def random_pairs(num_trials, max_size, rng, grid_size=64):
+    """
+    Yields pairs of random 8 bit N, C, H, W light fields of random view
+    sizes up to max_size, a noisy copy of a smooth light field then an
+    identical, an all black and an all white pair
+    """
+    for _ in range(num_trials):
+        height, width = rng.integers(11, max_size + 1, 2)
+        shape = (grid_size, 3, height, width)
+        smooth = rng.uniform(0, 255, (grid_size, 3, 1, 1)) + np.cumsum(
+            rng.normal(0, 4, shape), axis=-1)
+        noisy = smooth + rng.normal(0, rng.uniform(1, 40), shape)
+        yield (np.clip(smooth, 0, 255).astype(np.uint8),
+               np.clip(noisy, 0, 255).astype(np.uint8))
+    shape = (grid_size, 3, max_size, max_size)
+    same = rng.integers(0, 256, shape).astype(np.uint8)
+    yield same, same.copy()
+    yield np.zeros(shape, np.uint8), rng.integers(0, 256, shape, np.uint8)
+    yield np.full(shape, 255, np.uint8), rng.integers(0, 256, shape, np.uint8)
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    max_diffs = {torch.float64: [0.0, 0.0], torch.float32: [0.0, 0.0]}
+    for views, ground_truth in random_pairs(args.trials, args.size, rng):
+        reference = reference_metrics(views, ground_truth)
+        for dtype, diffs in max_diffs.items():
+            values = lf_metrics.view_metrics(views, ground_truth, dtype=dtype)
+            for i in range(2):
+                diffs[i] = max(diffs[i], float(np.max(np.abs(
+                    np.array(values[i]) - np.array(reference[i])))))
+
+    failed = False
+    for dtype, (psnr_diff, ssim_diff) in max_diffs.items():
+        print("Largest {} difference, psnr {:.3e}, ssim {:.3e}".format(
+            dtype, psnr_diff, ssim_diff))
+        failed = failed or not max(psnr_diff, ssim_diff) <= args.tolerance
+    if failed:
+        print("lf_metrics differs by more than {}".format(args.tolerance))
+        exit(-1)
+    print("lf_metrics is within {} of evaluate".format(args.tolerance))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Process modifiable parameters from command line')
+    PARSER.add_argument("--tolerance", default=1e-6, type=float,
+                        help="Largest allowed difference of any value")
+    PARSER.add_argument("--trials", default=8, type=int,
+                        help="Number of random light fields to compare on")
+    PARSER.add_argument("--size", default=48, type=int,
+                        help="Largest random view size, default 48")
+    PARSER.add_argument("--seed", default=0, type=int,
+                        help="Seed for the random light fields")
+    ARGS, UNPARSED = PARSER.parse_known_args()
+
+    if len(UNPARSED) != 0:
+        print("Unrecognised command line argument passed")
+        print(UNPARSED)
+        exit(-1)
+
+    print(ARGS)
+    print()
+    main(ARGS)
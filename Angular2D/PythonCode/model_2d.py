@@ -1,3 +1,6 @@
+import copy
+
+import torch
 import torch.nn as nn
 import common
 
@@ -87,4 +90,85 @@ class C2D(nn.Module):
             for name, param in self.named_parameters():
                 if name.find('body') is not -1:
                     param.requires_grad = False
-        
\ No newline at end of file
+        
+class FoldedC2D(nn.Module):
+    """
+    C2D for deployment, with the MeanShifts and res_scale folded into
+    the convolutions, see fold_c2d
+    """
+    def __init__(self, pad_mean, head, body, tail, add_mean):
+        super(FoldedC2D, self).__init__()
+        self.pad_mean = pad_mean
+        self.head = head
+        self.body = body
+        self.tail = tail
+        self.add_mean = add_mean
+
+    def forward(self, x):
+        x = self.pad_mean(x)
+        x = self.head(x)
+
+        res = self.body(x)
+        res += x
+
+        x = self.tail(res)
+        x = self.add_mean(x)
+
+        return x
+
+    def load_state_dict(self, state_dict, freeze=False, first=False):
+        # All the folded weights belong together, so always load them all
+        return super(FoldedC2D, self).load_state_dict(state_dict)
+
+def copy_conv(conv, weight=None, bias=None, padding=None):
+    """Returns a copy of conv with optionally new weight, bias or padding"""
+    folded = nn.Conv2d(
+        weight.shape[1] if weight is not None else conv.in_channels,
+        conv.out_channels, conv.kernel_size,
+        padding=conv.padding if padding is None else padding)
+    folded.weight.data.copy_(conv.weight.data if weight is None else weight)
+    folded.bias.data.copy_(conv.bias.data if bias is None else bias)
+    return folded.to(conv.weight.device)
+
+def fold_c2d(model):
+    """
+    Returns a FoldedC2D computing the same function as the C2D model
+
+    sub_mean is folded into the head conv, with the input padded by the
+    value sub_mean maps to zero so the borders match the zero padding.
+    add_mean follows the Tanh, so it can not fold into the tail conv and
+    becomes a per channel scale and shift instead of a 1x1 conv.
+    res_scale is folded into the last conv of each ResBlock.
+    """
+    with torch.no_grad():
+        shift = model.sub_mean.weight[:, :, 0, 0]
+        head = model.head[0]
+        weight = torch.einsum('ocij,cd->odij', head.weight, shift)
+        bias = head.bias + torch.einsum(
+            'ocij,c->o', head.weight, model.sub_mean.bias)
+        pad_value = torch.linalg.solve(shift, -model.sub_mean.bias)
+        pad_mean = common.MeanPad(pad_value, head.padding[0])
+        folded_head = nn.Sequential(
+            copy_conv(head, weight, bias, padding=0))
+
+        body = []
+        for block in model.body:
+            if not isinstance(block, common.ResBlock):
+                body.append(copy.deepcopy(block))
+                continue
+            layers = [copy.deepcopy(layer) for layer in block.body]
+            last = layers[-1]
+            layers[-1] = copy_conv(
+                last, last.weight * block.res_scale,
+                last.bias * block.res_scale)
+            body.append(common.PlainResBlock(nn.Sequential(*layers)))
+
+        scale = model.add_mean.weight[:, :, 0, 0]
+        if not torch.equal(scale, torch.diag(torch.diagonal(scale))):
+            raise ValueError("add_mean is not a per channel shift")
+        add_mean = common.ChannelAffine(
+            torch.diagonal(scale), model.add_mean.bias)
+
+    return FoldedC2D(
+        pad_mean, folded_head, nn.Sequential(*body),
+        copy.deepcopy(model.tail), add_mean)
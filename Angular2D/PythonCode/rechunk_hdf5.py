@@ -0,0 +1,199 @@
+"""
+Rewrites a light field hdf5 file into a chunk layout suited to training
+
+The capture scripts store one chunk per view, (1, 1, C, H, W), which is
+ideal for writing from Inviwo but means a random patch read decodes every
+full view. Tiling spatially across all views reads only the chunks
+overlapping the patch. Each candidate layout is written to its own file
+and timed with the TrainFromHdf5 access pattern.
+With --remap, remapped_images and remapped_warped are also written in the
+interleaved layout of data_transform.create_remap, which the loaders
+then crop from directly.
+
+Example:
+python rechunk_hdf5.py --loc in.h5 --out out.h5 \
+    --layout 64,3,64,64:lzf --layout 64,3,128,128:gzip4
+"""
+import argparse
+import os
+import random
+import time
+
+import h5py
+import torch
+
+import data_loading
+import data_transform
+
+# The datasets which hold N, V, C, H, W light fields
+LF_DATASETS = ('images', 'warped')
+
+
+def parse_layout(layout):
+    """
+    Parses views,channels,height,width:codec into a chunk shape
+    and h5py compression keyword arguments
+    codec is one of none, lzf or gzipN where N is a level from 0 to 9
+    """
+    chunk_str, _, codec = layout.partition(':')
+    chunks = tuple(int(val) for val in chunk_str.split(','))
+    if len(chunks) != 4:
+        raise ValueError(
+            "Layout {} should give views,channels,height,width".format(
+                layout))
+    codec = codec or 'lzf'
+    if codec == 'none':
+        compression = {}
+    elif codec == 'lzf':
+        compression = {'compression': 'lzf', 'shuffle': True}
+    elif codec.startswith('gzip'):
+        level = int(codec[4:] or 4)
+        compression = {
+            'compression': 'gzip', 'compression_opts': level,
+            'shuffle': True}
+    else:
+        raise ValueError("Unknown codec {}".format(codec))
+    return chunks, compression
+
+
+def layout_name(layout):
+    """Returns a file name safe version of a layout string"""
+    return layout.replace(',', 'x').replace(':', '_')
+
+
+def copy_attrs(src, dst):
+    """Copies every hdf5 attribute from src to dst"""
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+
+
+def rechunk_dataset(src, dst_group, chunks, compression):
+    """
+    Writes the N, V, C, H, W dataset src to dst_group one sample at a time
+    """
+    chunks = (1,) + tuple(
+        min(size, dim) for size, dim in zip(chunks, src.shape[1:]))
+    dst = dst_group.create_dataset(
+        os.path.basename(src.name), src.shape, src.dtype,
+        chunks=chunks, **compression)
+    copy_attrs(src, dst)
+    for idx in range(src.shape[0]):
+        dst[idx] = src[idx]
+    return dst
+
+
+def remap_dataset(src, dst_group, chunks, compression):
+    """
+    Writes the N, V, C, H, W dataset src to dst_group as remapped_name
+    of shape N, C, H * sqrt(V), W * sqrt(V), tiled like chunks
+    """
+    num, views, channels, height, width = src.shape
+    one_way = data_transform.grid_width(views)
+    shape = (num, channels, height * one_way, width * one_way)
+    # A tile of h by w pixels in every view is h * grid by w * grid here
+    remap_chunks = (
+        1, min(chunks[1], channels),
+        min(chunks[2], height) * one_way, min(chunks[3], width) * one_way)
+    dst = dst_group.create_dataset(
+        'remapped_' + os.path.basename(src.name), shape, src.dtype,
+        chunks=remap_chunks, **compression)
+    for idx in range(num):
+        dst[idx] = data_transform.create_remap(
+            torch.from_numpy(src[idx])).numpy()
+    return dst
+
+
+def copy_group(src, dst, chunks, compression, remap=False):
+    """Recursively copies src to dst, rechunking the light field datasets"""
+    copy_attrs(src, dst)
+    for name, item in src.items():
+        if isinstance(item, h5py.Group):
+            copy_group(
+                item, dst.create_group(name), chunks, compression, remap)
+        elif name in LF_DATASETS and len(item.shape) == 5:
+            rechunk_dataset(item, dst, chunks, compression)
+            if remap and 'remapped_' + name not in src:
+                remap_dataset(item, dst, chunks, compression)
+        else:
+            src.copy(item, dst, name=name)
+
+
+def rechunk(in_location, out_location, layout, remap=False):
+    """Writes in_location to out_location using layout"""
+    chunks, compression = parse_layout(layout)
+    start_time = time.time()
+    with h5py.File(in_location, mode='r', libver='latest') as src:
+        with h5py.File(out_location, mode='w', libver='latest') as dst:
+            copy_group(src, dst, chunks, compression, remap)
+    print("Wrote {} with layout {} in {:.1f}s, size {:.1f}MB".format(
+        out_location, layout, time.time() - start_time,
+        os.path.getsize(out_location) / 1e6))
+
+
+def time_train_reads(location, patch_size, num_crops, num_items):
+    """Returns items per second and MB per second of TrainFromHdf5 reads"""
+    train_set = data_loading.TrainFromHdf5(
+        file_path=location, patch_size=patch_size,
+        num_crops=num_crops, fixed_seed=True)
+    indices = [random.randrange(len(train_set)) for _ in range(num_items)]
+    num_bytes = 0
+    start_time = time.time()
+    for index in indices:
+        sample = train_set[index]
+        num_bytes += sum(
+            value.numel() for value in sample.values()
+            if torch.is_tensor(value))
+    time_taken = time.time() - start_time
+    data_loading.close_h5_files()
+    return num_items / time_taken, num_bytes / time_taken / 1e6
+
+
+def main(args):
+    if args.loc is None or args.out is None:
+        print("Please enter an input and output path through --loc and --out")
+        exit(-1)
+    layouts = args.layout or ['64,3,64,64:lzf']
+    results = []
+    if not args.no_bench:
+        results.append(('original', time_train_reads(
+            args.loc, args.patch_size, args.num_crops, args.n)))
+    for layout in layouts:
+        if len(layouts) == 1:
+            out_location = args.out
+        else:
+            stem, ext = os.path.splitext(args.out)
+            out_location = "{}_{}{}".format(stem, layout_name(layout), ext)
+        rechunk(args.loc, out_location, layout, args.remap)
+        if not args.no_bench:
+            results.append((layout, time_train_reads(
+                out_location, args.patch_size, args.num_crops, args.n)))
+
+    if results:
+        print("\nTrainFromHdf5 reads with patch size {}".format(
+            args.patch_size))
+        for layout, (item_rate, byte_rate) in results:
+            print("{:>24}: {:.2f} items/s, {:.1f} MB/s of uint8".format(
+                layout, item_rate, byte_rate))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="modifiable params")
+    PARSER.add_argument("--loc", type=str, default=None,
+                        help="hdf5 path to rechunk")
+    PARSER.add_argument("--out", type=str, default=None,
+                        help="hdf5 path to write, suffixed per layout")
+    PARSER.add_argument("--layout", action="append", default=None,
+                        help="views,channels,height,width:codec chunk " +
+                        "layout, codec is none, lzf or gzip0-9. Repeatable")
+    PARSER.add_argument("--patch_size", type=int, default=128,
+                        help="Training patch size to time reads with")
+    PARSER.add_argument("--num_crops", type=int, default=4,
+                        help="Training crops per light field")
+    PARSER.add_argument("--n", type=int, default=64,
+                        help="Number of training items to time")
+    PARSER.add_argument("--remap", action="store_true",
+                        help="Also write angular remapped datasets")
+    PARSER.add_argument("--no_bench", action="store_true",
+                        help="Only rewrite the file, do not time reads")
+    ARGS, _ = PARSER.parse_known_args()
+    main(ARGS)
@@ -0,0 +1,188 @@
+"""
+Checks that resuming training from a mid epoch checkpoint is bit exact
+
+Trains a small model on a tiny synthetic light field file three times:
+straight through, interrupted just after a resume checkpoint is written,
+and resumed from that checkpoint with a different seed.
+The resumed run must end with exactly the same weights and losses.
+
+Example:
+python resume_check.py --workers 2 --group_crops --uint8_workers
+"""
+import argparse
+import configparser
+import math
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from tensorboardX import SummaryWriter
+
+import cnn_main
+import data_transform
+import helpers
+import train_state
+from checkpoint_writer import CheckpointWriter
+from data_loading import create_dataloaders, close_h5_files
+from full_model import setup_model
+from train_state import TrainProgress
+
+
+class Interrupted(Exception):
+    """Raised to stop training as if the process had been killed"""
+
+
+def create_config(args, work_dir):
+    """Returns a config for the synthetic file written to work_dir"""
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'PATH': {
+            'hdf5_dir': work_dir, 'hdf5_name': 'synthetic.h5',
+            'checkpoint_dir': work_dir, 'model_dir': work_dir},
+        'NETWORK': {
+            'cuda': 'False', 'gpu_id': '0',
+            'patch_size': '8', 'val_patch_size': '8', 'num_crops': '4',
+            'train_batch_size': '4', 'val_batch_size': '2',
+            'num_workers': str(args.workers),
+            'sub_chan': 'False', 'crop_train': 'True', 'val_reduce': 'True',
+            'group_crops': str(args.group_crops),
+            'shuffle_buffer': '8',
+            'uint8_workers': str(args.uint8_workers),
+            'in_memory_val': str(args.in_memory_val)},
+        'VALSETS': {'val': 'val'}})
+    return config
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run(args, config, work_dir, seed, stop_at=None, resume=False):
+    """
+    Trains for args.nEpochs, writing a resume checkpoint every batch
+    stop_at -- an (epoch, step) to raise Interrupted at after saving
+    resume -- continue from the resume checkpoint in work_dir
+    Returns the final state dict and the loss of each epoch trained
+    """
+    data_loaders = create_dataloaders(args, config)
+    # Creating the datasets reseeds python random from the system
+    seed_all(seed)
+    for val_set in train_state.val_crop_sets(data_loaders).values():
+        val_set.crop_cords = data_transform.create_random_coords(
+            val_set.im_size, val_set.num_samples, val_set.patch_size)
+    model, criterion, optimizer, lr_scheduler = setup_model(args)
+    checkpointer = CheckpointWriter(model)
+    progress = TrainProgress(save_every=1)
+    resume_location = os.path.join(work_dir, "resume.pth")
+    best_loss, best_epoch, best_state = math.inf, None, None
+    start_epoch = 0
+    if resume:
+        best_loss, best_epoch, best_state = train_state.restore(
+            train_state.load_resume_state(resume_location), model,
+            optimizer, lr_scheduler, progress, data_loaders)
+        start_epoch = progress.epoch
+
+    def save_progress():
+        checkpointer.save(
+            progress.epoch, optimizer, best_loss, work_dir, "resume.pth",
+            model=model, rotate=False,
+            extra=train_state.resume_extras(
+                lr_scheduler, progress, best_epoch, best_state,
+                data_loaders))
+        if (progress.epoch, progress.step) == stop_at:
+            checkpointer.close()
+            raise Interrupted()
+    progress.save_fn = save_progress
+
+    writer = SummaryWriter(log_dir=os.path.join(work_dir, 'runs'))
+    losses = []
+    try:
+        for epoch in range(start_epoch, args.nEpochs):
+            epoch_loss_all = cnn_main.train(
+                model=model, dset_loaders=data_loaders,
+                optimizer=optimizer, lr_scheduler=lr_scheduler,
+                criterion=criterion, epoch=epoch, cuda=False,
+                clip=args.clip, writer=writer, progress=progress,
+                accumulate_steps=args.accumulate_steps)
+            epoch_loss = sum(epoch_loss_all) / len(epoch_loss_all)
+            losses.append(epoch_loss)
+            if epoch_loss < best_loss:
+                best_loss = epoch_loss
+                best_epoch = epoch
+                best_state = checkpointer.snapshot(model)
+            lr_scheduler = cnn_main.restart_lr_scheduler(
+                lr_scheduler, optimizer, args.lr)
+            progress.end_epoch()
+            save_progress()
+        checkpointer.close()
+    finally:
+        writer.close()
+        close_h5_files()
+    return model.state_dict(), losses
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix='resume_check_')
+    helpers.write_synthetic_hdf5(os.path.join(work_dir, 'synthetic.h5'))
+    config = create_config(args, work_dir)
+    stop_at = (args.stop_epoch, args.stop_step)
+
+    print("Training straight through")
+    full_state, full_losses = run(args, config, work_dir, seed=0)
+    print("Training until epoch {} batch {}".format(*stop_at))
+    try:
+        run(args, config, work_dir, seed=0, stop_at=stop_at)
+        print("Training finished before epoch {} batch {}".format(*stop_at))
+        exit(-1)
+    except Interrupted:
+        pass
+    print("Resuming with a different seed")
+    resumed_state, resumed_losses = run(
+        args, config, work_dir, seed=1, resume=True)
+
+    mismatched = [
+        name for name, value in full_state.items()
+        if not torch.equal(value, resumed_state[name])]
+    expected_losses = full_losses[args.stop_epoch:]
+    if mismatched or resumed_losses != expected_losses:
+        print("Resumed training differs from uninterrupted training")
+        print("Mismatched parameters: {}".format(mismatched))
+        print("Losses {} against {}".format(resumed_losses, expected_losses))
+        exit(-1)
+    print("Resumed training matches uninterrupted training exactly")
+    print("Epoch losses {}".format(resumed_losses))
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="modifiable params")
+    PARSER.add_argument("--nEpochs", "--n", type=int, default=3,
+                        help="Number of epochs to train for")
+    PARSER.add_argument("--stop_epoch", type=int, default=1,
+                        help="Epoch to interrupt training in")
+    PARSER.add_argument("--stop_step", type=int, default=2,
+                        help="Batches trained in stop_epoch at interruption")
+    PARSER.add_argument("--workers", type=int, default=0,
+                        help="Number of DataLoader workers")
+    PARSER.add_argument("--group_crops", action="store_true",
+                        help="Use the shuffle buffer grouped crop loader")
+    PARSER.add_argument("--uint8_workers", action="store_true",
+                        help="Remap and gamma correct whole batches")
+    PARSER.add_argument("--in_memory_val", action="store_true",
+                        help="Hold the validation set in memory")
+    PARSER.add_argument("--accumulate_steps", type=int, default=1,
+                        help="Batches to sum gradients over per step")
+    PARSER.add_argument("--lr", type=float, default=0.1)
+    PARSER.add_argument("--momentum", type=float, default=0.9)
+    PARSER.add_argument("--weight_decay", type=float, default=1e-4)
+    PARSER.add_argument("--clip", type=float, default=0.4)
+    PARSER.add_argument("--n_feats", type=int, default=8)
+    PARSER.add_argument("--n_resblocks", type=int, default=2)
+    PARSER.add_argument("--res_scale", type=float, default=1.0)
+    ARGS, _ = PARSER.parse_known_args()
+    main(ARGS)
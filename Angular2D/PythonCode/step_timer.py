@@ -0,0 +1,93 @@
+"""Times the parts of each training step, such as data wait and backward"""
+import json
+import os
+import time
+
+import torch
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return float('nan')
+    rank = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class StepTimer(object):
+    """
+    Records the time between successive calls to mark under each name
+
+    When disabled every method returns immediately, so the timer
+    can be left in the training loop at next to no cost
+    """
+
+    def __init__(self, enabled=False, cuda=False):
+        """
+        Keyword arguments:
+        enabled -- whether to record anything
+        cuda -- synchronise the GPU before each mark so the
+                time of queued kernels lands in the right phase
+        """
+        self.enabled = enabled
+        self.cuda = cuda
+        self.times = {}
+        self.history = []
+        self.last_time = None
+
+    def start(self):
+        """Begins timing from now, call before fetching the first batch"""
+        if not self.enabled:
+            return
+        self.last_time = time.perf_counter()
+
+    def mark(self, name):
+        """Records the time since the last mark or start under name"""
+        if not self.enabled:
+            return
+        if self.cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times.setdefault(name, []).append(now - self.last_time)
+        self.last_time = now
+
+    def summary(self):
+        """Returns {name: {p50, p95, mean, total, count}} in seconds"""
+        stats = {}
+        for name, values in self.times.items():
+            sorted_values = sorted(values)
+            stats[name] = {
+                'p50': percentile(sorted_values, 0.5),
+                'p95': percentile(sorted_values, 0.95),
+                'mean': sum(values) / len(values),
+                'total': sum(values),
+                'count': len(values)}
+        return stats
+
+    def end_phase(self, writer, phase, epoch):
+        """
+        Prints and writes the p50 and p95 of each part of the phase
+        to tensorboard, stores them for save and starts a new phase
+        """
+        if not self.enabled:
+            return
+        stats = self.summary()
+        print("Phase {} step timings (p50 / p95 ms):".format(phase))
+        for name, stat in stats.items():
+            print("    {:>16}: {:.2f} / {:.2f}".format(
+                name, stat['p50'] * 1000, stat['p95'] * 1000))
+            writer.add_scalar(
+                'timing/{}/{}_p50'.format(phase, name), stat['p50'], epoch)
+            writer.add_scalar(
+                'timing/{}/{}_p95'.format(phase, name), stat['p95'], epoch)
+        self.history.append({'epoch': epoch, 'phase': phase, 'stats': stats})
+        self.times = {}
+
+    def save(self, save_dir, name):
+        """Writes the timings of every phase so far as json to save_dir/name"""
+        if not self.enabled:
+            return
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        with open(os.path.join(save_dir, name), 'w') as json_file:
+            json.dump(self.history, json_file, indent=2)
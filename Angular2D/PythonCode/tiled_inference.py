@@ -0,0 +1,86 @@
+"""
+Tiled inference for remapped light fields too large to run at once
+
+The remapped image is split into tiles, and each tile is run with a halo
+of the model's receptive field radius around it. Every output pixel then
+sees the same inputs as in whole image inference, so the seams match up
+to floating point summation order. Windows at the image edge are shifted
+inwards rather than cut, so all windows have one size and batch
+together, and the zero padding at the image edge is unchanged.
+Peak activation memory is bounded by tile_batch windows of
+tile_size + 2 * halo pixels a side, rather than by the image size.
+"""
+import torch
+import torch.nn as nn
+
+
+def receptive_radius(model):
+    """
+    Returns how many pixels away an output of model can see,
+    for a model with all its convolutions in sequence, as C2D has
+    """
+    return sum(
+        module.dilation[0] * (module.kernel_size[0] - 1) // 2
+        for module in model.modules() if isinstance(module, nn.Conv2d))
+
+
+def tile_windows(size, tile_size, halo):
+    """
+    Returns the window size along a dimension of length size,
+    and a list of (window_start, tile_start, tile_end) for each tile,
+    with every window holding its tile and halo pixels either side,
+    unless that side is the image edge
+    """
+    window = min(size, tile_size + 2 * halo)
+    windows = []
+    for tile_start in range(0, size, tile_size):
+        tile_end = min(tile_start + tile_size, size)
+        window_start = min(max(tile_start - halo, 0), size - window)
+        windows.append((window_start, tile_start, tile_end))
+    return window, windows
+
+
+class TiledModel(nn.Module):
+    """Runs a model over tiles of its inputs, in batches of windows"""
+
+    def __init__(self, model, tile_size, tile_batch=1, halo=None):
+        """
+        Keyword arguments:
+        model -- the model to run, such as C2D or a wrapper of it
+        tile_size -- pixels a side of each tile of the remapped image
+        tile_batch -- number of windows to run the model on at once
+        halo -- pixels of context around each tile,
+                default the receptive field radius of model
+        """
+        super(TiledModel, self).__init__()
+        self.model = model
+        self.tile_size = tile_size
+        self.tile_batch = tile_batch
+        self.halo = receptive_radius(model) if halo is None else halo
+
+    def forward(self, inputs):
+        num, _, height, width = inputs.shape
+        window_h, rows = tile_windows(height, self.tile_size, self.halo)
+        window_w, cols = tile_windows(width, self.tile_size, self.halo)
+        if window_h == height and window_w == width:
+            return self.model(inputs)
+
+        tiles = [(n, row, col)
+                 for n in range(num) for row in rows for col in cols]
+        outputs = None
+        for start in range(0, len(tiles), self.tile_batch):
+            batch = tiles[start:start + self.tile_batch]
+            windows = torch.stack([
+                inputs[n, :, row[0]:row[0] + window_h,
+                       col[0]:col[0] + window_w]
+                for n, row, col in batch])
+            results = self.model(windows)
+            if outputs is None:
+                outputs = results.new_empty(
+                    (num, results.shape[1], height, width))
+            for result, (n, row, col) in zip(results, batch):
+                (row_start, top, bottom), (col_start, left, right) = row, col
+                outputs[n, :, top:bottom, left:right] = result[
+                    :, top - row_start:bottom - row_start,
+                    left - col_start:right - col_start]
+        return outputs
@@ -0,0 +1,164 @@
+"""
+Captures and restores everything needed to resume training mid epoch
+
+A resume checkpoint holds the usual model and optimizer state, the
+lr_scheduler state (including any doubled T_max), the best model so far,
+the number of batches trained in the epoch, the validation crops and the
+random number generator states at the start of the epoch. On resume the
+generators are restored and the already trained batches are drawn again
+but not trained on, so every crop, gamma and shuffle matches an
+uninterrupted run exactly, whichever loader and number of workers is used.
+"""
+import random
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    """Returns the python, numpy and torch random number generator states"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores random number generator states from get_rng_state"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class TrainProgress(object):
+    """Tracks the position in training for step level checkpoints"""
+
+    def __init__(self, save_every=0, save_fn=None):
+        """
+        Keyword arguments:
+        save_every -- call save_fn after every save_every training batches,
+                      0 never does
+        save_fn -- a function of no arguments which saves a checkpoint
+        """
+        self.save_every = save_every
+        self.save_fn = save_fn
+        self.epoch = None
+        self.step = 0
+        self.running_loss = 0.0
+        self.rng_state = None
+        self.resuming = False
+        self.saved_step = 0
+
+    def start_epoch(self, epoch):
+        """
+        Records the random state at the start of epoch, or restores it
+        if resuming this epoch
+        Returns the number of batches already trained in the epoch
+        """
+        if self.resuming and epoch == self.epoch:
+            self.resuming = False
+            self.saved_step = self.step
+            set_rng_state(self.rng_state)
+            return self.step
+        self.resuming = False
+        self.epoch = epoch
+        self.step = 0
+        self.saved_step = 0
+        self.running_loss = 0.0
+        self.rng_state = get_rng_state()
+        return 0
+
+    def end_step(self, step, running_loss):
+        """
+        Records that step batches are trained and saves if at least
+        save_every batches were trained since the last save
+        """
+        self.step = step
+        self.running_loss = running_loss
+        if (self.save_fn is not None and self.save_every > 0
+                and step - self.saved_step >= self.save_every):
+            self.saved_step = step
+            self.save_fn()
+
+    def end_epoch(self):
+        """Moves to the start of the next epoch, so a save resumes there"""
+        self.epoch += 1
+        self.step = 0
+        self.saved_step = 0
+        self.running_loss = 0.0
+        self.rng_state = get_rng_state()
+
+    def state_dict(self):
+        return {
+            'epoch': self.epoch,
+            'step': self.step,
+            'running_loss': self.running_loss,
+            'rng_state': self.rng_state}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.step = state['step']
+        self.running_loss = state['running_loss']
+        self.rng_state = state['rng_state']
+        self.resuming = True
+
+
+def val_crop_sets(data_loaders):
+    """Returns the validation sets of data_loaders which use fixed crops"""
+    val_sets = {}
+    for name, loader in data_loaders.items():
+        if name == 'train':
+            continue
+        # A DataLoader or a data_loading.InMemoryValLoader
+        val_set = getattr(loader, 'dataset', getattr(loader, 'val_set', None))
+        if getattr(val_set, 'val_transform', False):
+            val_sets[name] = val_set
+    return val_sets
+
+
+def resume_extras(lr_scheduler, progress, best_epoch, best_state,
+                  data_loaders):
+    """Returns the state a resume checkpoint holds beyond a normal one"""
+    return {
+        'lr_scheduler': lr_scheduler.state_dict(),
+        'progress': progress.state_dict(),
+        'best_epoch': best_epoch,
+        'best_state': best_state,
+        # Drawn at random when the validation sets are created
+        'val_crops': {
+            name: val_set.crop_cords
+            for name, val_set in val_crop_sets(data_loaders).items()}}
+
+
+def load_resume_state(location):
+    """Loads a resume checkpoint, which holds more than tensors, to CPU"""
+    try:
+        return torch.load(location, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch before 1.13 has no weights_only and never restricts loads
+        return torch.load(location, map_location='cpu')
+
+
+def restore(resume, model, optimizer, lr_scheduler, progress,
+            data_loaders):
+    """
+    Loads a resume checkpoint into the model, optimizer, lr_scheduler,
+    progress and validation crops of data_loaders,
+    returning the best loss, epoch and state dict
+    """
+    # Skip any partial loading overrides of the model class
+    torch.nn.Module.load_state_dict(model, resume['state_dict'])
+    optimizer.load_state_dict(resume['optimizer'])
+    lr_scheduler.load_state_dict(resume['lr_scheduler'])
+    progress.load_state_dict(resume['progress'])
+    for name, val_set in val_crop_sets(data_loaders).items():
+        if name in resume['val_crops']:
+            val_set.crop_cords = resume['val_crops'][name]
+    print("=> resuming epoch {} after {} batches".format(
+        progress.epoch, progress.step))
+    return resume['best_loss'], resume['best_epoch'], resume['best_state']
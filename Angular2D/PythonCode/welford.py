@@ -20,6 +20,24 @@ def update(existing_aggregate, new_value):
 
     return (count, mean, M2)
 
+def combine(aggregate_a, aggregate_b):
+    """
+    # combine the aggregates of two disjoint sets of values into the
+    # aggregate of all of them, the parallel algorithm of Chan et al.
+    """
+    (count_a, mean_a, M2_a) = aggregate_a
+    (count_b, mean_b, M2_b) = aggregate_b
+    if count_a == 0:
+        return aggregate_b
+    if count_b == 0:
+        return aggregate_a
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    M2 = M2_a + M2_b + delta * delta * count_a * count_b / count
+
+    return (count, mean, M2)
+
 def finalize(existing_aggregate):
     """
     # retrieve the mean, variance and sample variance from an aggregate
@@ -19,7 +19,7 @@ from time import sleep, time
 from random_camera import create_random_camera
 from random_clip import random_clip_look_from, restore_clip
 from random_clip import random_plane_clip_cam
-from common import get_all_files_in_dir
+from common import get_all_files_in_dir, remap_lf
 from modify_transfer_func import modify_tf
 from config_gen import choose_cfg
 import welford
@@ -112,6 +112,17 @@ def create_hdf_storage(hdf5_file, config, network, num_vol_tfs):
                                 shuffle = True)
         colour.create_dataset('timing', time_shape, np.float32)
         colour.create_dataset('camera_extrinsics', cam_shape, np.float32)
+        if config.get("save_remapped", False):
+            # Interleaved layout so the loader can skip angular remapping
+            remap_shape = [
+                num_samples, chs,
+                pixel_dim_y * spatial_rows, pixel_dim_x * spatial_cols]
+            for name in 'remapped_images', 'remapped_warped':
+                colour.create_dataset(
+                    name, remap_shape, np.uint8,
+                    chunks = (1, chs, pixel_dim_y, pixel_dim_x),
+                    compression = "lzf",
+                    shuffle = True)
 
 def save_looking_to_hdf5_group(
     sample_index, h5_canvas_list, camera, config):
@@ -199,6 +210,12 @@ def save_looking_to_hdf5_group(
                 im_data = im_data[::-1, ::-1, ...]
                 group['warped'][sample_index, idx] = im_data[:chs, ...]
 
+            if "remapped_images" in group:
+                group['remapped_images'][sample_index] = remap_lf(
+                    group['images'][sample_index])
+                group['remapped_warped'][sample_index] = remap_lf(
+                    group['warped'][sample_index])
+
         for i, group_tuple in enumerate(h5_canvas_list):
             group = group_tuple[0]
             mean, var, _ = welford.finalize(accumulator_list[i])
@@ -1,3 +1,4 @@
+import math
 import os
 from os import listdir
 from os.path import isfile, isdir, join
@@ -12,6 +13,18 @@ def save_numpy_image(array, location):
     im = Image.fromarray(array.astype(np.uint8))
     im.save(location)
 
+def remap_lf(lf):
+    """
+    Interleaves an N, C, H, W light field into C, H * sqrt(N), W * sqrt(N)
+    View i lands at [:, i % sqrt(N)::sqrt(N), i // sqrt(N)::sqrt(N)]
+    This matches data_transform.create_remap in Angular2D
+    """
+    num, chs, height, width = lf.shape
+    one_way = int(round(math.sqrt(num)))
+    grid = lf.reshape(one_way, one_way, chs, height, width)
+    return grid.transpose(2, 3, 1, 4, 0).reshape(
+        chs, height * one_way, width * one_way)
+
 def make_dir_if_not_exists(location):
     """Makes directory structure for given location"""
     os.makedirs(os.path.dirname(location), exist_ok=True)
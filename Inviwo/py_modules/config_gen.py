@@ -27,6 +27,9 @@ import pathlib
     volume_dir -- the directory which contains the volume files to generate over
     base_tf_dir -- the directory which contains the ivw transfer functions to 
                     generate over
+    save_remapped -- optional, also store remapped_images and remapped_warped
+                        in the interleaved C, H * rows, W * cols layout
+                        the training loader uses. Defaults to False.
 """
 
 def choose_cfg(choice):
@@ -1,27 +1,33 @@
 import argparse
+import os
+import sys
 from os.path import join
 
 import numpy as np
 from PIL import Image
 
-import image_warping
-import evaluate
+# lf_metrics and metric_cache are shared with Angular2D/PythonCode
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, "Angular2D", "PythonCode"))
+
+import lf_metrics
 
 def main(args):
     if args.dir is None:
         print("Please enter a dir to compare in! use --dir flag")
         exit(-1)
+    warps, fulls = [], []
     for i in range(64):
         loc1 = join(args.dir, "Warp{}.png".format(i))
         loc2 = join(args.dir, "Full{}.png".format(i))
-        im1 = Image.open(loc1)
-        im2 = Image.open(loc2)
-        im1 = np.array(im1)
-        im2 = np.array(im2)
-        im_a1 = Image.fromarray(im1.astype(np.uint8))
-        im_a2 = Image.fromarray(im2.astype(np.uint8))
-        psnr = evaluate.my_psnr(im1, im2)
-        ssim = evaluate.ssim(im1, im2)
+        warps.append(np.array(Image.open(loc1)))
+        fulls.append(np.array(Image.open(loc2)))
+    # lf_metrics takes N, C, H, W views
+    psnrs, ssims = lf_metrics.view_metrics(
+        np.moveaxis(np.stack(warps), -1, 1),
+        np.moveaxis(np.stack(fulls), -1, 1))
+    for i, (psnr, ssim) in enumerate(zip(psnrs, ssims)):
         print("{}: PSNR {:4f}, SSIM {:4f}".format(i, psnr, ssim))
 
 
@@ -1,57 +1,209 @@
 import os
+import sys
+import csv
 import math
+import multiprocessing
+from functools import partial
 
 import h5py
-import numpy as np
+import torch
 
 import argparse
-import evaluate
+
+# lf_metrics, metric_cache and welford are shared with Angular2D/PythonCode
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, "Angular2D", "PythonCode"))
+
 import welford
+from metric_cache import MetricCache, cached_view_metrics, fingerprint
+
+# The read only hdf5 file of this worker process and its metric cache,
+# opened by open_file
+H5_FILE = None
+CACHE = None
+
+
+def open_file(loc, cache_loc=None, use_cache=True):
+    """Opens the hdf5 file at loc read only, and its cache, for this process"""
+    global H5_FILE, CACHE
+    H5_FILE = h5py.File(loc, 'r')
+    if use_cache:
+        CACHE = MetricCache(loc, cache_loc)
+    # Each worker has one core to itself
+    torch.set_num_threads(1)
+
+
+def source(group, channels, i):
+    """Returns the metric cache source of sample i of group"""
+    return "{}/{}/{}".format(group, i, channels)
+
+
+def summarise(i, psnrs, ssims):
+    """
+    Returns (sample, psnrs, ssims, psnr aggregate, ssim aggregate)
+    of sample i, with welford aggregates over its views
+    """
+    psnr_accumulator = (0, 0, 0)
+    ssim_accumulator = (0, 0, 0)
+    for psnr, ssim in zip(psnrs, ssims):
+        psnr_accumulator = welford.update(psnr_accumulator, psnr)
+        ssim_accumulator = welford.update(ssim_accumulator, ssim)
+    return i, psnrs, ssims, psnr_accumulator, ssim_accumulator
+
+
+def evaluate_shard(group, channels, shard):
+    """
+    Evaluates warped against images for the samples in shard,
+    taking the values of content already in the cache from it
+    Returns the summarise tuple of each sample and the welford
+    aggregates of the psnr and ssim averages of the samples
+    """
+    samples = []
+    shard_psnr_accum = (0, 0, 0)
+    shard_ssim_accum = (0, 0, 0)
+    for i in shard:
+        group1 = H5_FILE[group]["images"][i, :, :channels, ...]
+        group2 = H5_FILE[group]["warped"][i, :, :channels, ...]
+        key = fingerprint(group1, group2)
+        # evaluate.psnr gives infinity for identical views
+        psnrs, ssims = cached_view_metrics(
+            CACHE, key, group1, group2, equal_psnr=math.inf)
+        if CACHE is not None:
+            CACHE.set_source(source(group, channels, i), key)
+        samples.append(summarise(i, psnrs, ssims))
+        _, _, _, psnr_accumulator, ssim_accumulator = samples[-1]
+        shard_psnr_accum = welford.update(
+            shard_psnr_accum, psnr_accumulator[1])
+        shard_ssim_accum = welford.update(
+            shard_ssim_accum, ssim_accumulator[1])
+    return samples, shard_psnr_accum, shard_ssim_accum
+
+
+def make_shards(samples, num_workers, shards_per_worker=4):
+    """
+    Returns contiguous runs of the list samples, a few per worker
+    so that the workers stay busy and the output streams
+    """
+    size = max(1, math.ceil(
+        len(samples) / (num_workers * shards_per_worker)))
+    return [samples[start:start + size]
+            for start in range(0, len(samples), size)]
+
+
+def open_csv(prefix, name, header):
+    """Returns a csv file prefix_name.csv and a writer of it with header"""
+    csv_file = open("{}_{}.csv".format(prefix, name), 'w', newline='')
+    writer = csv.writer(csv_file)
+    writer.writerow(header)
+    return csv_file, writer
+
+
+def computed_samples(results, partials):
+    """
+    Yields the summarise tuple of each sample of the evaluate_shard
+    results in order, appending the aggregates of each shard to partials
+    """
+    for samples, shard_psnr_accum, shard_ssim_accum in results:
+        partials.append((shard_psnr_accum, shard_ssim_accum))
+        yield from samples
 
 
 def main(args):
-    with h5py.File(args.loc, 'r') as f:
-        overall_psnr_accum = (0, 0, 0)
-        overall_ssim_accum = (0, 0, 0)
+    # Samples stored in the cache since the file last changed are
+    # reported without reading them or starting any workers
+    cached = {}
+    if not args.no_cache:
+        cache = MetricCache(args.loc, args.cache_loc)
         for i in range(args.n):
-            psnr_accumulator = (0, 0, 0)
-            ssim_accumulator = (0, 0, 0)
-            group1 = f[args.group]["images"][i, :, :args.channels, ...]
-            group2 = f[args.group]["warped"][i, :, :args.channels, ...]
-            for j in range(64):
-                im1 = group1[j]
-                im2 = group2[j]
-                im1 = np.swapaxes(im1, 0, 2)
-                im1 = np.swapaxes(im1, 0, 1)
-                im2 = np.swapaxes(im2, 0, 2)
-                im2 = np.swapaxes(im2, 0, 1)
-                psnr = evaluate.psnr(im1, im2)
-                ssim = evaluate.ssim(im1, im2)
-                psnr_accumulator = welford.update(psnr_accumulator, psnr)
-                ssim_accumulator = welford.update(ssim_accumulator, ssim)
-                if args.verbose:
-                    print("{};{};PSNR {:4f};SSIM {:4f}".format(
-                        i, j, psnr, ssim))
-            psnr_mean, psnr_var, _ = welford.finalize(psnr_accumulator)
-            ssim_mean, ssim_var, _ = welford.finalize(ssim_accumulator)
+            values = cache.lookup(source(args.group, args.channels, i))
+            if values is not None:
+                cached[i] = summarise(i, *values)
+        cache.close()
+        print("{} samples from the metric cache, evaluating {}".format(
+            len(cached), args.n - len(cached)))
+    missing = [i for i in range(args.n) if i not in cached]
+
+    shards = make_shards(missing, args.workers)
+    evaluate = partial(evaluate_shard, args.group, args.channels)
+    init_args = (args.loc, args.cache_loc, not args.no_cache)
+    if args.workers > 1 and len(shards) > 1:
+        # Spawn, as hdf5 handles must not be shared with forked processes
+        pool = multiprocessing.get_context('spawn').Pool(
+            min(args.workers, len(shards)),
+            initializer=open_file, initargs=init_args)
+        results = pool.imap(evaluate, shards)
+    else:
+        pool = None
+        if shards:
+            open_file(*init_args)
+        results = map(evaluate, shards)
+    partials = []
+    computed = computed_samples(results, partials)
+
+    csv_files = []
+    if args.csv:
+        view_file, view_writer = open_csv(
+            args.csv, "views", ["sample", "view", "psnr", "ssim"])
+        sample_file, sample_writer = open_csv(
+            args.csv, "samples", ["sample", "psnr_mean", "psnr_stddev",
+                                  "ssim_mean", "ssim_stddev"])
+        csv_files = [view_file, sample_file]
+
+    cached_psnr_accum = (0, 0, 0)
+    cached_ssim_accum = (0, 0, 0)
+    for i in range(args.n):
+        if i in cached:
+            _, psnrs, ssims, psnr_accumulator, ssim_accumulator = cached[i]
+            cached_psnr_accum = welford.update(
+                cached_psnr_accum, psnr_accumulator[1])
+            cached_ssim_accum = welford.update(
+                cached_ssim_accum, ssim_accumulator[1])
+        else:
+            _, psnrs, ssims, psnr_accumulator, ssim_accumulator = next(
+                computed)
+        for j, (psnr, ssim) in enumerate(zip(psnrs, ssims)):
             if args.verbose:
-                print()
-            print(
-                "{};psnr average {:5f};stddev {:5f}".format(
-                    i, psnr_mean, math.sqrt(psnr_var)) +
-                ";ssim average {:5f};stddev {:5f}".format(
-                    ssim_mean, math.sqrt(ssim_var)))
-            overall_psnr_accum = welford.update(
-                overall_psnr_accum, psnr_mean)
-            overall_ssim_accum = welford.update(
-                overall_ssim_accum, ssim_mean)
-        if args.n > 1:
-            psnr_mean, psnr_var, _ = welford.finalize(overall_psnr_accum)
-            ssim_mean, ssim_var, _ = welford.finalize(overall_ssim_accum)
-            print("\nOverall psnr average {:5f}; stddev {:5f}".format(
-                psnr_mean, math.sqrt(psnr_var)))
-            print("Overall ssim average {:5f}; stddev {:5f}".format(
+                print("{};{};PSNR {:4f};SSIM {:4f}".format(
+                    i, j, psnr, ssim))
+            if args.csv:
+                view_writer.writerow([i, j, psnr, ssim])
+        psnr_mean, psnr_var, _ = welford.finalize(psnr_accumulator)
+        ssim_mean, ssim_var, _ = welford.finalize(ssim_accumulator)
+        if args.verbose:
+            print()
+        print(
+            "{};psnr average {:5f};stddev {:5f}".format(
+                i, psnr_mean, math.sqrt(psnr_var)) +
+            ";ssim average {:5f};stddev {:5f}".format(
                 ssim_mean, math.sqrt(ssim_var)))
+        if args.csv:
+            sample_writer.writerow([
+                i, psnr_mean, math.sqrt(psnr_var),
+                ssim_mean, math.sqrt(ssim_var)])
+            for csv_file in csv_files:
+                csv_file.flush()
+
+    overall_psnr_accum = cached_psnr_accum
+    overall_ssim_accum = cached_ssim_accum
+    for shard_psnr_accum, shard_ssim_accum in partials:
+        overall_psnr_accum = welford.combine(
+            overall_psnr_accum, shard_psnr_accum)
+        overall_ssim_accum = welford.combine(
+            overall_ssim_accum, shard_ssim_accum)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for csv_file in csv_files:
+        csv_file.close()
+
+    if args.n > 1:
+        psnr_mean, psnr_var, _ = welford.finalize(overall_psnr_accum)
+        ssim_mean, ssim_var, _ = welford.finalize(overall_ssim_accum)
+        print("\nOverall psnr average {:5f}; stddev {:5f}".format(
+            psnr_mean, math.sqrt(psnr_var)))
+        print("Overall ssim average {:5f}; stddev {:5f}".format(
+            ssim_mean, math.sqrt(ssim_var)))
 
 
 if __name__ == '__main__':
@@ -66,5 +218,17 @@ if __name__ == '__main__':
                         help="hdf5 group to get images from")
     PARSER.add_argument("--channels", "-c", type=int, default=3,
                         help="How many channels to use in the image")
+    PARSER.add_argument("--workers", "-w", type=int,
+                        default=os.cpu_count(),
+                        help="Processes to evaluate samples in, " +
+                        "default one per core")
+    PARSER.add_argument("--csv", type=str, default=None,
+                        help="Write per view and per sample values to " +
+                        "csv files starting with this path")
+    PARSER.add_argument("--no_cache", action="store_true",
+                        help="Evaluate every sample without the metric cache")
+    PARSER.add_argument("--cache_loc", type=str, default=None,
+                        help="The metric cache file, " +
+                        "default next to the hdf5 file")
     ARGS, _ = PARSER.parse_known_args()
     main(ARGS)
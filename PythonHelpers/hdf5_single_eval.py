@@ -1,44 +1,66 @@
 import os
+import sys
 import math
 
 import h5py
 import numpy as np
 
 import argparse
-import evaluate
+
+# lf_metrics, metric_cache and welford are shared with Angular2D/PythonCode
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, "Angular2D", "PythonCode"))
+
 import welford
+from metric_cache import MetricCache, cached_view_metrics, fingerprint
 
 import common
 def main(args):
+    cache = None if args.no_cache else MetricCache(args.loc, args.cache_loc)
     with h5py.File(args.loc, 'r') as f:
         overall_psnr_accum = (0, 0, 0)
         overall_ssim_accum = (0, 0, 0)
         i = args.n
         psnr_accumulator = (0, 0, 0)
         ssim_accumulator = (0, 0, 0)
-        group1 = f[args.group]["images"][i, :, :args.channels, ...]
-        group2 = f[args.group]["warped"][i, :, :args.channels, ...]
+        source = "{}/{}/{}".format(args.group, i, args.channels)
+        values = None if cache is None else cache.lookup(source)
+        if values is not None:
+            # Stored as evaluate.psnr gives, infinity for identical views
+            psnrs, ssims = values
+        # The views are only read if they are saved or not in the cache
+        if values is None or args.out_loc is not None:
+            group1 = f[args.group]["images"][i, :, :args.channels, ...]
+            group2 = f[args.group]["warped"][i, :, :args.channels, ...]
+        if values is None:
+            key = fingerprint(group1, group2)
+            # evaluate.psnr gives infinity for identical views
+            psnrs, ssims = cached_view_metrics(
+                cache, key, group1, group2, equal_psnr=math.inf)
+            if cache is not None:
+                cache.set_source(source, key)
         for j in range(64):
-            im1_out_location = os.path.join(
-                args.out_loc, "{}/gt{}.png".format(i, j))
-            im2_out_location = os.path.join(
-                args.out_loc, "{}/warp{}.png".format(i, j))
-            im1 = group1[j]
-            im2 = group2[j]
-            im1 = np.swapaxes(im1, 0, 2)
-            im1 = np.swapaxes(im1, 0, 1)
-            im2 = np.swapaxes(im2, 0, 2)
-            im2 = np.swapaxes(im2, 0, 1)
-            common.save_numpy_image(
-                array=im1,
-                location=im1_out_location
-            )
-            common.save_numpy_image(
-                array=im2,
-                location=im2_out_location
-            )
-            psnr = evaluate.psnr(im1, im2)
-            ssim = evaluate.ssim(im1, im2)
+            if args.out_loc is not None:
+                im1_out_location = os.path.join(
+                    args.out_loc, "{}/gt{}.png".format(i, j))
+                im2_out_location = os.path.join(
+                    args.out_loc, "{}/warp{}.png".format(i, j))
+                im1 = group1[j]
+                im2 = group2[j]
+                im1 = np.swapaxes(im1, 0, 2)
+                im1 = np.swapaxes(im1, 0, 1)
+                im2 = np.swapaxes(im2, 0, 2)
+                im2 = np.swapaxes(im2, 0, 1)
+                common.save_numpy_image(
+                    array=im1,
+                    location=im1_out_location
+                )
+                common.save_numpy_image(
+                    array=im2,
+                    location=im2_out_location
+                )
+            psnr, ssim = psnrs[j], ssims[j]
             psnr_accumulator = welford.update(psnr_accumulator, psnr)
             ssim_accumulator = welford.update(ssim_accumulator, ssim)
             if args.verbose:
@@ -57,6 +79,8 @@ def main(args):
             overall_psnr_accum, psnr_mean)
         overall_ssim_accum = welford.update(
             overall_ssim_accum, ssim_mean)
+    if cache is not None:
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -72,6 +96,11 @@ if __name__ == '__main__':
     PARSER.add_argument("--channels", "-c", type=int, default=3,
                         help="How many channels to use in the image")
     PARSER.add_argument("--out_loc", type=str, default=None,
-                        help="Where to save images")
+                        help="Where to save images, none are saved if unset")
+    PARSER.add_argument("--no_cache", action="store_true",
+                        help="Evaluate without the metric cache")
+    PARSER.add_argument("--cache_loc", type=str, default=None,
+                        help="The metric cache file, " +
+                        "default next to the hdf5 file")
     ARGS, _ = PARSER.parse_known_args()
     main(ARGS)
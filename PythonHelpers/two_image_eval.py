@@ -1,9 +1,16 @@
 import argparse
+import os
+import sys
 
 import numpy as np
 from PIL import Image
 
-import evaluate
+# lf_metrics is shared with Angular2D/PythonCode
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, "Angular2D", "PythonCode"))
+
+import lf_metrics
 
 def main(args):
     if args.im1 is None or args.im2 is None:
@@ -14,8 +21,11 @@ def main(args):
     im2 = Image.open(args.im2)
     im1 = np.array(im1)
     im2 = np.array(im2)
-    psnr = evaluate.my_psnr(im1, im2)
-    ssim = evaluate.ssim(im1, im2)
+    # lf_metrics takes N, C, H, W views, here a batch of one
+    psnrs, ssims = lf_metrics.view_metrics(
+        np.moveaxis(np.atleast_3d(im1), -1, 0)[None],
+        np.moveaxis(np.atleast_3d(im2), -1, 0)[None])
+    psnr, ssim = psnrs[0], ssims[0]
     print("PSNR {:4f}, SSIM {:4f}".format(psnr, ssim))
 
 if __name__ == '__main__':